@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from apps.photos.models import Person, Location, Album, Photo, Thumbnail
+from apps.photos.models import (
+    Person, Location, Album, Photo, Rendition, Thumbnail, ThumbnailJob)
 
 
 class NameOnlyAdmin(admin.ModelAdmin):
@@ -13,11 +14,21 @@ class AlbumAdmin(admin.ModelAdmin):
 
 class ThumbnailInline(admin.TabularInline):
     model = Thumbnail
-    readonly_fields = ['size', 'file', ]
+    readonly_fields = ['size', 'file', 'rendition', ]
+
+
+class ThumbnailJobAdmin(admin.ModelAdmin):
+    list_display = ['photo', 'size', 'created', 'started', 'attempts', ]
+    readonly_fields = ['error', ]
+
+
+class RenditionAdmin(admin.ModelAdmin):
+    list_display = ['checksum', 'size', 'version', 'reference_count', ]
+    readonly_fields = ['checksum', 'size', 'version', 'file', 'reference_count', ]
 
 
 class PhotoAdmin(admin.ModelAdmin):
-    list_display = ['name', 'album', ]
+    list_display = ['name', 'album', 'exif_datetime', 'exif_model', ]
     inlines = [ThumbnailInline, ]
 
 
@@ -25,3 +36,5 @@ admin.site.register(Person, NameOnlyAdmin)
 admin.site.register(Location, NameOnlyAdmin)
 admin.site.register(Album, AlbumAdmin)
 admin.site.register(Photo, PhotoAdmin)
+admin.site.register(ThumbnailJob, ThumbnailJobAdmin)
+admin.site.register(Rendition, RenditionAdmin)
@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class PhotosConfig(AppConfig):
+    name = 'apps.photos'
+
+    def ready(self):
+        # Connects the signals that keep the search and tag indexes, and the
+        # counters, up to date
+        from apps.photos import counters, search, tags  # noqa
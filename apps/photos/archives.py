@@ -0,0 +1,219 @@
+import fcntl
+import glob
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+from apps.photos.models import Photo
+from apps.photos.utils import get_upright_original
+from utils.http import get_modified_timestamp
+from utils.zip import ZIP_CHUNK_SIZE, stream_zip
+
+# Where album archives are kept, in the storage of the photos
+ARCHIVE_DIR = 'photos/archive'
+
+
+def get_album_version(album):
+    """
+    Return a version of the album's content, which changes whenever a photo
+    is added to, removed from or rotated in the album.
+    """
+    digest = hashlib.sha1()
+    photos = album.photo_set.order_by('pk').values_list('pk', 'file', 'orientation')
+    for photo in photos.iterator():
+        digest.update('{}:{}:{}\n'.format(*photo).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+class AlbumArchive:
+    """
+    The zip file of an album's originals for its current version. Archives are
+    built once, when the first request asks for them, and kept so later
+    requests for the same version are served from disk. A lock per album makes
+    concurrent requests wait for that single build instead of building the
+    archive themselves. The archives that were used the least recently are
+    evicted once they take up more than ALBUM_ARCHIVE_MAX_SIZE bytes.
+    Archives are kept next to the originals (so they can be served the same
+    way), which needs a storage with a local filesystem. With
+    ALBUM_ARCHIVE_MAX_SIZE = 0 nothing is kept (and the storage is only
+    read), so archives can still be streamed from any storage.
+    """
+
+    def __init__(self, album):
+        self.album = album
+        self.storage = Photo._meta.get_field('file').storage
+        self.enabled = bool(settings.ALBUM_ARCHIVE_MAX_SIZE)
+        self.version = self.name = self.path = None
+        if self.enabled:
+            self.version = get_album_version(album)
+            self.name = '{}/album-{}-{}.zip'.format(ARCHIVE_DIR, album.pk, self.version)
+            self.path = self.storage.path(self.name)
+
+    def get_photos(self):
+        """
+        Return the (file, checksum, orientation) of each photo in the album.
+        """
+        return self.album.photo_set.values_list('file', 'checksum', 'orientation')
+
+    def get_files(self, photos):
+        """
+        Yield the (arcname, file, modified) of each of the given photos (see
+        get_photos) for stream_zip: the original, or a copy turned the new way
+        for photos that were rotated (see get_upright_original). This only
+        touches storage, so it can run in another thread.
+        """
+        for name, checksum, orientation in photos:
+            upright_name = get_upright_original(self.storage, name, checksum, orientation)
+            file = self.storage.open(upright_name, 'rb')
+            yield name.split('/')[-1], file, get_modified_timestamp(self.storage, name)
+
+    def exists(self):
+        return self.enabled and os.path.exists(self.path)
+
+    def touch(self):
+        """
+        Mark the archive as used. Only the access time is changed, so the
+        ETag (which depends on the modification time) stays the same.
+        """
+        try:
+            os.utime(self.path, (time.time(), os.stat(self.path).st_mtime))
+        except OSError:
+            pass
+
+    def lock(self):
+        """
+        Wait until no other request is building an archive of the album, and
+        return the (open) lock file. Closing it releases the lock.
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        lock_path = os.path.join(os.path.dirname(self.path), 'album-{}.lock'.format(self.album.pk))
+        handle = open(lock_path, 'a')
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        return handle
+
+    def build(self, lock):
+        """
+        Start building the archive (see ArchiveBuild) and return an iterable
+        that yields it a chunk at a time as it is written. The given lock is
+        released as soon as the archive is complete.
+        """
+        return ArchiveBuild(self, lock)
+
+    def evict(self):
+        """
+        Delete the archives of older versions of the album, and then the
+        least recently used archives until the rest fits in
+        ALBUM_ARCHIVE_MAX_SIZE.
+        """
+        pattern = os.path.join(os.path.dirname(self.path), 'album-{}-*.zip'.format(self.album.pk))
+        for path in glob.glob(pattern):
+            if path != self.path:
+                remove_archive(path)
+        archives = []
+        directory = os.path.dirname(self.path)
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith('.zip') and path != self.path:
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                archives.append((stat.st_atime, stat.st_size, path))
+        total = sum(size for atime, size, path in archives)
+        if self.exists():
+            total += os.path.getsize(self.path)
+        for atime, size, path in sorted(archives):
+            if total <= settings.ALBUM_ARCHIVE_MAX_SIZE:
+                break
+            remove_archive(path)
+            total -= size
+
+
+class ArchiveBuild:
+    """
+    Builds an album archive in a thread, into a temporary file that only takes
+    the place of the cached archive once it is complete, and yields the file
+    as it grows. The build does not wait for the response, so a slow client
+    (or one that goes away) does not keep the lock, and with it the other
+    requests for the album, waiting: the lock is released as soon as the
+    archive is complete.
+    """
+
+    def __init__(self, archive, lock):
+        self.archive = archive
+        self.lock = lock
+        self.temp = '{}.{}.tmp'.format(archive.path, uuid.uuid4().hex)
+        self.changed = threading.Condition()
+        self.written = 0
+        self.finished = False
+        self.error = None
+        try:
+            # The photos are read here, the thread does not use the database
+            files = archive.get_files(list(archive.get_photos()))
+            handle = open(self.temp, 'wb')
+            self.reader = open(self.temp, 'rb')
+        except Exception:
+            lock.close()
+            raise
+        thread = threading.Thread(target=self.write, args=(handle, files))
+        thread.daemon = True
+        thread.start()
+
+    def __iter__(self):
+        return self.read()
+
+    def write(self, handle, files):
+        try:
+            try:
+                with handle:
+                    for chunk in stream_zip(files):
+                        handle.write(chunk)
+                        handle.flush()
+                        with self.changed:
+                            self.written += len(chunk)
+                            self.changed.notify_all()
+                os.replace(self.temp, self.archive.path)
+            finally:
+                if os.path.exists(self.temp):
+                    os.remove(self.temp)
+                self.lock.close()
+            self.archive.evict()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.changed:
+                self.finished = True
+                self.changed.notify_all()
+
+    def read(self):
+        """
+        Yield what the thread writes, until it is done. The temporary file is
+        read through a handle that was opened before it was renamed (or
+        removed), so it can always be read to the end.
+        """
+        position = 0
+        with self.reader:
+            while True:
+                with self.changed:
+                    while self.written == position and not self.finished:
+                        self.changed.wait()
+                    written, finished = self.written, self.finished
+                while position < written:
+                    chunk = self.reader.read(min(ZIP_CHUNK_SIZE, written - position))
+                    position += len(chunk)
+                    yield chunk
+                if finished and position == written:
+                    break
+        if self.error is not None:
+            raise self.error
+
+
+def remove_archive(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,150 @@
+from django.db import connection, models
+
+from apps.photos.models import Album, Location, Person, Photo
+
+TAGS_TABLE = Photo.people.through._meta.db_table
+
+# Each statement recounts the photos (or albums) and picks the cover of the
+# rows it updates, with correlated subqueries that only touch indexes. Covers
+# are the first photo by name (and id, for photos with the same name), the
+# order the photos are listed in. The cover of a location is that of its first
+# album that has photos.
+REFRESH_SQL = {
+    Album: (
+        'UPDATE {album} SET '
+        'photo_count = (SELECT COUNT(*) FROM {photo} WHERE {photo}.album_id = {album}.id), '
+        'cover_photo_id = (SELECT {photo}.id FROM {photo} WHERE {photo}.album_id = {album}.id '
+        'ORDER BY {photo}.name, {photo}.id LIMIT 1)'),
+    Person: (
+        'UPDATE {person} SET '
+        'photo_count = (SELECT COUNT(*) FROM {tags} WHERE {tags}.person_id = {person}.id), '
+        'cover_photo_id = (SELECT {photo}.id FROM {photo} '
+        'INNER JOIN {tags} ON {tags}.photo_id = {photo}.id WHERE {tags}.person_id = {person}.id '
+        'ORDER BY {photo}.name, {photo}.id LIMIT 1)'),
+    Location: (
+        'UPDATE {location} SET '
+        'album_count = (SELECT COUNT(*) FROM {album} WHERE {album}.location_id = {location}.id), '
+        'cover_photo_id = (SELECT {album}.cover_photo_id FROM {album} '
+        'WHERE {album}.location_id = {location}.id AND {album}.cover_photo_id IS NOT NULL '
+        'ORDER BY {album}.name, {album}.id LIMIT 1)'),
+}
+
+
+def refresh(model, ids=None):
+    """
+    Bring the counts and covers of the given albums, people or locations (all
+    of them when ids is None) up to date, with a single UPDATE. Returns the
+    number of rows it updated.
+    """
+    sql = REFRESH_SQL[model].format(
+        album=Album._meta.db_table, location=Location._meta.db_table,
+        person=Person._meta.db_table, photo=Photo._meta.db_table, tags=TAGS_TABLE)
+    params = []
+    if ids is not None:
+        ids = sorted(set(pk for pk in ids if pk is not None))
+        if not ids:
+            return 0
+        sql += ' WHERE id IN ({})'.format(', '.join(['%s'] * len(ids)))
+        params = ids
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+
+def refresh_albums(album_ids):
+    """
+    Refresh the given albums, and then their locations (whose covers come
+    from their albums).
+    """
+    refresh(Album, album_ids)
+    location_ids = Album.objects.filter(pk__in=list(album_ids)).values_list('location_id', flat=True)
+    refresh(Location, location_ids)
+
+
+def reconcile():
+    """
+    Recount every album, person and location, and pick their covers again.
+    Returns the number of rows updated for each.
+    """
+    return dict((model, refresh(model)) for model in (Album, Person, Location))
+
+
+def remember_old_values(sender, **kwargs):
+    """
+    This signal remembers the album and name of a photo, or the location of an
+    album, before it is saved, for refresh_after_save.
+    """
+    instance = kwargs['instance']
+    fields = ('album_id', 'name') if sender is Photo else ('location_id',)
+    instance._counters_old = None
+    if instance.pk is not None:
+        instance._counters_old = sender.objects.filter(pk=instance.pk).values_list(*fields).first()
+
+
+def refresh_after_save(sender, **kwargs):
+    """
+    This signal refreshes what a saved photo counts towards, when it was
+    added, moved or renamed (which can change the covers). Albums, people and
+    locations are refreshed themselves as well, since saving them writes the
+    counters they were loaded with.
+    """
+    instance = kwargs['instance']
+    old = getattr(instance, '_counters_old', None)
+    if sender is Photo:
+        if old == (instance.album_id, instance.name):
+            return
+        refresh_albums([instance.album_id, old and old[0]])
+        if old:
+            refresh(Person, instance.people.values_list('pk', flat=True))
+    elif sender is Album:
+        refresh_albums([instance.pk])
+        refresh(Location, [old and old[0]])
+    else:
+        refresh(sender, [instance.pk])
+
+
+def remember_photo_before_delete(sender, **kwargs):
+    """
+    This signal remembers the people in a photo that is about to be deleted,
+    since deleting their tags does not send signals.
+    """
+    instance = kwargs['instance']
+    instance._counters_people = list(instance.people.values_list('pk', flat=True))
+
+
+def refresh_after_photo_delete(sender, **kwargs):
+    instance = kwargs['instance']
+    refresh_albums([instance.album_id])
+    refresh(Person, getattr(instance, '_counters_people', []))
+
+
+def refresh_after_album_delete(sender, **kwargs):
+    refresh(Location, [kwargs['instance'].location_id])
+
+
+def refresh_tagged_people(sender, **kwargs):
+    """
+    This signal refreshes the people whose photos changed, from either side.
+    """
+    action, instance = kwargs['action'], kwargs['instance']
+    if kwargs['reverse']:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            refresh(Person, [instance.pk])
+    elif action == 'pre_clear':
+        instance._counters_people = list(instance.people.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        refresh(Person, getattr(instance, '_counters_people', []))
+    elif action in ('post_add', 'post_remove'):
+        refresh(Person, kwargs['pk_set'])
+
+
+models.signals.pre_save.connect(remember_old_values, sender=Photo)
+models.signals.pre_save.connect(remember_old_values, sender=Album)
+models.signals.post_save.connect(refresh_after_save, sender=Photo)
+models.signals.post_save.connect(refresh_after_save, sender=Album)
+models.signals.post_save.connect(refresh_after_save, sender=Person)
+models.signals.post_save.connect(refresh_after_save, sender=Location)
+models.signals.pre_delete.connect(remember_photo_before_delete, sender=Photo)
+models.signals.post_delete.connect(refresh_after_photo_delete, sender=Photo)
+models.signals.post_delete.connect(refresh_after_album_delete, sender=Album)
+models.signals.m2m_changed.connect(refresh_tagged_people, sender=Photo.people.through)
@@ -1,10 +1,25 @@
+from collections import defaultdict
+import shutil
+import tempfile
+import zipfile
+
 from django import forms
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.db import transaction
 from django.utils.translation import ugettext_lazy as _
 from django.forms.models import modelform_factory
 
-from apps.photos.models import Album, Photo, Location, Person
-from apps.photos.utils import friendly_name
-from utils.uploads import file_allowed
+from apps.photos.counters import refresh_albums
+from apps.photos.search import index_photos
+from apps.photos.tags import tag_index
+from apps.photos.models import (
+    Album, Photo, Location, Person, Rendition, Thumbnail, UploadSession)
+from apps.photos.utils import (
+    DEGENERATE_DHASHES, friendly_name, get_chunk_variants, get_dhash, get_exif_data,
+    hamming_distance, split_dhash)
+from utils.uploads import file_allowed, split_extension
 
 AlbumForm = modelform_factory(Album, fields=['name', 'month', 'year', 'location'])
 LocationNameForm = modelform_factory(Location, fields=['name', ])
@@ -34,7 +49,11 @@ class AlbumMergeForm(forms.Form):
         """
         # Move all the photos from this album to the new album
         new_album = self.cleaned_data['new_album']
+        photo_ids = list(self.instance.photo_set.values_list('pk', flat=True))
         self.instance.photo_set.all().update(album=new_album)
+        index_photos(photo_ids)
+        tag_index.changed(photos=photo_ids)
+        refresh_albums([new_album.pk])
         # Delete this album
         self.instance.delete()
         # Return the new album
@@ -51,9 +70,37 @@ class SearchForm(forms.Form):
         label=_('Albums'), queryset=Album.objects.all(), required=False)
     p = forms.ModelMultipleChoiceField(
         label=_('People'), queryset=Person.objects.all(), required=False)
+    pa = forms.ModelMultipleChoiceField(
+        label=_('With all of these people'), queryset=Person.objects.all(), required=False)
+    px = forms.ModelMultipleChoiceField(
+        label=_('Without these people'), queryset=Person.objects.all(), required=False)
     l = forms.ModelMultipleChoiceField(
         label=_('Locations'), queryset=Location.objects.all(), required=False)
     q = forms.CharField(label=_('Search'), required=False)
+    c = forms.MultipleChoiceField(label=_('Cameras'), required=False)
+    n = forms.MultipleChoiceField(label=_('Lenses'), required=False)
+    f = forms.DateField(label=_('Taken from'), required=False,
+                        help_text=_('YYYY-MM-DD'))
+    t = forms.DateField(label=_('Taken until'), required=False,
+                        help_text=_('YYYY-MM-DD'))
+    iso_min = forms.IntegerField(label=_('ISO from'), min_value=0, required=False)
+    iso_max = forms.IntegerField(label=_('ISO up to'), min_value=0, required=False)
+    o = forms.ChoiceField(label=_('Sort by'), required=False, choices=(
+        ('name', _('Name')),
+        ('taken', _('Oldest first')),
+        ('-taken', _('Newest first')),
+    ))
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The cameras and lenses come straight from their indexes
+        self.fields['c'].choices = self.get_choices('exif_model')
+        self.fields['n'].choices = self.get_choices('exif_lens')
+
+    def get_choices(self, field):
+        values = (Photo.objects.exclude(**{field: ''}).order_by(field)
+                  .values_list(field, flat=True).distinct())
+        return [(value, value) for value in values]
 
 
 class UploadForm(forms.Form):
@@ -65,9 +112,15 @@ class UploadForm(forms.Form):
 
     album = forms.ModelChoiceField(queryset=Album.objects.all())
     photos = forms.FileField(label=_('Photos'))
+    skip_duplicates = forms.BooleanField(
+        label=_('Skip photos that are already in the gallery'),
+        required=False)
+
+    # Number of photos that are inserted, and whose thumbnails are created, at once
+    thumbnail_batch = 50
 
     class Meta:
-        fields = ['album', 'photos']
+        fields = ['album', 'photos', 'skip_duplicates']
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -77,12 +130,14 @@ class UploadForm(forms.Form):
     def clean_photos(self):
         """
         Make sure each photo uploaded is allowed, according to the
-        file_allowed function.
+        file_allowed function, and that zip files can be read.
         """
         files_not_allowed = []
         for file_handle in self.files.getlist('photos'):
             if not file_allowed(file_handle.name):
                 files_not_allowed.append(file_handle.name)
+            elif is_zip(file_handle.name) and not zipfile.is_zipfile(file_handle):
+                files_not_allowed.append(file_handle.name)
         if files_not_allowed:
             raise forms.ValidationError(
                 _('The following files are not allowed: %s')
@@ -91,16 +146,210 @@ class UploadForm(forms.Form):
 
     def save(self):
         """
-        Add each photo to the album (which must already be existing).
-        Create a thumbnail so there is no lag when redirecting to the album.
-        TODO: support for zip file uploading.
+        Add each photo to the album (which must already be existing), all of
+        them or none. The images in zip files are added one at a time as they
+        are read from the archive. The originals are stored as they are read,
+        and the thumbnails of every thumbnail_batch of them are rendered in
+        parallel, so there is no lag when redirecting to the album. Once all
+        of them are ready, the photos and their thumbnails are inserted in one
+        short transaction. If anything fails, nothing is inserted, and the
+        files that were stored and rendered for the upload are deleted again.
+        Photos that look the same as one already in the gallery (or earlier
+        in the upload) are left out (and listed in self.duplicates) if
+        skip_duplicates is checked. Files in zip files that are not images are
+        left out (and listed in self.skipped).
         """
         self.instance = self.cleaned_data['album']
         self.photo_count = 0
-        for file_handle in self.files.getlist('photos'):
-            self.photo_count = self.photo_count + 1
-            photo_name = friendly_name(file_handle.name)
-            photo = Photo.objects.create(
-                album=self.instance, name=photo_name, file=file_handle)
-            photo.thumbnail('200x200-fit')
+        self.duplicates = []
+        self.skipped = []
+        self.added = []
+        self.staged_dhashes = defaultdict(list)
+        photos, renditions, batch = [], [], []
+        try:
+            for file_handle in self.files.getlist('photos'):
+                if is_zip(file_handle.name):
+                    members = self.get_zip_members(file_handle)
+                else:
+                    members = [file_handle]
+                for member in members:
+                    photo = self.store_photo(member, from_zip=is_zip(file_handle.name))
+                    if photo is not None:
+                        photos.append(photo)
+                        batch.append(photo)
+                    if len(batch) >= self.thumbnail_batch:
+                        renditions.extend(self.render_thumbnails(batch))
+                        batch = []
+            renditions.extend(self.render_thumbnails(batch))
+            self.add_photos(photos, renditions)
+        except Exception:
+            self.discard_photos(photos, renditions)
+            raise
         return self.instance
+
+    def render_thumbnails(self, photos):
+        """
+        Render the grid thumbnails of the given (stored, not inserted) photos
+        all at once, even when THUMBNAIL_QUEUE is on. Returns a dictionary of
+        size -> Rendition for each photo.
+        """
+        sizes = settings.THUMBNAIL_LADDERS['grid']
+        return Rendition.objects.acquire_many([(photo, sizes) for photo in photos])
+
+    def add_photos(self, photos, renditions):
+        """
+        Insert the given photos, and thumbnails for the given renditions of
+        them, in one transaction, and bring the album, the search index and
+        the tag index up to date with them (bulk_create sends no signals).
+        """
+        if not photos:
+            return
+        with transaction.atomic():
+            Photo.objects.bulk_create(photos)
+            # bulk_create does not set primary keys on SQLite, but the file
+            # names are unique. They are looked up a batch at a time, for
+            # SQLite's limit on query parameters.
+            names = [photo.file.name for photo in photos]
+            pks = {}
+            for start in range(0, len(names), self.thumbnail_batch):
+                pks.update(Photo.objects.filter(
+                    file__in=names[start:start + self.thumbnail_batch]).values_list('file', 'pk'))
+            thumbnails = []
+            for photo, acquired in zip(photos, renditions):
+                photo.pk = pks[photo.file.name]
+                photo._state.adding = False
+                for size, rendition in acquired.items():
+                    thumbnail = Thumbnail(photo=photo, size=size)
+                    thumbnail.set_rendition(rendition)
+                    thumbnails.append(thumbnail)
+            Thumbnail.objects.bulk_create(thumbnails)
+            refresh_albums([self.instance.pk])
+            index_photos(pks.values())
+        tag_index.changed(photos=pks.values())
+        for thumbnail in thumbnails:
+            setattr(thumbnail.photo, Photo.get_thumbnail_attr(thumbnail.size), thumbnail)
+        self.photo_count = len(photos)
+        self.added = photos
+
+    def discard_photos(self, photos, renditions):
+        """
+        Drop the references taken on the given renditions (which deletes the
+        ones nothing else uses) and delete the originals of the given photos,
+        which were never inserted.
+        """
+        for acquired in renditions:
+            for rendition in acquired.values():
+                Rendition.objects.release(rendition.pk)
+        for photo in photos:
+            photo.file.delete(save=False)
+
+    def store_photo(self, file_handle, from_zip=False):
+        """
+        Store the given file and return a new (unsaved) photo for it in the
+        album, or None if it was left out.
+        """
+        # Read the upload first, so a duplicate is skipped before it is
+        # stored and its thumbnails are rendered
+        exif = get_exif_data(file_handle)
+        dhash = get_dhash(file_handle, exif.get('orientation', 1))
+        if from_zip and dhash is None:
+            self.skipped.append(file_handle.name)
+            return None
+        if self.cleaned_data['skip_duplicates'] and self.is_duplicate(dhash):
+            self.duplicates.append(file_handle.name)
+            return None
+        photo = Photo(album=self.instance, name=friendly_name(file_handle.name))
+        photo.set_exif(exif)
+        photo.dhash = dhash
+        # Store it now, zip members are gone once the next one is read
+        photo.file.save(file_handle.name, file_handle, save=False)
+        if dhash is not None and dhash not in DEGENERATE_DHASHES:
+            for i, chunk in enumerate(split_dhash(dhash)):
+                self.staged_dhashes[(i, chunk)].append(dhash)
+        return photo
+
+    def is_duplicate(self, dhash):
+        """
+        Return True if a photo with the given hash is already in the gallery,
+        or earlier in the upload (whose photos are looked up by the chunks of
+        their hashes, like PhotoQuerySet.near_duplicates does).
+        """
+        if dhash is None or dhash in DEGENERATE_DHASHES:
+            return False
+        if Photo.objects.near_duplicates(dhash):
+            return True
+        distance = settings.DUPLICATE_DISTANCE
+        for i, chunk in enumerate(split_dhash(dhash)):
+            for variant in get_chunk_variants(chunk, distance):
+                for other in self.staged_dhashes.get((i, variant), ()):
+                    if hamming_distance(dhash, other) <= distance:
+                        return True
+        return False
+
+    def get_zip_members(self, file_handle):
+        """
+        Yield each image in the given zip file as a File, one at a time, so
+        only one of them is held (in memory, or on disk if it is large) no
+        matter how big the archive is. Other members are left out.
+        """
+        with zipfile.ZipFile(file_handle) as archive:
+            for info in archive.infolist():
+                path = info.filename
+                filename = path.split('/')[-1]
+                if not filename:
+                    continue
+                if (path.startswith('__MACOSX/') or filename.startswith('.') or
+                        not file_allowed(filename) or is_zip(filename)):
+                    self.skipped.append(path)
+                    continue
+                with tempfile.SpooledTemporaryFile(
+                        max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE) as temp:
+                    with archive.open(info) as member:
+                        shutil.copyfileobj(member, temp)
+                    temp.seek(0)
+                    yield File(temp, name=path)
+
+
+class UploadSessionForm(forms.ModelForm):
+    """
+    A form to start a chunked upload of a single file (see UploadSession).
+    The space the file needs is reserved up front, so unfinished uploads never
+    take up more than CHUNKED_UPLOAD_MAX_TOTAL bytes.
+    """
+
+    class Meta:
+        model = UploadSession
+        fields = ['album', 'filename', 'size', 'skip_duplicates']
+
+    def clean_filename(self):
+        filename = self.cleaned_data['filename']
+        if not file_allowed(filename):
+            raise forms.ValidationError(
+                _('The following files are not allowed: %s') % filename)
+        return filename
+
+    def clean_size(self):
+        size = self.cleaned_data['size']
+        if size < 1 or size > settings.CHUNKED_UPLOAD_MAX_SIZE:
+            raise forms.ValidationError(
+                _('Files must be between 1 and %s bytes.') % settings.CHUNKED_UPLOAD_MAX_SIZE)
+        if UploadSession.objects.reserved_size() + size > settings.CHUNKED_UPLOAD_MAX_TOTAL:
+            raise forms.ValidationError(
+                _('There is no room for this file right now, try again later.'))
+        return size
+
+    def save(self, user):
+        """
+        Create the session for the given user, along with the (empty) file
+        the chunks are written to.
+        """
+        session = super().save(commit=False)
+        session.user = user
+        session.chunk_size = settings.CHUNKED_UPLOAD_CHUNK_SIZE
+        session.file.save('upload.part', ContentFile(b''), save=False)
+        session.save()
+        return session
+
+
+def is_zip(filename):
+    return split_extension(filename)[1] == 'zip'
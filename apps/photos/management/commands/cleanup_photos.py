@@ -1,6 +1,8 @@
 from django.core.management.base import BaseCommand
+from django.db.models import Count
 
-from apps.photos.models import Photo, Thumbnail
+from apps.photos.models import Photo, Rendition, Thumbnail, UploadSession
+from apps.photos.utils import UPRIGHT_DIR
 
 
 class Command(BaseCommand):
@@ -12,20 +14,72 @@ class Command(BaseCommand):
         Removes all photos that do not exist for Photos and for Thumbnails.
         """
         verbosity = int(options['verbosity'])
+        self.cleanup_renditions()
+        self.cleanup_upload_sessions()
         self.cleanup_files(Photo, 'file', 'photos/photo', verbosity)
         self.cleanup_files(Thumbnail, 'file', 'photos/thumbnail', verbosity)
+        self.cleanup_files(Rendition, 'file', 'photos/rendition', verbosity,
+                           extra_fields=['file_webp'])
+        self.cleanup_files(UploadSession, 'file', 'photos/uploadsession', verbosity)
+        self.cleanup_upright_copies(verbosity)
         self.stdout.write('Successfully cleaned up.')
 
-    def cleanup_files(self, model_class, field, dirname, verbosity):
+    def cleanup_renditions(self):
+        """
+        Fixes the reference counts of renditions, which can drift when a
+        process dies between rendering and saving a thumbnail, and deletes the
+        renditions that no thumbnail refers to anymore.
+        """
+        renditions = Rendition.objects.annotate(count=Count('thumbnail'))
+        deleted = 0
+        for rendition in renditions:
+            if rendition.count == 0:
+                rendition.delete()
+                deleted += 1
+            elif rendition.count != rendition.reference_count:
+                Rendition.objects.filter(pk=rendition.pk).update(
+                    reference_count=rendition.count)
+        self.stdout.write('Deleted {} unused renditions.'.format(deleted))
+
+    def cleanup_upload_sessions(self):
+        """
+        Deletes the chunked uploads that were abandoned, along with their
+        partial files.
+        """
+        deleted = 0
+        for session in UploadSession.objects.stale():
+            session.delete()
+            deleted += 1
+        self.stdout.write('Deleted {} stale upload sessions.'.format(deleted))
+
+    def cleanup_upright_copies(self, verbosity):
+        """
+        Deletes the copies of rotated originals (see get_upright_original)
+        that no photo is turned like anymore. They are named after the
+        checksum and orientation they were made for.
+        """
+        storage = Photo._meta.get_field('file').storage
+        used = set('{}-{}'.format(*photo)
+                   for photo in Photo.objects.values_list('checksum', 'orientation'))
+        files_to_delete = [
+            filename for filename in self.get_storage_files(storage, UPRIGHT_DIR)
+            if filename.split('/')[-1].rsplit('.', 1)[0] not in used]
+        self.stdout.write('Deleting {} upright copies...'.format(len(files_to_delete)))
+        self.delete_files(storage, files_to_delete, verbosity)
+
+    def cleanup_files(self, model_class, field, dirname, verbosity, extra_fields=()):
         """
         Removes all files on the file storage that do not exist in the given
         model_class and field anymore. This assumes that the only things in the
-        given dirname are files that belong to the given model_class and field.
-        If that assumption is not correct then do not use this method or you
-        will permanently lose data!
+        given dirname are files that belong to the given model_class and field
+        (or one of the extra_fields, which use the same storage). If that
+        assumption is not correct then do not use this method or you will
+        permanently lose data!
         """
         storage = model_class._meta.get_field(field).storage
-        model_files = self.get_model_files(model_class, field)
+        model_files = set(self.get_model_files(model_class, field))
+        for extra_field in extra_fields:
+            model_files.update(self.get_model_files(model_class, extra_field))
         storage_files = self.get_storage_files(storage, dirname)
         files_to_delete = set(storage_files) - set(model_files)
         data = {
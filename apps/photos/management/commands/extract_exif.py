@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+
+from apps.photos.models import Photo
+from apps.photos.utils import get_exif_data
+
+
+class Command(BaseCommand):
+    help = 'Reads the EXIF metadata and dimensions of photos that were ' \
+           'added before they were stored, in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch', type=int, default=500,
+            help='Number of photos to read from the database at a time.')
+        parser.add_argument(
+            '--all', action='store_true', default=False,
+            help='Read every photo again, not only the ones without metadata.')
+
+    def handle(self, *args, **options):
+        """
+        Walk through the photos in primary key order and store the metadata of
+        each one with a single update.
+        """
+        verbosity = int(options['verbosity'])
+        queryset = Photo.objects.order_by('pk').only('pk', 'file')
+        if not options['all']:
+            queryset = queryset.filter(width__isnull=True)
+
+        last_pk = 0
+        updated = failed = 0
+        while True:
+            photos = list(queryset.filter(pk__gt=last_pk)[:options['batch']])
+            if not photos:
+                break
+            for photo in photos:
+                data = get_exif_data(photo.file)
+                photo.file.close()
+                if not data:
+                    failed += 1
+                    self.stderr.write('Could not read photo {}.'.format(photo.pk))
+                    continue
+                # The existing thumbnails were rendered without the EXIF
+                # orientation, rotate these photos by hand instead.
+                del data['orientation']
+                Photo.objects.filter(pk=photo.pk).update(**data)
+                updated += 1
+            last_pk = photos[-1].pk
+            if verbosity > 1:
+                self.stdout.write('Read {} photos so far.'.format(updated))
+
+        self.stdout.write('Read the metadata of {} photos ({} failed).'.format(updated, failed))
@@ -0,0 +1,95 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.photos.models import Photo
+from apps.photos.utils import (
+    DEGENERATE_DHASHES, DHASH_CHUNKS, get_chunk_variants, get_dhash, hamming_distance,
+    split_dhash)
+
+
+class Command(BaseCommand):
+    help = 'Lists the groups of photos that look the same. The hashes of ' \
+           'photos that do not have one yet are computed first.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--distance', type=int, default=settings.DUPLICATE_DISTANCE,
+            help='Number of bits in which the hashes of duplicates may differ.')
+        parser.add_argument(
+            '--batch', type=int, default=500,
+            help='Number of photos to read from the database at a time.')
+
+    def handle(self, *args, **options):
+        self.hash_photos(options['batch'])
+        clusters = self.get_clusters(options['distance'])
+        photos = Photo.objects.select_related('album').in_bulk(
+            [pk for cluster in clusters for pk in cluster])
+        for cluster in clusters:
+            self.stdout.write('{} photos:'.format(len(cluster)))
+            for pk in cluster:
+                photo = photos[pk]
+                self.stdout.write('    {} / {} ({})'.format(photo.album.name, photo.name, pk))
+        self.stdout.write('Found {} groups of duplicates.'.format(len(clusters)))
+
+    def hash_photos(self, batch):
+        """
+        Compute the hashes of the photos that were added before there were
+        any, in primary key order.
+        """
+        queryset = Photo.objects.filter(dhash_0__isnull=True).order_by('pk')
+        queryset = queryset.only('pk', 'file', 'orientation')
+        last_pk = 0
+        while True:
+            photos = list(queryset.filter(pk__gt=last_pk)[:batch])
+            if not photos:
+                break
+            for photo in photos:
+                photo.dhash = get_dhash(photo.file, photo.orientation)
+                photo.file.close()
+                if photo.dhash is None:
+                    self.stderr.write('Could not read photo {}.'.format(photo.pk))
+                    continue
+                Photo.objects.filter(pk=photo.pk).update(**dict(
+                    ('dhash_{}'.format(i), chunk) for i, chunk in enumerate(split_dhash(photo.dhash))))
+            last_pk = photos[-1].pk
+
+    def get_clusters(self, distance):
+        """
+        Return the groups (lists of pks, in order) of photos that are within
+        the given distance of each other, directly or through other photos.
+
+        The hashes are indexed by chunk in memory, so each photo is only
+        compared with the photos that share a close enough chunk with it.
+        Flat images (see DEGENERATE_DHASHES) are left out.
+        """
+        hashes = {}
+        index = [defaultdict(list) for i in range(DHASH_CHUNKS)]
+        for photo in Photo.objects.filter(dhash_0__isnull=False).order_by('pk').only(
+                'pk', 'dhash_0', 'dhash_1', 'dhash_2', 'dhash_3'):
+            if photo.dhash in DEGENERATE_DHASHES:
+                continue
+            hashes[photo.pk] = photo.dhash
+            for i, chunk in enumerate(split_dhash(photo.dhash)):
+                index[i][chunk].append(photo.pk)
+
+        # Union-find over the photos that are close to each other
+        parents = {}
+
+        def find(pk):
+            while parents.get(pk, pk) != pk:
+                pk = parents[pk]
+            return pk
+
+        for pk, dhash in hashes.items():
+            for i, chunk in enumerate(split_dhash(dhash)):
+                for variant in get_chunk_variants(chunk, distance):
+                    for other in index[i].get(variant, ()):
+                        if other > pk and hamming_distance(dhash, hashes[other]) <= distance:
+                            parents[find(other)] = find(pk)
+
+        clusters = defaultdict(list)
+        for pk in sorted(hashes):
+            clusters[find(pk)].append(pk)
+        return [cluster for root, cluster in sorted(clusters.items()) if len(cluster) > 1]
@@ -0,0 +1,173 @@
+from multiprocessing import Pool
+import os
+import time
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.photos.models import Photo, Rendition, Thumbnail, bulk_get_or_create, render_renditions
+from apps.photos.utils import ImageHandler
+from utils.uploads import get_file_checksum
+
+
+def render_photo(task):
+    """
+    Render the given sizes for a single photo and save them to storage as
+    renditions. This runs in a worker process and only touches storage, never
+    the database. Returns (photo_pk, checksum, {size: {format: filename}},
+    error).
+    """
+    pk, filename, checksum, orientation, sizes, version = task
+    try:
+        original = Photo(pk=pk, file=filename).file
+        checksum = checksum or get_file_checksum(original)
+        files = render_renditions(original, checksum, sizes, version, orientation)
+    except Exception as e:
+        return pk, checksum, {}, str(e)
+    return pk, checksum, files, None
+
+
+class Command(BaseCommand):
+    help = 'Pre-renders thumbnails for every photo that is missing them, ' \
+           'using a pool of worker processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', nargs='+', default=list(settings.THUMBNAIL_SIZES),
+            help='Thumbnail sizes to render, such as 200x200-fit.')
+        parser.add_argument(
+            '--processes', type=int, default=settings.THUMBNAIL_WORKERS,
+            help='Number of worker processes (THUMBNAIL_WORKERS by default). '
+                 'Use 0 to render in this process.')
+        parser.add_argument(
+            '--batch', type=int, default=500,
+            help='Number of photos to read from the database at a time.')
+        parser.add_argument(
+            '--checkpoint',
+            help='File that records progress. An interrupted run that is '
+                 'given the same file resumes where it left off, or at the '
+                 'first photo that failed.')
+
+    def handle(self, *args, **options):
+        """
+        Walk through the photos in primary key order, render the missing
+        sizes in the pool and save the progress after each batch. The
+        progress never goes past a photo that failed, so a resumed run tries
+        it again (the photos after it that were rendered are skipped, as they
+        have their thumbnails).
+        """
+        verbosity = int(options['verbosity'])
+        self.sizes = options['sizes']
+        self.version = settings.THUMBNAIL_VERSION
+        for size in self.sizes:
+            try:
+                ImageHandler.parse_size(size)
+            except AssertionError as e:
+                raise CommandError(e)
+        last_pk = self.read_checkpoint(options['checkpoint'])
+
+        pool = None
+        imap = map
+        if options['processes'] > 0:
+            pool = Pool(options['processes'], initializer=django.setup)
+            imap = pool.imap
+
+        start = time.time()
+        rendered = failed = 0
+        first_failed = None
+        try:
+            while True:
+                photos = list(Photo.objects.filter(pk__gt=last_pk).order_by('pk')
+                              .values_list('pk', 'file', 'checksum', 'orientation')
+                              [:options['batch']])
+                if not photos:
+                    break
+                orientations = dict((photo[0], photo[3]) for photo in photos)
+                tasks, thumbnails = self.get_tasks(photos)
+                for pk, checksum, files, error in imap(render_photo, tasks):
+                    if error:
+                        failed += 1
+                        if first_failed is None:
+                            first_failed = pk
+                        self.stderr.write('Failed photo {}: {}'.format(pk, error))
+                        continue
+                    rendered += 1
+                    Photo.objects.filter(pk=pk).update(checksum=checksum)
+                    for size, names in files.items():
+                        rendition = Rendition.objects.add(
+                            checksum, size, self.version, names, orientations[pk])
+                        thumbnails.append(self.get_thumbnail(pk, rendition))
+                bulk_get_or_create(Thumbnail, thumbnails)
+                last_pk = photos[-1][0]
+                if first_failed is None:
+                    self.write_checkpoint(options['checkpoint'], last_pk)
+                else:
+                    self.write_checkpoint(options['checkpoint'], first_failed - 1)
+                if verbosity > 1:
+                    self.stdout.write(self.get_progress(rendered, start))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        self.stdout.write('Rendered {} photos ({} failed). {}'.format(
+            rendered, failed, self.get_progress(rendered, start)))
+
+    def get_tasks(self, photos):
+        """
+        Return a render task for each of the given photos that is missing at
+        least one of the sizes, along with the thumbnails that can share an
+        existing rendition right away and do not need rendering.
+        """
+        existing = set(Thumbnail.objects.filter(
+            photo__in=[photo[0] for photo in photos], size__in=self.sizes
+        ).values_list('photo_id', 'size'))
+        tasks, thumbnails = [], []
+        for pk, filename, checksum, orientation in photos:
+            missing = [size for size in self.sizes if (pk, size) not in existing]
+            if missing and checksum:
+                renditions = Rendition.objects.acquire_existing(
+                    checksum, missing, self.version, orientation)
+                for size, rendition in renditions.items():
+                    thumbnails.append(self.get_thumbnail(pk, rendition))
+                    missing.remove(size)
+            if missing:
+                tasks.append((pk, filename, checksum, orientation, missing, self.version))
+        return tasks, thumbnails
+
+    def get_thumbnail(self, pk, rendition):
+        """
+        Return an unsaved thumbnail of the given photo for the rendition.
+        """
+        thumbnail = Thumbnail(photo_id=pk, size=rendition.size)
+        thumbnail.set_rendition(rendition)
+        return thumbnail
+
+    def get_progress(self, rendered, start):
+        """
+        Return a message with the throughput so far.
+        """
+        elapsed = max(time.time() - start, 0.001)
+        return '{:.1f} photos/s'.format(rendered / elapsed)
+
+    def read_checkpoint(self, filename):
+        """
+        Return the last photo pk recorded in the checkpoint file, or 0.
+        """
+        if not filename or not os.path.exists(filename):
+            return 0
+        with open(filename) as handle:
+            return int(handle.read().strip() or 0)
+
+    def write_checkpoint(self, filename, pk):
+        """
+        Record the last processed photo pk. The file is replaced atomically so
+        an interruption never leaves it half written.
+        """
+        if not filename:
+            return
+        temp = '{}.tmp'.format(filename)
+        with open(temp, 'w') as handle:
+            handle.write(str(pk))
+        os.replace(temp, filename)
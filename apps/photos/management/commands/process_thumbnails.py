@@ -0,0 +1,87 @@
+from itertools import groupby
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.photos.models import ThumbnailJob
+
+
+class Command(BaseCommand):
+    help = 'Generates the thumbnails that were queued by Photo.thumbnail. ' \
+           'Runs forever unless --once is given.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', action='store_true', default=False,
+            help='Exit once the queue is empty instead of waiting for more.')
+        parser.add_argument(
+            '--sleep', type=float, default=2.0,
+            help='Seconds to wait between polls when the queue is empty.')
+        parser.add_argument(
+            '--batch', type=int, default=20,
+            help='Number of jobs to fetch per poll.')
+        parser.add_argument(
+            '--max-attempts', type=int, default=3,
+            help='Give up on a job after it failed this many times.')
+        parser.add_argument(
+            '--stale-after', type=int, default=600,
+            help='Seconds after which a started job is considered abandoned.')
+
+    def handle(self, *args, **options):
+        """
+        Poll the queue and work through the pending jobs in batches.
+        """
+        verbosity = int(options['verbosity'])
+        processed = 0
+        while True:
+            jobs = self.get_jobs(options)
+            jobs.sort(key=lambda job: job.photo_id)
+            for photo_id, photo_jobs in groupby(jobs, lambda job: job.photo_id):
+                processed += self.process_jobs(list(photo_jobs), options, verbosity)
+            if not jobs:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+        self.stdout.write('Processed {} thumbnail jobs.'.format(processed))
+
+    def get_jobs(self, options):
+        """
+        Return the next batch of pending jobs, oldest first.
+        """
+        queryset = ThumbnailJob.objects.pending(
+            options['max_attempts'], options['stale_after'])
+        return list(queryset.select_related('photo')[:options['batch']])
+
+    def process_jobs(self, jobs, options, verbosity):
+        """
+        Claim the given jobs (which all belong to the same photo) and render
+        all of their sizes from a single decode of the original. If that
+        fails, run them one at a time so a single bad size does not hold back
+        the others. Return the number of thumbnails generated.
+        """
+        jobs = [job for job in jobs if job.claim(options['stale_after'])]
+        if not jobs:
+            return 0
+        try:
+            jobs[0].photo.generate_thumbnails([job.size for job in jobs])
+        except Exception:
+            return sum(self.process_job(job, verbosity) for job in jobs)
+        ThumbnailJob.objects.filter(pk__in=[job.pk for job in jobs]).delete()
+        if verbosity > 1:
+            for job in jobs:
+                self.stdout.write(str(job))
+        return len(jobs)
+
+    def process_job(self, job, verbosity):
+        """
+        Run a single claimed job. Return 1 if the thumbnail was generated and
+        0 if the job failed.
+        """
+        try:
+            job.run()
+        except Exception as e:
+            self.stderr.write('Failed {}: {}'.format(job, e))
+            return 0
+        if verbosity > 1:
+            self.stdout.write(str(job))
+        return 1
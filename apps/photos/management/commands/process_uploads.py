@@ -0,0 +1,54 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.photos.models import UploadSession
+from apps.photos.uploads import import_session
+
+
+class Command(BaseCommand):
+    help = 'Imports the chunked uploads that were finalized while ' \
+           'CHUNKED_UPLOAD_QUEUE is on. Runs forever unless --once is given.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', action='store_true', default=False,
+            help='Exit once the queue is empty instead of waiting for more.')
+        parser.add_argument(
+            '--sleep', type=float, default=2.0,
+            help='Seconds to wait between polls when the queue is empty.')
+
+    def handle(self, *args, **options):
+        """
+        Poll the queue and import the sessions in it, oldest first.
+        """
+        verbosity = int(options['verbosity'])
+        processed = 0
+        while True:
+            sessions = list(UploadSession.objects.filter(state=UploadSession.QUEUED))
+            for session in sessions:
+                processed += self.process_session(session, verbosity)
+            if not sessions:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+        self.stdout.write('Imported {} uploads.'.format(processed))
+
+    def process_session(self, session, verbosity):
+        """
+        Claim the given session and import it. Return 1 if it was imported
+        and 0 if it failed (or another worker claimed it first).
+        """
+        if not session.claim():
+            return 0
+        try:
+            album = import_session(session)
+        except Exception as e:
+            self.stderr.write('Failed {}: {}'.format(session, e))
+            return 0
+        if album is None:
+            self.stderr.write('Failed {}: {}'.format(session, session.error))
+            return 0
+        if verbosity > 1:
+            self.stdout.write(str(session))
+        return 1
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from apps.photos import search
+from apps.photos.models import Photo
+
+
+class Command(BaseCommand):
+    help = 'Indexes every photo again for full-text search, for when the ' \
+           'index missed changes (such as bulk updates).'
+
+    def handle(self, *args, **options):
+        if not search.is_available():
+            self.stdout.write('There is no search index in this database, '
+                              'search uses LIKE queries instead.')
+            return
+        search.rebuild()
+        self.stdout.write('Indexed {} photos.'.format(Photo.objects.count()))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from apps.photos import counters
+from apps.photos.models import Album, Location, Person
+
+
+class Command(BaseCommand):
+    help = 'Counts the photos and albums of every album, person and location ' \
+           'again and picks their covers, for when the counters missed ' \
+           'changes (such as bulk updates).'
+
+    def handle(self, *args, **options):
+        updated = counters.reconcile()
+        self.stdout.write('Updated {} albums, {} people and {} locations.'.format(
+            updated[Album], updated[Person], updated[Location]))
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThumbnailJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('size', models.CharField(verbose_name='size', max_length=20)),
+                ('created', models.DateTimeField(verbose_name='created', db_index=True, default=django.utils.timezone.now)),
+                ('started', models.DateTimeField(verbose_name='started', blank=True, null=True)),
+                ('attempts', models.PositiveSmallIntegerField(verbose_name='attempts', default=0)),
+                ('error', models.TextField(verbose_name='error', blank=True)),
+                ('photo', models.ForeignKey(verbose_name='photo', to='photos.Photo')),
+            ],
+            options={
+                'verbose_name': 'thumbnail job',
+                'verbose_name_plural': 'thumbnail jobs',
+                'ordering': ['created'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='thumbnailjob',
+            unique_together=set([('photo', 'size')]),
+        ),
+    ]
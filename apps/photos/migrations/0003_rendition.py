@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import apps.photos.models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0002_thumbnailjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Rendition',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('checksum', models.CharField(verbose_name='checksum', max_length=40)),
+                ('size', models.CharField(verbose_name='size', max_length=20)),
+                ('version', models.PositiveSmallIntegerField(verbose_name='version')),
+                ('file', models.ImageField(verbose_name='file', upload_to=apps.photos.models.get_rendition_path)),
+                ('reference_count', models.PositiveIntegerField(verbose_name='reference count', default=0)),
+            ],
+            options={
+                'verbose_name': 'rendition',
+                'verbose_name_plural': 'renditions',
+                'ordering': ['checksum', 'size'],
+            },
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='checksum',
+            field=models.CharField(verbose_name='checksum', max_length=40, blank=True, db_index=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='rendition',
+            unique_together=set([('checksum', 'size', 'version')]),
+        ),
+        migrations.AddField(
+            model_name='thumbnail',
+            name='rendition',
+            field=models.ForeignKey(verbose_name='rendition', blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='photos.Rendition'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import apps.photos.models
+import utils.uploads
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0003_rendition'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rendition',
+            name='file_webp',
+            field=models.ImageField(verbose_name='WebP file', blank=True, null=True, upload_to=apps.photos.models.get_rendition_path),
+        ),
+        migrations.AddField(
+            model_name='thumbnail',
+            name='file_webp',
+            field=models.ImageField(verbose_name='WebP file', blank=True, null=True, upload_to=utils.uploads.get_unique_upload_path),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0004_thumbnail_webp'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='orientation',
+            field=models.PositiveSmallIntegerField(verbose_name='orientation', default=1, choices=[(1, 'Normal'), (2, 'Mirror horizontal'), (3, 'Rotate 180'), (4, 'Mirror vertical'), (5, 'Mirror horizontal and rotate 270 CW'), (6, 'Rotate 90 CW'), (7, 'Mirror horizontal and rotate 90 CW'), (8, 'Rotate 270 CW')]),
+        ),
+        migrations.AddField(
+            model_name='rendition',
+            name='orientation',
+            field=models.PositiveSmallIntegerField(verbose_name='orientation', default=1, choices=[(1, 'Normal'), (2, 'Mirror horizontal'), (3, 'Rotate 180'), (4, 'Mirror vertical'), (5, 'Mirror horizontal and rotate 270 CW'), (6, 'Rotate 90 CW'), (7, 'Mirror horizontal and rotate 90 CW'), (8, 'Rotate 270 CW')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='rendition',
+            unique_together=set([('checksum', 'size', 'version', 'orientation')]),
+        ),
+    ]
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0005_orientation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='exif_datetime',
+            field=models.DateTimeField(verbose_name='taken', blank=True, null=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='exif_exposure',
+            field=models.CharField(verbose_name='exposure', max_length=100, blank=True),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='exif_fnumber',
+            field=models.FloatField(verbose_name='f-number', blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='exif_focal',
+            field=models.FloatField(verbose_name='focal length', blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='exif_iso',
+            field=models.PositiveIntegerField(verbose_name='ISO', blank=True, null=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='exif_lens',
+            field=models.CharField(verbose_name='lens', max_length=100, blank=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='exif_make',
+            field=models.CharField(verbose_name='camera make', max_length=100, blank=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='exif_model',
+            field=models.CharField(verbose_name='camera model', max_length=100, blank=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='height',
+            field=models.PositiveIntegerField(verbose_name='height', blank=True, null=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='width',
+            field=models.PositiveIntegerField(verbose_name='width', blank=True, null=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0006_photo_exif'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='dhash_0',
+            field=models.PositiveIntegerField(blank=True, null=True, db_index=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='dhash_1',
+            field=models.PositiveIntegerField(blank=True, null=True, db_index=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='dhash_2',
+            field=models.PositiveIntegerField(blank=True, null=True, db_index=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='dhash_3',
+            field=models.PositiveIntegerField(blank=True, null=True, db_index=True, editable=False),
+        ),
+    ]
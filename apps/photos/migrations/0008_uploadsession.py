@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import apps.photos.models
+import django.utils.timezone
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('photos', '0007_photo_dhash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadChunk',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('index', models.PositiveIntegerField(verbose_name='index')),
+            ],
+            options={
+                'verbose_name': 'upload chunk',
+                'verbose_name_plural': 'upload chunks',
+                'ordering': ['session', 'index'],
+            },
+        ),
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('token', models.CharField(verbose_name='token', max_length=32, unique=True, default=apps.photos.models.get_upload_token)),
+                ('filename', models.CharField(verbose_name='filename', max_length=200)),
+                ('size', models.BigIntegerField(verbose_name='size')),
+                ('chunk_size', models.PositiveIntegerField(verbose_name='chunk size')),
+                ('skip_duplicates', models.BooleanField(verbose_name='skip duplicates', default=True)),
+                ('file', models.FileField(verbose_name='file', blank=True, upload_to=apps.photos.models.get_upload_session_path)),
+                ('created', models.DateTimeField(verbose_name='created', default=django.utils.timezone.now)),
+                ('updated', models.DateTimeField(verbose_name='updated', db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name': 'upload session',
+                'verbose_name_plural': 'upload sessions',
+                'ordering': ['created'],
+            },
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='album',
+            field=models.ForeignKey(verbose_name='album', to='photos.Album'),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='user',
+            field=models.ForeignKey(verbose_name='user', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='uploadchunk',
+            name='session',
+            field=models.ForeignKey(verbose_name='upload session', to='photos.UploadSession'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='uploadchunk',
+            unique_together=set([('session', 'index')]),
+        ),
+    ]
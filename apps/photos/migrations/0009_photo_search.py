@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.utils import OperationalError
+
+
+def create_search_index(apps, schema_editor):
+    """
+    Create the full-text index of the photos (see apps.photos.search) and fill
+    it. This only happens on SQLite with FTS5, search falls back to LIKE
+    queries everywhere else.
+    """
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    try:
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE photos_photo_fts "
+            "USING fts5(name, album, people, location, prefix='2 3')")
+    except OperationalError:
+        return
+    # Rank matches on the name of the photo above the others
+    schema_editor.execute(
+        "INSERT INTO photos_photo_fts (photos_photo_fts, rank) "
+        "VALUES ('rank', 'bm25(4.0, 2.0, 1.0, 1.0)')")
+    schema_editor.execute(
+        "INSERT INTO photos_photo_fts (rowid, name, album, people, location) "
+        "SELECT photo.id, photo.name, COALESCE(album.name, ''), "
+        "COALESCE((SELECT group_concat(person.name, ' ') FROM photos_photo_people tag "
+        "JOIN photos_person person ON person.id = tag.person_id "
+        "WHERE tag.photo_id = photo.id), ''), COALESCE(location.name, '') "
+        "FROM photos_photo photo "
+        "LEFT JOIN photos_album album ON album.id = photo.album_id "
+        "LEFT JOIN photos_location location ON location.id = album.location_id")
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS photos_photo_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0008_uploadsession'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
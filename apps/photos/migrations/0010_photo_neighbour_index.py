@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0009_photo_search'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='photo',
+            index_together=set([('album', 'name', 'id'), ('name', 'id')]),
+        ),
+    ]
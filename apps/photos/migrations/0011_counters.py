@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+def fill_counters(apps, schema_editor):
+    """
+    Count the photos and albums, and pick the covers, of the existing albums,
+    people and locations (see apps.photos.counters).
+    """
+    schema_editor.execute(
+        "UPDATE photos_album SET "
+        "photo_count = (SELECT COUNT(*) FROM photos_photo WHERE album_id = photos_album.id), "
+        "cover_photo_id = (SELECT id FROM photos_photo WHERE album_id = photos_album.id "
+        "ORDER BY name, id LIMIT 1)")
+    schema_editor.execute(
+        "UPDATE photos_person SET "
+        "photo_count = (SELECT COUNT(*) FROM photos_photo_people WHERE person_id = photos_person.id), "
+        "cover_photo_id = (SELECT photo.id FROM photos_photo photo "
+        "INNER JOIN photos_photo_people tag ON tag.photo_id = photo.id "
+        "WHERE tag.person_id = photos_person.id ORDER BY photo.name, photo.id LIMIT 1)")
+    schema_editor.execute(
+        "UPDATE photos_location SET "
+        "album_count = (SELECT COUNT(*) FROM photos_album WHERE location_id = photos_location.id), "
+        "cover_photo_id = (SELECT cover_photo_id FROM photos_album "
+        "WHERE location_id = photos_location.id AND cover_photo_id IS NOT NULL "
+        "ORDER BY name, id LIMIT 1)")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0010_photo_neighbour_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='album',
+            name='cover_photo',
+            field=models.ForeignKey(verbose_name='cover photo', blank=True, null=True, editable=False, related_name='+', on_delete=django.db.models.deletion.SET_NULL, to='photos.Photo'),
+        ),
+        migrations.AddField(
+            model_name='album',
+            name='photo_count',
+            field=models.PositiveIntegerField(verbose_name='photos', default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='location',
+            name='album_count',
+            field=models.PositiveIntegerField(verbose_name='albums', default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='location',
+            name='cover_photo',
+            field=models.ForeignKey(verbose_name='cover photo', blank=True, null=True, editable=False, related_name='+', on_delete=django.db.models.deletion.SET_NULL, to='photos.Photo'),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='cover_photo',
+            field=models.ForeignKey(verbose_name='cover photo', blank=True, null=True, editable=False, related_name='+', on_delete=django.db.models.deletion.SET_NULL, to='photos.Photo'),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='photo_count',
+            field=models.PositiveIntegerField(verbose_name='photos', default=0, editable=False),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
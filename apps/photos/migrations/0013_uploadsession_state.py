@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0012_uploadsession_skip_duplicates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadsession',
+            name='error',
+            field=models.TextField(verbose_name='error', blank=True),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='result',
+            field=models.TextField(verbose_name='result', blank=True),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='state',
+            field=models.CharField(verbose_name='state', max_length=20, db_index=True, default='uploading', choices=[('uploading', 'Uploading'), ('queued', 'Queued'), ('importing', 'Importing'), ('done', 'Done'), ('failed', 'Failed')]),
+        ),
+    ]
@@ -1,23 +1,59 @@
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import uuid
 
-from django.db import models
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.urlresolvers import reverse
+from django.db import IntegrityError, models, transaction
+from django.db.models import F, Q
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django.utils.dates import MONTHS
 
-from utils.uploads import get_unique_upload_path
-from apps.photos.utils import generate_thumbnail
+from utils.cache import LRUCache
+from utils.uploads import get_file_checksum, get_unique_upload_path, split_extension
+from apps.photos.utils import (
+    DEGENERATE_DHASHES, DHASH_CHUNKS, THUMBNAIL_EXTENSIONS, ImageHandler, Placeholder,
+    generate_thumbnails, get_chunk_variants, get_dhash, get_exif_data, get_thumbnail_formats,
+    hamming_distance, join_dhash, sign_thumbnail_size, split_dhash)
 
 MONTH_CHOICES = [(key, value) for key, value in MONTHS.items()]
 
 YEAR_CHOICES = [(year, year) for year in
                 range(1950, (datetime.now().year + 1))]
 
+ORIENTATION_CHOICES = [
+    (1, _('Normal')),
+    (2, _('Mirror horizontal')),
+    (3, _('Rotate 180')),
+    (4, _('Mirror vertical')),
+    (5, _('Mirror horizontal and rotate 270 CW')),
+    (6, _('Rotate 90 CW')),
+    (7, _('Mirror horizontal and rotate 90 CW')),
+    (8, _('Rotate 270 CW')),
+]
+
+# Remembers (across requests) the storage names of thumbnails, keyed by photo
+# and size. See get_cached_thumbnails.
+thumbnail_cache = LRUCache(settings.THUMBNAIL_CACHE_SIZE,
+                           backend=settings.THUMBNAIL_CACHE_BACKEND,
+                           prefix='photos:thumbnail:')
+
 
 class Location(models.Model):
     """A location is a physical location that can be applied to an album."""
 
     name = models.CharField(_('name'), max_length=200)
 
+    # Kept up to date by apps.photos.counters, so lists of locations do not
+    # have to count and look for covers one location at a time
+    album_count = models.PositiveIntegerField(_('albums'), default=0, editable=False)
+    cover_photo = models.ForeignKey(
+        'Photo', null=True, blank=True, editable=False, related_name='+',
+        verbose_name=_('cover photo'), on_delete=models.SET_NULL)
+
     class Meta:
         ordering = ['name', ]
         verbose_name = _('location')
@@ -30,22 +66,18 @@ class Location(models.Model):
     def __str__(self):
         return self.name
 
-    @property
-    def cover_photo(self):
-        """
-        Returns the cover photo for this person, which for now is just the
-        first photo from the first album based on whatever ordering is the
-        default.
-        """
-        if self.album_set.count():
-            return self.album_set.first().photo_set.first()
-
 
 class Person(models.Model):
     """A person is an actual person that can be tagged in photos."""
 
     name = models.CharField(_('name'), max_length=200)
 
+    # Kept up to date by apps.photos.counters
+    photo_count = models.PositiveIntegerField(_('photos'), default=0, editable=False)
+    cover_photo = models.ForeignKey(
+        'Photo', null=True, blank=True, editable=False, related_name='+',
+        verbose_name=_('cover photo'), on_delete=models.SET_NULL)
+
     class Meta:
         ordering = ['name', ]
         verbose_name = _('person')
@@ -58,14 +90,6 @@ class Person(models.Model):
     def __str__(self):
         return self.name
 
-    @property
-    def cover_photo(self):
-        """
-        Returns the cover photo for this person, which for now is just the
-        first photo based on whatever ordering is the default.
-        """
-        return self.photo_set.first()
-
 
 class Album(models.Model):
     """
@@ -83,6 +107,12 @@ class Album(models.Model):
         Location, null=True, blank=True,
         verbose_name=_('location'), on_delete=models.SET_NULL)
 
+    # Kept up to date by apps.photos.counters
+    photo_count = models.PositiveIntegerField(_('photos'), default=0, editable=False)
+    cover_photo = models.ForeignKey(
+        'Photo', null=True, blank=True, editable=False, related_name='+',
+        verbose_name=_('cover photo'), on_delete=models.SET_NULL)
+
     class Meta:
         ordering = ['name', ]
         verbose_name = _('album')
@@ -95,14 +125,6 @@ class Album(models.Model):
     def __str__(self):
         return self.name
 
-    @property
-    def cover_photo(self):
-        """
-        Returns the cover photo for this album, which for now is just the
-        first photo based on whatever ordering is the default.
-        """
-        return self.photo_set.first()
-
     def get_date_display(self):
         """
         Returns a pretty display of the month and year in one of the formats:
@@ -115,6 +137,156 @@ class Album(models.Model):
         return '{} {}'.format(month, year).strip()
 
 
+def prefetch_thumbnails(photos, sizes, queue=None):
+    """
+    Attach the thumbnails with the given sizes to each of the given photos so
+    Photo.thumbnail does not have to query for them one at a time. Existing
+    thumbnails are loaded with a single query and the missing ones are queued
+    (or generated, if queue is False, or THUMBNAIL_QUEUE is off when queue is
+    None) in bulk.
+    """
+    if queue is None:
+        queue = settings.THUMBNAIL_QUEUE
+    photos = [photo for photo in photos if photo.pk is not None]
+    if not photos or not sizes:
+        return
+    thumbnails = get_cached_thumbnails(photos, sizes)
+    uncached = [photo for photo in photos
+                if any((photo.pk, size) not in thumbnails for size in sizes)]
+    if uncached:
+        existing = list(Thumbnail.objects.filter(photo__in=uncached, size__in=sizes))
+        photos_by_pk = dict((photo.pk, photo) for photo in uncached)
+        for thumb in existing:
+            thumb.photo = photos_by_pk[thumb.photo_id]
+        cache_thumbnails(existing)
+        thumbnails.update(((thumb.photo_id, thumb.size), thumb) for thumb in existing)
+    missing = []
+    for photo in photos:
+        for size in sizes:
+            if (photo.pk, size) not in thumbnails:
+                missing.append(Thumbnail(photo=photo, size=size))
+    if missing and queue:
+        ThumbnailJob.objects.enqueue(missing)
+        thumbnails.update(((t.photo_id, t.size), Placeholder(t.size)) for t in missing)
+    elif missing:
+        photo_sizes = []
+        for photo in photos:
+            photo_sizes.append((photo, [t.size for t in missing if t.photo_id == photo.pk]))
+        photo_sizes = [(photo, sizes) for photo, sizes in photo_sizes if sizes]
+        renditions = dict(
+            (photo.pk, acquired) for (photo, sizes), acquired in
+            zip(photo_sizes, Rendition.objects.acquire_many(photo_sizes)))
+        for thumbnail in missing:
+            thumbnail.set_rendition(renditions[thumbnail.photo_id][thumbnail.size])
+        bulk_get_or_create(Thumbnail, missing)
+        thumbnails.update(((t.photo_id, t.size), t) for t in missing)
+    for photo in photos:
+        for size in sizes:
+            setattr(photo, Photo.get_thumbnail_attr(size), thumbnails[(photo.pk, size)])
+
+
+def get_thumbnail_cache_key(photo_id, size):
+    return '{}:{}'.format(photo_id, size)
+
+
+def get_cached_thumbnails(photos, sizes):
+    """
+    Return a dictionary of (photo pk, size) -> Thumbnail with the thumbnails
+    of the given photos and sizes that are in thumbnail_cache. These are built
+    from the cache without any queries. Entries made for another original or
+    orientation (i.e. before the photo was rotated) are ignored.
+    """
+    keys = dict((get_thumbnail_cache_key(photo.pk, size), (photo, size))
+                for photo in photos for size in sizes)
+    thumbnails = {}
+    for key, (pk, source, name, webp_name) in thumbnail_cache.get_many(list(keys)).items():
+        photo, size = keys[key]
+        if source == (photo.checksum, photo.orientation):
+            thumbnails[(photo.pk, size)] = Thumbnail(
+                pk=pk, photo=photo, size=size, file=name, file_webp=webp_name)
+    return thumbnails
+
+
+def cache_thumbnails(thumbnails):
+    """
+    Remember the storage names of the given (saved) thumbnails in
+    thumbnail_cache.
+    """
+    thumbnail_cache.set_many(dict(
+        (get_thumbnail_cache_key(thumb.photo_id, thumb.size),
+         (thumb.pk, (thumb.photo.checksum, thumb.photo.orientation),
+          thumb.file.name, thumb.file_webp.name or None))
+        for thumb in thumbnails if thumb.pk is not None))
+
+
+def bulk_get_or_create(model_class, objs):
+    """
+    Insert all objs (which are unique on photo and size) in one query. If
+    another request beat us to some of them, fall back to inserting them one
+    at a time and skipping the ones that already exist.
+    """
+    try:
+        with transaction.atomic():
+            model_class.objects.bulk_create(objs)
+    except IntegrityError:
+        for obj in objs:
+            model_class.objects.get_or_create(photo=obj.photo, size=obj.size, defaults={
+                field.name: getattr(obj, field.name)
+                for field in obj._meta.concrete_fields
+                if field.name not in ('id', 'photo', 'size')})
+
+
+class PhotoQuerySet(models.QuerySet):
+    _thumbnail_sizes = ()
+
+    def with_thumbnails(self, *sizes):
+        """
+        Return a queryset that attaches the thumbnails with the given sizes to
+        every photo once it is evaluated. See prefetch_thumbnails.
+        """
+        clone = self._clone()
+        clone._thumbnail_sizes = self._thumbnail_sizes + sizes
+        return clone
+
+    def _clone(self, *args, **kwargs):
+        clone = super()._clone(*args, **kwargs)
+        clone._thumbnail_sizes = self._thumbnail_sizes
+        return clone
+
+    def _fetch_all(self):
+        fetch = self._result_cache is None
+        super()._fetch_all()
+        if fetch and self._thumbnail_sizes:
+            photos = [obj for obj in self._result_cache if isinstance(obj, Photo)]
+            prefetch_thumbnails(photos, self._thumbnail_sizes)
+
+    def near_duplicates(self, dhash, distance=None):
+        """
+        Return the photos whose dHash is within the given Hamming distance
+        (DUPLICATE_DISTANCE by default) of dhash, closest first, each with its
+        distance in a distance attribute. The candidates are looked up in the
+        indexes of the hash chunks (see get_chunk_variants) and only those are
+        compared in full. Flat images (see DEGENERATE_DHASHES) have no
+        duplicates.
+        """
+        if distance is None:
+            distance = settings.DUPLICATE_DISTANCE
+        if dhash in DEGENERATE_DHASHES:
+            return []
+        query = Q()
+        for i, chunk in enumerate(split_dhash(dhash)):
+            query |= Q(**{'dhash_{}__in'.format(i): get_chunk_variants(chunk, distance)})
+        photos = []
+        for photo in self.filter(query):
+            if photo.dhash in DEGENERATE_DHASHES:
+                continue
+            photo.distance = hamming_distance(dhash, photo.dhash)
+            if photo.distance <= distance:
+                photos.append(photo)
+        photos.sort(key=lambda photo: photo.distance)
+        return photos
+
+
 class Photo(models.Model):
     """
     A photo is just that - a single photo. It can belong to only one album.
@@ -127,15 +299,47 @@ class Photo(models.Model):
     people = models.ManyToManyField(
         Person, blank=True, verbose_name=_('people'))
 
-    # exif_make = models.CharField(max_length=100, null=True, blank=True)
-    # exif_model = models.CharField(max_length=100, null=True, blank=True)
-    # exif_iso = models.PositiveSmallIntegerField(null=True, blank=True)
-    # exif_focal = models.PositiveSmallIntegerField(null=True, blank=True)
-    # exif_exposure = models.CharField(max_length=100, null=True, blank=True)
-    # exif_fnumber = models.PositiveSmallIntegerField(null=True, blank=True)
+    # Metadata read from the original when it is added (see get_exif_data).
+    # The dimensions are those of the photo turned upright, and are empty
+    # until the original has been read.
+    exif_datetime = models.DateTimeField(
+        _('taken'), null=True, blank=True, db_index=True)
+    exif_make = models.CharField(
+        _('camera make'), max_length=100, blank=True, db_index=True)
+    exif_model = models.CharField(
+        _('camera model'), max_length=100, blank=True, db_index=True)
+    exif_lens = models.CharField(
+        _('lens'), max_length=100, blank=True, db_index=True)
+    exif_iso = models.PositiveIntegerField(
+        _('ISO'), null=True, blank=True, db_index=True)
+    exif_focal = models.FloatField(_('focal length'), null=True, blank=True)
+    exif_exposure = models.CharField(_('exposure'), max_length=100, blank=True)
+    exif_fnumber = models.FloatField(_('f-number'), null=True, blank=True)
+    width = models.PositiveIntegerField(
+        _('width'), null=True, blank=True, db_index=True)
+    height = models.PositiveIntegerField(
+        _('height'), null=True, blank=True, db_index=True)
+
+    checksum = models.CharField(
+        _('checksum'), max_length=40, blank=True, db_index=True)
+    # How the original has to be turned to be upright, like EXIF orientation.
+    # Rotating a photo only changes this, the original is never re-encoded.
+    orientation = models.PositiveSmallIntegerField(
+        _('orientation'), choices=ORIENTATION_CHOICES, default=1)
+
+    # The perceptual hash of the photo (see get_dhash), split into indexed
+    # chunks so near-duplicates can be looked up (see near_duplicates).
+    dhash_0 = models.PositiveIntegerField(null=True, blank=True, editable=False, db_index=True)
+    dhash_1 = models.PositiveIntegerField(null=True, blank=True, editable=False, db_index=True)
+    dhash_2 = models.PositiveIntegerField(null=True, blank=True, editable=False, db_index=True)
+    dhash_3 = models.PositiveIntegerField(null=True, blank=True, editable=False, db_index=True)
+
+    objects = PhotoQuerySet.as_manager()
 
     class Meta:
         ordering = ['name', ]
+        # For the previous and next photos (see photos.views.photo.Detail)
+        index_together = [('album', 'name', 'id'), ('name', 'id')]
         verbose_name = _('photo')
         verbose_name_plural = _('photos')
 
@@ -146,16 +350,159 @@ class Photo(models.Model):
     def __str__(self):
         return self.name
 
-    def thumbnail(self, size):
+    def save(self, **kwargs):
+        """
+        Read the metadata (and the orientation) of a new photo from the
+        original, so it never has to be opened for them again.
+        """
+        if self._state.adding and self.width is None and self.file:
+            self.set_exif(get_exif_data(self.file))
+        if self._state.adding and self.dhash is None and self.file:
+            self.dhash = get_dhash(self.file, self.orientation)
+        super().save(**kwargs)
+
+    @property
+    def dhash(self):
+        """
+        The perceptual hash of the photo, or None if it was not computed.
+        """
+        chunks = [getattr(self, 'dhash_{}'.format(i)) for i in range(DHASH_CHUNKS)]
+        if None in chunks:
+            return None
+        return join_dhash(chunks)
+
+    @dhash.setter
+    def dhash(self, value):
+        chunks = split_dhash(value) if value is not None else [None] * DHASH_CHUNKS
+        for i, chunk in enumerate(chunks):
+            setattr(self, 'dhash_{}'.format(i), chunk)
+
+    def get_near_duplicates(self, distance=None):
+        """
+        Return the other photos that look the same as this one (see
+        PhotoQuerySet.near_duplicates).
         """
-        Generate and return a thumbnail with the given size. Only do this once
+        if self.dhash is None:
+            return []
+        return Photo.objects.exclude(pk=self.pk).near_duplicates(self.dhash, distance)
+
+    def set_exif(self, data):
+        """
+        Set the fields from the given get_exif_data dictionary. An orientation
+        that was already set (i.e. a rotated photo) is kept.
+        """
+        for field, value in data.items():
+            if field != 'orientation' or self.orientation == 1:
+                setattr(self, field, value)
+
+    def get_checksum(self):
+        """
+        Return the SHA-1 checksum of the original file, calculating (and
+        storing) it the first time it is needed.
+        """
+        if not self.checksum:
+            self.checksum = get_file_checksum(self.file)
+            if self.pk:
+                Photo.objects.filter(pk=self.pk).update(checksum=self.checksum)
+        return self.checksum
+
+    def thumbnail(self, size, webp=False):
+        """
+        Return the thumbnail file with the given size, or the WebP version of
+        it if webp is True and there is one. Only look the thumbnail up once
         in this instance to save on hits to the Thumnail model.
+
+        When THUMBNAIL_QUEUE is enabled a missing thumbnail is not generated
+        here. Instead a ThumbnailJob is queued for the process_thumbnails
+        command and a Placeholder is returned right away.
         """
-        prop_name = '_thumb_%s' % size.replace('-', '_')
-        instance, created = self.thumbnail_set.get_or_create(size=size)
+        prop_name = self.get_thumbnail_attr(size)
         if not hasattr(self, prop_name):
-            setattr(self, prop_name, instance.file)
-        return getattr(self, prop_name)
+            setattr(self, prop_name, self._get_thumbnail(size))
+        thumbnail = getattr(self, prop_name)
+        if isinstance(thumbnail, Placeholder):
+            return thumbnail
+        if webp and thumbnail.file_webp:
+            return thumbnail.file_webp
+        return thumbnail.file
+
+    def thumbnails(self, sizes, webp=False):
+        """
+        Return a dictionary of size -> thumbnail file (see thumbnail) for all
+        of the given sizes. The ones this instance has not looked up yet are
+        looked up, and generated or queued, all at once.
+        """
+        missing = [size for size in sizes if not hasattr(self, self.get_thumbnail_attr(size))]
+        if missing:
+            prefetch_thumbnails([self], missing)
+        return dict((size, self.thumbnail(size, webp=webp)) for size in sizes)
+
+    @staticmethod
+    def get_thumbnail_attr(size):
+        """
+        Return the name of the attribute the thumbnail with the given size is
+        remembered in.
+        """
+        return '_thumb_%s' % size.replace('-', '_')
+
+    def get_thumbnail_url(self, size):
+        """
+        Return the signed url of the on-demand thumbnail view for the given
+        size. This needs no database queries. The url carries the thumbnail
+        version, part of the checksum of the original and the orientation, so
+        it changes when the photo is rotated or thumbnails are rendered
+        differently.
+        """
+        url = reverse('photo_thumbnail', kwargs={
+            'pk': self.pk, 'size': size, 'signature': sign_thumbnail_size(size)})
+        return '{}?v={}.{}.{}'.format(
+            url, settings.THUMBNAIL_VERSION, self.checksum[:8], self.orientation)
+
+    def find_thumbnail(self, size):
+        """
+        Return the thumbnail with the given size from thumbnail_cache or the
+        database, or None if it does not exist yet.
+        """
+        instance = get_cached_thumbnails([self], [size]).get((self.pk, size))
+        if instance is None:
+            instance = self.thumbnail_set.filter(size=size).first()
+            if instance is not None:
+                cache_thumbnails([instance])
+        return instance
+
+    def _get_thumbnail(self, size):
+        """
+        Look up (or generate, or queue) the thumbnail with the given size.
+        """
+        instance = self.find_thumbnail(size)
+        if instance is not None:
+            return instance
+        if not settings.THUMBNAIL_QUEUE:
+            instance, created = self.thumbnail_set.get_or_create(size=size)
+            return instance
+        ThumbnailJob.objects.get_or_create(photo=self, size=size)
+        return Placeholder(size)
+
+    def generate_thumbnails(self, sizes):
+        """
+        Generate all the thumbnails with the given sizes that do not exist yet
+        with a single decode of the original. Sizes that were already rendered
+        for an identical original are shared instead of rendered again.
+        Return the new thumbnails.
+        """
+        existing = set(self.thumbnail_set.filter(size__in=sizes)
+                       .values_list('size', flat=True))
+        missing = [size for size in sizes if size not in existing]
+        if not missing:
+            return []
+        renditions = Rendition.objects.acquire(self, missing)
+        thumbnails = []
+        for size in missing:
+            thumbnail = Thumbnail(photo=self, size=size)
+            thumbnail.set_rendition(renditions[size])
+            thumbnails.append(thumbnail)
+        bulk_get_or_create(Thumbnail, thumbnails)
+        return thumbnails
 
     @property
     def file_thumb(self):
@@ -172,6 +519,258 @@ class Photo(models.Model):
         return self.thumbnail('1024x768-thumb')
 
 
+def get_rendition_path(instance, filename):
+    """
+    Gets the upload path for a rendition. Renditions are named after what they
+    were made from, so the same original, size, version and orientation always
+    map to the same file. An example path looks like this:
+        photos/rendition/2fd4e1c67a2d28fced849ee1bb76e7391b93eb12-200x200-fit-v1.jpg
+    Renditions of originals that were turned upright have the orientation in
+    their name, such as ...-200x200-fit-o6-v1.jpg.
+    """
+    filename, ext = split_extension(filename)
+    size = instance.size
+    if instance.orientation != 1:
+        size = '{}-o{}'.format(size, instance.orientation)
+    return 'photos/rendition/{}-{}-v{}.{}'.format(
+        instance.checksum, size, instance.version, ext)
+
+
+class RenditionQuerySet(models.QuerySet):
+    def lookup(self, checksum, sizes, version, orientation=1):
+        """
+        Return a dictionary of size -> Rendition for the renditions of the
+        given original (with the given orientation) that already exist. A
+        rendition never changes once it is rendered, so lookups are kept in the
+        cache (which is shared between workers when a shared cache backend is
+        configured).
+        """
+        keys = dict((get_rendition_cache_key(checksum, size, version, orientation), size)
+                    for size in sizes)
+        renditions = {}
+        for key, (pk, name, webp_name) in cache.get_many(keys.keys()).items():
+            renditions[keys[key]] = Rendition(
+                pk=pk, checksum=checksum, size=keys[key], version=version,
+                orientation=orientation, file=name, file_webp=webp_name)
+        missing = [size for size in sizes if size not in renditions]
+        if missing:
+            found = self.filter(checksum=checksum, version=version,
+                                orientation=orientation, size__in=missing)
+            for rendition in found:
+                renditions[rendition.size] = rendition
+            cache.set_many(dict(
+                (rendition.cache_key, (rendition.pk, rendition.file.name, rendition.file_webp.name))
+                for rendition in found), None)
+        return renditions
+
+    def acquire_existing(self, checksum, sizes, version, orientation=1):
+        """
+        Take a reference on each existing rendition of the given original and
+        return them (see lookup).
+        """
+        renditions = self.lookup(checksum, sizes, version, orientation)
+        if not renditions:
+            return renditions
+        pks = [rendition.pk for rendition in renditions.values()]
+        taken = self.filter(pk__in=pks).update(reference_count=F('reference_count') + 1)
+        if taken != len(pks):
+            # Some were deleted since they were cached, they need rendering
+            remaining = set(self.filter(pk__in=pks).values_list('pk', flat=True))
+            for size, rendition in list(renditions.items()):
+                if rendition.pk not in remaining:
+                    cache.delete(rendition.cache_key)
+                    del renditions[size]
+        return renditions
+
+    def acquire(self, photo, sizes):
+        """
+        Return a dictionary of size -> Rendition for the photo's original and
+        take a reference on each. Only the sizes that have not been rendered
+        for an identical original yet are rendered, in a single pass and in
+        every thumbnail format, turned upright according to the photo's
+        orientation.
+        """
+        checksum = photo.get_checksum()
+        version = settings.THUMBNAIL_VERSION
+        orientation = photo.orientation
+        renditions = self.acquire_existing(checksum, sizes, version, orientation)
+        missing = [size for size in sizes if size not in renditions]
+        if missing:
+            files = generate_thumbnails(photo.file, missing, orientation)
+            for size in missing:
+                renditions[size] = self.add(checksum, size, version, files[size], orientation)
+        return renditions
+
+    def acquire_many(self, photo_sizes):
+        """
+        Like acquire, for a list of (photo, sizes) at once. The photos that
+        need rendering are rendered in a pool of THUMBNAIL_WORKERS threads, so
+        this takes about as long as rendering the slowest of them. Returns a
+        list with a dictionary of size -> Rendition for each of the photos (in
+        the same order), which do not need to be saved yet.
+        """
+        version = settings.THUMBNAIL_VERSION
+        result, tasks = [], []
+        for photo, sizes in photo_sizes:
+            checksum = photo.get_checksum()
+            renditions = self.acquire_existing(checksum, sizes, version, photo.orientation)
+            result.append(renditions)
+            missing = [size for size in sizes if size not in renditions]
+            if missing:
+                tasks.append((renditions, photo, checksum, missing))
+
+        def render(task):
+            renditions, photo, checksum, sizes = task
+            # A fresh FieldFile, so no file handle is shared between threads
+            original = Photo(file=photo.file.name).file
+            return render_renditions(original, checksum, sizes, version, photo.orientation)
+
+        workers = min(settings.THUMBNAIL_WORKERS, len(tasks))
+        if workers > 1:
+            with ThreadPoolExecutor(workers) as executor:
+                futures = [executor.submit(render, task) for task in tasks]
+                rendered, errors = [], []
+                for future in futures:
+                    try:
+                        rendered.append(future.result())
+                    except Exception as e:
+                        errors.append(e)
+        else:
+            rendered, errors = [], []
+            for task in tasks:
+                try:
+                    rendered.append(render(task))
+                except Exception as e:
+                    errors.append(e)
+                    break
+        if errors:
+            # Nothing refers to the files of the other photos yet. The
+            # references taken on existing renditions are dropped again, as
+            # this may not run in a transaction that is rolled back.
+            for renditions in result:
+                for rendition in renditions.values():
+                    self.release(rendition.pk)
+            self.delete_unused_files(
+                name for files in rendered for formats in files.values()
+                for name in formats.values())
+            raise errors[0]
+        for (renditions, photo, checksum, sizes), files in zip(tasks, rendered):
+            for size in sizes:
+                renditions[size] = self.add(
+                    checksum, size, version, files[size], photo.orientation)
+        return result
+
+    def delete_unused_files(self, names):
+        """
+        Delete the given rendition files from storage, except the ones a
+        rendition refers to. This cleans up after renditions that were
+        rendered but never saved, or saved in a transaction that was rolled
+        back.
+        """
+        names = set(names)
+        used = self.filter(Q(file__in=names) | Q(file_webp__in=names))
+        names -= set(used.values_list('file', flat=True))
+        names -= set(used.values_list('file_webp', flat=True))
+        storage = Rendition._meta.get_field('file').storage
+        for name in names:
+            storage.delete(name)
+
+    def add(self, checksum, size, version, files, orientation=1):
+        """
+        Store newly rendered files (a dictionary of format -> file) as a
+        rendition with one reference. If the same rendition was stored in the
+        meantime, throw the files away and take a reference on the existing
+        one instead.
+        """
+        rendition = Rendition(checksum=checksum, size=size, version=version,
+                              orientation=orientation, file=files['JPEG'],
+                              file_webp=files.get('WEBP'), reference_count=1)
+        try:
+            with transaction.atomic():
+                rendition.save()
+        except IntegrityError:
+            rendition.file.delete(save=False)
+            if rendition.file_webp:
+                rendition.file_webp.delete(save=False)
+            rendition = self.get(checksum=checksum, size=size, version=version,
+                                 orientation=orientation)
+            self.filter(pk=rendition.pk).update(reference_count=F('reference_count') + 1)
+        return rendition
+
+    def release(self, pk):
+        """
+        Drop a reference on the given rendition, and delete it (along with its
+        file) once no thumbnail refers to it anymore.
+        """
+        self.filter(pk=pk, reference_count__gt=0).update(
+            reference_count=F('reference_count') - 1)
+        for rendition in self.filter(pk=pk, reference_count=0):
+            if not rendition.thumbnail_set.exists():
+                rendition.delete()
+
+
+def get_rendition_cache_key(checksum, size, version, orientation=1):
+    return 'photos:rendition:{}:{}:{}:{}'.format(checksum, size, version, orientation)
+
+
+def render_renditions(original, checksum, sizes, version, orientation=1):
+    """
+    Render the given sizes of the original (a FieldFile) and save them to
+    storage under their rendition names. This only touches storage, never the
+    database, so it can run in another thread or process. Returns a
+    dictionary of size -> {format: filename} for Rendition.objects.add.
+    """
+    handler = ImageHandler(original, orientation)
+    rendered = handler.render(sizes, get_thumbnail_formats())
+    field = Rendition._meta.get_field('file')
+    files = {}
+    for size, encoded in rendered.items():
+        rendition = Rendition(checksum=checksum, size=size, version=version,
+                              orientation=orientation)
+        files[size] = {}
+        for format, data in encoded.items():
+            name = 'thumbnail.{}'.format(THUMBNAIL_EXTENSIONS[format])
+            name = field.generate_filename(rendition, name)
+            files[size][format] = field.storage.save(name, ContentFile(data))
+    return files
+
+
+class Rendition(models.Model):
+    """
+    A rendition is a rendered thumbnail file. It is identified by the content
+    of the original it was made from, the size, the THUMBNAIL_VERSION it was
+    rendered with and the orientation it was turned upright from, so photos
+    with identical originals share renditions (and their files). It counts the
+    thumbnails that refer to it.
+    """
+
+    checksum = models.CharField(_('checksum'), max_length=40)
+    size = models.CharField(_('size'), max_length=20)
+    version = models.PositiveSmallIntegerField(_('version'))
+    orientation = models.PositiveSmallIntegerField(
+        _('orientation'), choices=ORIENTATION_CHOICES, default=1)
+    file = models.ImageField(_('file'), upload_to=get_rendition_path)
+    file_webp = models.ImageField(
+        _('WebP file'), upload_to=get_rendition_path, null=True, blank=True)
+    reference_count = models.PositiveIntegerField(_('reference count'), default=0)
+
+    objects = RenditionQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['checksum', 'size', ]
+        unique_together = ('checksum', 'size', 'version', 'orientation', )
+        verbose_name = _('rendition')
+        verbose_name_plural = _('renditions')
+
+    def __str__(self):
+        return '%s (%s)' % (self.checksum, self.size)
+
+    @property
+    def cache_key(self):
+        return get_rendition_cache_key(
+            self.checksum, self.size, self.version, self.orientation)
+
+
 class Thumbnail(models.Model):
     """
     A thumbnail is a smaller resolution size of a photo. It knows how to
@@ -180,7 +779,12 @@ class Thumbnail(models.Model):
 
     size = models.CharField(_('size'), max_length=20, db_index=True)
     file = models.ImageField(_('file'), upload_to=get_unique_upload_path)
+    file_webp = models.ImageField(
+        _('WebP file'), upload_to=get_unique_upload_path, null=True, blank=True)
     photo = models.ForeignKey(Photo, verbose_name=_('photo'))
+    rendition = models.ForeignKey(
+        Rendition, null=True, blank=True, verbose_name=_('rendition'),
+        on_delete=models.PROTECT)
 
     class Meta:
         ordering = ['photo', 'size', ]
@@ -193,16 +797,322 @@ class Thumbnail(models.Model):
 
     def save(self, **kwargs):
         """
-        If we have a photo and a size, generate a thumbnail before saving.
+        If we have a photo and a size but no file yet, generate a thumbnail
+        before saving.
         """
-        if self.photo and self.size:
+        if self.photo and self.size and not self.file:
             self.generate()
         super().save(**kwargs)
 
     def generate(self):
         """
-        Generate the thumbnail. This happens regardless of whether we already
-        have one generated. The new one will overwrite the existing one (while
-        keeping the same filename).
+        Generate the thumbnail, or share the rendition of an identical
+        original if there is one.
+        """
+        rendition = Rendition.objects.acquire(self.photo, [self.size])[self.size]
+        self.set_rendition(rendition)
+
+    def set_rendition(self, rendition):
+        """
+        Point this thumbnail (and its files) at the given rendition.
+        """
+        self.rendition = rendition
+        self.file = rendition.file.name
+        self.file_webp = rendition.file_webp.name
+
+
+class ThumbnailJobQuerySet(models.QuerySet):
+    def pending(self, max_attempts, stale_after):
+        """
+        Return the jobs that are ready to be worked on: jobs that have not
+        been started yet, and jobs whose worker went away (started more than
+        stale_after seconds ago). Jobs that failed max_attempts times are left
+        alone so they can be inspected in the admin.
+        """
+        stale = timezone.now() - timedelta(seconds=stale_after)
+        return self.filter(attempts__lt=max_attempts).filter(
+            Q(started__isnull=True) | Q(started__lt=stale))
+
+    def enqueue(self, thumbnails):
+        """
+        Queue a job for each of the given (unsaved) thumbnails in one query,
+        skipping the ones that are already queued.
+        """
+        photos = set(thumb.photo_id for thumb in thumbnails)
+        sizes = set(thumb.size for thumb in thumbnails)
+        queued = set(self.filter(photo__in=photos, size__in=sizes)
+                     .values_list('photo_id', 'size'))
+        jobs = [ThumbnailJob(photo=thumb.photo, size=thumb.size)
+                for thumb in thumbnails if (thumb.photo_id, thumb.size) not in queued]
+        if jobs:
+            bulk_get_or_create(ThumbnailJob, jobs)
+
+
+class ThumbnailJob(models.Model):
+    """
+    A thumbnail job is a request to generate a thumbnail outside of the
+    request/response cycle. Jobs are processed by the process_thumbnails
+    management command, and are deleted once the thumbnail exists.
+    """
+
+    size = models.CharField(_('size'), max_length=20)
+    photo = models.ForeignKey(Photo, verbose_name=_('photo'))
+    created = models.DateTimeField(
+        _('created'), default=timezone.now, db_index=True)
+    started = models.DateTimeField(_('started'), null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(_('attempts'), default=0)
+    error = models.TextField(_('error'), blank=True)
+
+    objects = ThumbnailJobQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['created', ]
+        unique_together = ('photo', 'size', )
+        verbose_name = _('thumbnail job')
+        verbose_name_plural = _('thumbnail jobs')
+
+    def __str__(self):
+        return '%s (%s)' % (self.photo, self.size)
+
+    def claim(self, stale_after):
+        """
+        Mark this job as started. The update only matches if nobody else has
+        claimed the job in the meantime, so it is safe to run several workers
+        against the same database. Return True if the job is ours.
+        """
+        stale = timezone.now() - timedelta(seconds=stale_after)
+        claimed = ThumbnailJob.objects.filter(pk=self.pk).filter(
+            Q(started__isnull=True) | Q(started__lt=stale)
+        ).update(started=timezone.now(), attempts=F('attempts') + 1)
+        return claimed == 1
+
+    def run(self):
+        """
+        Generate the thumbnail (unless another path already did) and remove
+        the job. On failure the error is recorded and the job is released so
+        it can be retried.
+        """
+        try:
+            self.photo.generate_thumbnails([self.size])
+        except Exception as e:
+            ThumbnailJob.objects.filter(pk=self.pk).update(
+                started=None, error=str(e))
+            raise
+        self.delete()
+
+
+def get_upload_token():
+    return uuid.uuid4().hex
+
+
+def get_upload_session_path(instance, filename):
+    """
+    Gets the path the chunks of an upload session are written to, such as:
+        photos/uploadsession/bc31d8ba49c149598f83cf6c64eed500.part
+    """
+    return 'photos/uploadsession/{}.part'.format(instance.token)
+
+
+class UploadSessionQuerySet(models.QuerySet):
+    def stale(self):
+        """
+        Return the sessions that have not received a chunk for
+        CHUNKED_UPLOAD_EXPIRY seconds.
+        """
+        expired = timezone.now() - timedelta(seconds=settings.CHUNKED_UPLOAD_EXPIRY)
+        return self.filter(updated__lt=expired)
+
+    def reserved_size(self):
+        """
+        Return the number of bytes the open sessions can take up on disk.
+        Sessions that were imported no longer have a file.
+        """
+        sessions = self.exclude(state=UploadSession.DONE)
+        return sessions.aggregate(total=models.Sum('size'))['total'] or 0
+
+
+class UploadSession(models.Model):
+    """
+    An upload session receives a single (large) file, usually a zip of
+    photos, in chunks that can arrive in any order and be sent again if they
+    were lost. The chunks are written straight into a file in storage at their
+    offset. Once every chunk is in, the session is finalized and the file is
+    added to the album like a regular upload, either right away or by the
+    process_uploads management command (see CHUNKED_UPLOAD_QUEUE). The
+    session then records the outcome, so finalizing it again only reports
+    it. See apps.photos.views.chunked and apps.photos.uploads.
+    """
+
+    UPLOADING = 'uploading'
+    QUEUED = 'queued'
+    IMPORTING = 'importing'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATE_CHOICES = [
+        (UPLOADING, _('Uploading')),
+        (QUEUED, _('Queued')),
+        (IMPORTING, _('Importing')),
+        (DONE, _('Done')),
+        (FAILED, _('Failed')),
+    ]
+
+    token = models.CharField(
+        _('token'), max_length=32, unique=True, default=get_upload_token)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_('user'))
+    album = models.ForeignKey(Album, verbose_name=_('album'))
+    filename = models.CharField(_('filename'), max_length=200)
+    size = models.BigIntegerField(_('size'))
+    chunk_size = models.PositiveIntegerField(_('chunk size'))
+    skip_duplicates = models.BooleanField(_('skip duplicates'), default=False)
+    file = models.FileField(_('file'), upload_to=get_upload_session_path, blank=True)
+    state = models.CharField(
+        _('state'), max_length=20, choices=STATE_CHOICES, default=UPLOADING, db_index=True)
+    # What the import added (photo_count, duplicates and skipped, as JSON),
+    # or why it failed
+    result = models.TextField(_('result'), blank=True)
+    error = models.TextField(_('error'), blank=True)
+    created = models.DateTimeField(_('created'), default=timezone.now)
+    updated = models.DateTimeField(_('updated'), default=timezone.now, db_index=True)
+
+    objects = UploadSessionQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['created', ]
+        verbose_name = _('upload session')
+        verbose_name_plural = _('upload sessions')
+
+    def __str__(self):
+        return '%s (%s)' % (self.filename, self.user)
+
+    @property
+    def chunk_count(self):
+        return max(1, -(-self.size // self.chunk_size))
+
+    def get_chunk_length(self, index):
+        """
+        Return the number of bytes in the chunk with the given index.
+        """
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def get_missing_chunks(self):
+        """
+        Return the indexes of the chunks that have not been received yet.
+        """
+        received = set(self.uploadchunk_set.values_list('index', flat=True))
+        return [index for index in range(self.chunk_count) if index not in received]
+
+    def write_chunk(self, index, stream):
+        """
+        Write the chunk with the given index, read from stream, at its offset
+        in the file, and record it as received. Return False (and record
+        nothing) if the stream does not hold exactly the chunk. Writing a chunk
+        again is harmless.
+        """
+        length = self.get_chunk_length(index)
+        written = 0
+        with open(self.file.path, 'r+b') as handle:
+            handle.seek(index * self.chunk_size)
+            while written <= length:
+                data = stream.read(64 * 1024)
+                if not data:
+                    break
+                handle.write(data[:max(0, length - written)])
+                written += len(data)
+        if written != length:
+            return False
+        UploadChunk.objects.get_or_create(session=self, index=index)
+        UploadSession.objects.filter(pk=self.pk).update(updated=timezone.now())
+        return True
+
+    def set_state(self, state, from_states, **fields):
+        """
+        Move the session to the given state if it is still in one of
+        from_states, and set the given fields along with it. The update only
+        matches if nobody else moved it in the meantime (a retried request,
+        or another worker), so only one of them gets to. Return True if it
+        was this one.
+        """
+        fields.update(state=state, updated=timezone.now())
+        changed = UploadSession.objects.filter(
+            pk=self.pk, state__in=from_states).update(**fields)
+        if changed:
+            for name, value in fields.items():
+                setattr(self, name, value)
+        return changed == 1
+
+    def finalize(self):
+        """
+        Hand the uploaded file over to be imported: queue it for the
+        process_uploads command if CHUNKED_UPLOAD_QUEUE is on, otherwise mark
+        it as being imported (by the caller). Sessions that failed to import
+        can be finalized again, since a failed import adds nothing. Return
+        True if the session was handed over by this call.
+        """
+        state = self.QUEUED if settings.CHUNKED_UPLOAD_QUEUE else self.IMPORTING
+        return self.set_state(state, (self.UPLOADING, self.FAILED), error='')
+
+    def claim(self):
+        """
+        Mark a queued session as being imported. Return True if it is ours.
         """
-        self.file = generate_thumbnail(self.photo.file, self.size)
+        return self.set_state(self.IMPORTING, (self.QUEUED, ))
+
+
+class UploadChunk(models.Model):
+    """
+    Records that a chunk of an upload session was written.
+    """
+
+    session = models.ForeignKey(UploadSession, verbose_name=_('upload session'))
+    index = models.PositiveIntegerField(_('index'))
+
+    class Meta:
+        ordering = ['session', 'index', ]
+        unique_together = ('session', 'index', )
+        verbose_name = _('upload chunk')
+        verbose_name_plural = _('upload chunks')
+
+    def __str__(self):
+        return '%s (%s)' % (self.session, self.index)
+
+
+def release_rendition_on_delete(sender, **kwargs):
+    """
+    This signal drops the reference a deleted thumbnail held on its rendition.
+    """
+    if kwargs['instance'].rendition_id:
+        Rendition.objects.release(kwargs['instance'].rendition_id)
+
+
+def forget_thumbnail(sender, **kwargs):
+    """
+    This signal removes a saved or deleted thumbnail from thumbnail_cache.
+    Rotating, deleting and regenerating photos all go through here.
+    """
+    thumbnail_cache.delete(get_thumbnail_cache_key(
+        kwargs['instance'].photo_id, kwargs['instance'].size))
+
+
+def delete_rendition_file_on_delete(sender, **kwargs):
+    """
+    This signal deletes the files of a deleted rendition, and forgets it.
+    """
+    cache.delete(kwargs['instance'].cache_key)
+    kwargs['instance'].file.delete(save=False)
+    if kwargs['instance'].file_webp:
+        kwargs['instance'].file_webp.delete(save=False)
+
+
+def delete_upload_session_file_on_delete(sender, **kwargs):
+    """
+    This signal deletes the (partial) file of a deleted upload session.
+    """
+    if kwargs['instance'].file:
+        kwargs['instance'].file.delete(save=False)
+
+
+models.signals.post_delete.connect(release_rendition_on_delete, sender=Thumbnail)
+models.signals.post_delete.connect(forget_thumbnail, sender=Thumbnail)
+models.signals.post_save.connect(forget_thumbnail, sender=Thumbnail)
+models.signals.post_delete.connect(delete_rendition_file_on_delete, sender=Rendition)
+models.signals.post_delete.connect(delete_upload_session_file_on_delete, sender=UploadSession)
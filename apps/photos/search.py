@@ -0,0 +1,185 @@
+import re
+from collections import defaultdict
+
+from django.db import connection, models, transaction
+from django.db.backends.signals import connection_created
+
+from apps.photos.models import Album, Location, Person, Photo
+
+# The full-text index of the photos: an SQLite FTS5 table (created by the
+# photo_search migration) whose rowids are photo ids. It is only there when
+# the database is SQLite with FTS5, otherwise search falls back to LIKE
+# queries (see filter_photos).
+SEARCH_TABLE = 'photos_photo_fts'
+
+# Number of photos that are (re)indexed at a time
+SEARCH_INDEX_BATCH = 500
+
+
+# Whether the database has the full-text index, which is looked up once for
+# each connection (see is_available)
+_available = None
+
+
+def is_available():
+    """
+    Return True if the database has the full-text index.
+    """
+    global _available
+    if _available is None:
+        _available = (connection.vendor == 'sqlite' and
+                      SEARCH_TABLE in connection.introspection.table_names())
+    return _available
+
+
+def forget_availability(**kwargs):
+    """
+    This signal makes is_available look for the full-text index again on new
+    connections, and after migrations (which create or drop it).
+    """
+    global _available
+    _available = None
+
+
+def get_match_query(text):
+    """
+    Return an FTS5 query that matches everything with words starting with each
+    of the words in text, or '' if there are no words in it.
+    """
+    return ' '.join('"{}"*'.format(word) for word in re.findall(r'\w+', text))
+
+
+def filter_photos(queryset, text):
+    """
+    Return the photos in the queryset whose name, album, people or location
+    match text. With the full-text index they are annotated with search_rank
+    (lower is better), which weighs matches on the name of the photo the most.
+    Without it they are found with (unindexed) LIKE queries.
+    """
+    match = get_match_query(text)
+    if not match or not is_available():
+        return queryset.filter(
+            models.Q(name__icontains=text) | models.Q(album__name__icontains=text) |
+            models.Q(people__name__icontains=text) |
+            models.Q(album__location__name__icontains=text)).distinct()
+    return queryset.extra(
+        select={'search_rank': '{}.rank'.format(SEARCH_TABLE)},
+        tables=[SEARCH_TABLE],
+        where=['{}.rowid = {}.id'.format(SEARCH_TABLE, Photo._meta.db_table),
+               '{} MATCH %s'.format(SEARCH_TABLE)],
+        params=[match])
+
+
+def index_photos(photo_ids):
+    """
+    Bring the index of the given photos up to date with their name, album,
+    people and location. Photos that do not exist anymore are removed from
+    it.
+    """
+    if not is_available():
+        return
+    photo_ids = sorted(set(photo_ids))
+    for start in range(0, len(photo_ids), SEARCH_INDEX_BATCH):
+        batch = photo_ids[start:start + SEARCH_INDEX_BATCH]
+        people = defaultdict(list)
+        tags = Photo.people.through.objects.filter(photo__in=batch)
+        for photo_id, name in tags.values_list('photo_id', 'person__name'):
+            people[photo_id].append(name)
+        photos = Photo.objects.filter(pk__in=batch).values_list(
+            'pk', 'name', 'album__name', 'album__location__name')
+        rows = [(pk, name, album or '', ' '.join(people[pk]), location or '')
+                for pk, name, album, location in photos]
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('DELETE FROM {} WHERE rowid IN ({})'.format(
+                SEARCH_TABLE, ', '.join(['%s'] * len(batch))), batch)
+            cursor.executemany(
+                'INSERT INTO {} (rowid, name, album, people, location) '
+                'VALUES (%s, %s, %s, %s, %s)'.format(SEARCH_TABLE), rows)
+
+
+def rebuild():
+    """
+    Index every photo again, and drop everything else from the index.
+    """
+    if not is_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM {}'.format(SEARCH_TABLE))
+    index_photos(Photo.objects.values_list('pk', flat=True))
+
+
+def index_photo(sender, **kwargs):
+    """
+    This signal indexes a saved photo, and removes a deleted one.
+    """
+    index_photos([kwargs['instance'].pk])
+
+
+def index_album(sender, **kwargs):
+    """
+    This signal indexes the photos of a saved album again.
+    """
+    index_photos(kwargs['instance'].photo_set.values_list('pk', flat=True))
+
+
+def index_location(sender, **kwargs):
+    """
+    This signal indexes the photos of a saved location again.
+    """
+    index_photos(Photo.objects.filter(album__location=kwargs['instance'])
+                 .values_list('pk', flat=True))
+
+
+def index_person(sender, **kwargs):
+    """
+    This signal indexes the photos of a saved person again.
+    """
+    index_photos(kwargs['instance'].photo_set.values_list('pk', flat=True))
+
+
+def remember_photos_before_delete(sender, **kwargs):
+    """
+    This signal remembers the photos of a person or location that is about to
+    be deleted (which does not send signals for them), so they can be indexed
+    again afterwards by index_photos_after_delete.
+    """
+    instance = kwargs['instance']
+    if isinstance(instance, Person):
+        photos = instance.photo_set.all()
+    else:
+        photos = Photo.objects.filter(album__location=instance)
+    instance._search_photo_ids = list(photos.values_list('pk', flat=True))
+
+
+def index_photos_after_delete(sender, **kwargs):
+    index_photos(getattr(kwargs['instance'], '_search_photo_ids', []))
+
+
+def index_tagged_photos(sender, **kwargs):
+    """
+    This signal indexes photos whose people changed, from either side.
+    """
+    action, instance = kwargs['action'], kwargs['instance']
+    if not kwargs['reverse']:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            index_photos([instance.pk])
+    elif action == 'pre_clear':
+        instance._search_photo_ids = list(instance.photo_set.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        index_photos_after_delete(sender, instance=instance)
+    elif action in ('post_add', 'post_remove'):
+        index_photos(kwargs['pk_set'])
+
+
+connection_created.connect(forget_availability)
+models.signals.post_migrate.connect(forget_availability)
+models.signals.post_save.connect(index_photo, sender=Photo)
+models.signals.post_delete.connect(index_photo, sender=Photo)
+models.signals.post_save.connect(index_album, sender=Album)
+models.signals.post_save.connect(index_location, sender=Location)
+models.signals.post_save.connect(index_person, sender=Person)
+models.signals.pre_delete.connect(remember_photos_before_delete, sender=Person)
+models.signals.pre_delete.connect(remember_photos_before_delete, sender=Location)
+models.signals.post_delete.connect(index_photos_after_delete, sender=Person)
+models.signals.post_delete.connect(index_photos_after_delete, sender=Location)
+models.signals.m2m_changed.connect(index_tagged_photos, sender=Photo.people.through)
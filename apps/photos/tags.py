@@ -0,0 +1,349 @@
+from collections import defaultdict
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_finished
+from django.db import connection, models
+
+from apps.photos.models import Album, Location, Person, Photo
+
+# Changes made by any process increment this counter (in the default cache),
+# so the other processes know to rebuild their index.
+TAG_INDEX_VERSION_KEY = 'photos:tag_index:version'
+
+# Changes to more than this many photos, albums and people in one go are not
+# read again one by one, the index is rebuilt instead. This also keeps the
+# queries that read them under SQLite's limit on parameters.
+TAG_INDEX_MAX_PENDING = 500
+
+
+def make_bitmap(ids):
+    """
+    Return a bitmap (an int where bit n is set for each id n) of the ids.
+    """
+    ids = list(ids)
+    if not ids:
+        return 0
+    data = bytearray(max(ids) // 8 + 1)
+    for i in ids:
+        data[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(data, 'little')
+
+
+def get_bitmap_ids(bitmap):
+    """
+    Return the sorted ids that are set in the bitmap.
+    """
+    bits = bin(bitmap)[:1:-1]
+    ids = []
+    i = bits.find('1')
+    while i != -1:
+        ids.append(i)
+        i = bits.find('1', i + 1)
+    return ids
+
+
+def union(bitmaps):
+    result = 0
+    for bitmap in bitmaps:
+        result |= bitmap
+    return result
+
+
+class TagIndex:
+    """
+    Keeps a bitmap of photo ids for each person and album in memory, so
+    questions such as "photos with both of these people, but not that one"
+    are answered with a few operations on whole bitmaps (Python ints, which
+    combine a machine word at a time) instead of joins. Locations are the
+    union of their albums. The people of each photo are kept as well, so a
+    change to a photo only touches the bitmaps of the people it had.
+    The index is built with three queries the first time it is used. The
+    signals below record which photos, albums, people and locations changed,
+    and those are read again once the changes are committed (see flush).
+    Changes made by other processes are picked up through a version counter
+    in the default cache, and the index is rebuilt at least every
+    TAG_INDEX_TIMEOUT seconds (0 rebuilds it for every query). The default
+    cache has to be shared between the processes (memcached, for example):
+    with a cache per process, such as LocMemCache, each process only sees
+    its own changes until its next rebuild.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        self.version = None
+        self.built = 0
+
+    def bump(self):
+        """
+        Increment the version in the cache (atomically, where the cache can)
+        and return it, or None if the cache does not keep it.
+        """
+        try:
+            return cache.incr(TAG_INDEX_VERSION_KEY)
+        except ValueError:
+            cache.add(TAG_INDEX_VERSION_KEY, 0, None)
+            try:
+                return cache.incr(TAG_INDEX_VERSION_KEY)
+            except ValueError:
+                return None
+
+    def advance(self):
+        """
+        Increment the version in the cache, and keep the index at the new
+        version if it was at the one before (nothing else changed in the
+        meantime), or mark it to be rebuilt otherwise. Returns True if it was
+        kept.
+        """
+        current = self.version is not None and self.version == cache.get(TAG_INDEX_VERSION_KEY)
+        version = self.bump()
+        if current and version is not None and version == self.version + 1:
+            self.version = version
+            return True
+        self.version = None
+        return False
+
+    def invalidate(self):
+        """
+        Make the next query rebuild the index, in every process. In a
+        transaction, the other processes are told again once it is committed,
+        so they do not rebuild from what they could see before.
+        """
+        with self.lock:
+            self.local.pending = None
+            self.version = None
+            self.bump()
+        if connection.in_atomic_block:
+            self.get_pending()['rebuild'] = True
+
+    def get_pending(self):
+        """
+        Return the changes this thread made that were not read again yet.
+        """
+        if getattr(self.local, 'pending', None) is None:
+            self.local.pending = {
+                'photos': set(), 'albums': set(), 'people': set(), 'locations': set(),
+                'rebuild': False}
+        return self.local.pending
+
+    def changed(self, photos=(), albums=(), people=(), locations=()):
+        """
+        Record that the album or people of the given photos, the location of
+        the given albums, the photos of the given people, or the given
+        locations changed, and read them again if they are committed (see
+        flush).
+        """
+        pending = self.get_pending()
+        if connection.in_atomic_block:
+            # Tell the other processes now, and again once it is committed
+            with self.lock:
+                self.advance()
+        for key, ids in (('photos', photos), ('albums', albums), ('people', people),
+                         ('locations', locations)):
+            pending[key].update(ids)
+        if sum(len(pending[key]) for key in ('photos', 'albums', 'people', 'locations')) > \
+                TAG_INDEX_MAX_PENDING:
+            self.local.pending = None
+            self.get_pending()['rebuild'] = True
+        self.flush()
+
+    def flush(self):
+        """
+        Apply the changes this thread made, unless it is still in a
+        transaction (Django 1.8 cannot tell when that is committed, so this
+        is also called when the index is used, and at the end of every
+        request). Only committed data is read, so the changes of transactions
+        that were rolled back are never applied. The other processes are told
+        about the changes, and if any of them changed anything the index
+        missed, it is rebuilt by the next query instead.
+        """
+        pending = getattr(self.local, 'pending', None)
+        if pending is None or connection.in_atomic_block:
+            return
+        self.local.pending = None
+        with self.lock:
+            if self.advance() and not pending['rebuild']:
+                self.update(pending['photos'], pending['albums'], pending['people'],
+                            pending['locations'])
+            else:
+                self.version = None
+
+    def build(self):
+        people = defaultdict(list)
+        for photo_id, person_id in Photo.people.through.objects.values_list(
+                'photo_id', 'person_id').iterator():
+            people[person_id].append(photo_id)
+        albums = defaultdict(list)
+        self.photo_albums = {}
+        for photo_id, album_id in Photo.objects.values_list('pk', 'album_id').iterator():
+            albums[album_id].append(photo_id)
+            self.photo_albums[photo_id] = album_id
+        self.people = dict((pk, make_bitmap(ids)) for pk, ids in people.items())
+        self.photo_people = defaultdict(set)
+        for person_id, photo_ids in people.items():
+            for photo_id in photo_ids:
+                self.photo_people[photo_id].add(person_id)
+        self.albums = dict((pk, make_bitmap(ids)) for pk, ids in albums.items())
+        self.album_locations = dict(Album.objects.values_list('pk', 'location_id'))
+        self.all = make_bitmap(self.photo_albums)
+        self.built = time.time()
+
+    def update(self, photos, albums, people, locations):
+        """
+        Read the album and people of the given photos, the photos of the given
+        people, and the location of the given albums (and of the albums that
+        were in the given locations) again.
+        """
+        through = Photo.people.through.objects
+        if photos:
+            # Only the bitmaps of the people the photos had are touched
+            for pk in photos:
+                bit = 1 << pk
+                for person_id in self.photo_people.pop(pk, ()):
+                    self.people[person_id] &= ~bit
+                album_id = self.photo_albums.pop(pk, None)
+                if album_id is not None:
+                    self.albums[album_id] &= ~bit
+                self.all &= ~bit
+            for pk, album_id in Photo.objects.filter(pk__in=photos).values_list('pk', 'album_id'):
+                self.add_photo(pk, album_id)
+            for photo_id, person_id in through.filter(photo__in=photos).values_list(
+                    'photo_id', 'person_id'):
+                self.tag_photo(photo_id, person_id)
+        if people:
+            for pk in people:
+                for photo_id in get_bitmap_ids(self.people.pop(pk, 0)):
+                    self.photo_people[photo_id].discard(pk)
+            for photo_id, person_id in through.filter(person__in=people).values_list(
+                    'photo_id', 'person_id'):
+                self.tag_photo(photo_id, person_id)
+        albums = set(albums) | set(
+            pk for pk, location_id in self.album_locations.items() if location_id in locations)
+        if albums:
+            for pk in albums:
+                self.album_locations.pop(pk, None)
+            self.album_locations.update(
+                Album.objects.filter(pk__in=albums).values_list('pk', 'location_id'))
+
+    def refresh(self):
+        """
+        Rebuild the index if it is missing, too old, or another process
+        changed it.
+        """
+        version = cache.get(TAG_INDEX_VERSION_KEY)
+        if version is None:
+            cache.add(TAG_INDEX_VERSION_KEY, 0, None)
+            version = cache.get(TAG_INDEX_VERSION_KEY)
+        if (version is None or version != self.version or
+                time.time() - self.built >= settings.TAG_INDEX_TIMEOUT):
+            self.build()
+            self.version = version
+
+    def query(self, albums=(), locations=(), any_people=(), all_people=(), no_people=()):
+        """
+        Return the sorted ids of the photos that are in one of the albums (if
+        given), in one of the locations (if given), with any of any_people (if
+        given), with all of all_people and with none of no_people. Changes this
+        thread made in a transaction that is still open are answered from an
+        index of what the transaction sees, which is not kept.
+        """
+        args = (albums, locations, any_people, all_people, no_people)
+        if connection.in_atomic_block and getattr(self.local, 'pending', None) is not None:
+            index = TagIndex()
+            index.build()
+            return index.match(*args)
+        self.flush()
+        with self.lock:
+            self.refresh()
+            return self.match(*args)
+
+    def match(self, albums, locations, any_people, all_people, no_people):
+        result = self.all
+        if albums:
+            result &= union(self.albums.get(int(pk), 0) for pk in albums)
+        if locations:
+            locations = set(int(pk) for pk in locations)
+            result &= union(bitmap for pk, bitmap in self.albums.items()
+                            if self.album_locations.get(pk) in locations)
+        if any_people:
+            result &= union(self.people.get(int(pk), 0) for pk in any_people)
+        for pk in all_people:
+            result &= self.people.get(int(pk), 0)
+        for pk in no_people:
+            result &= ~self.people.get(int(pk), 0)
+        return get_bitmap_ids(result)
+
+    def add_photo(self, photo_id, album_id):
+        bit = 1 << photo_id
+        self.albums[album_id] = self.albums.get(album_id, 0) | bit
+        self.photo_albums[photo_id] = album_id
+        self.all |= bit
+
+    def tag_photo(self, photo_id, person_id):
+        self.people[person_id] = self.people.get(person_id, 0) | (1 << photo_id)
+        self.photo_people[photo_id].add(person_id)
+
+
+tag_index = TagIndex()
+
+
+def photo_changed(sender, **kwargs):
+    """
+    This signal follows photos being added, moved and deleted.
+    """
+    tag_index.changed(photos=[kwargs['instance'].pk])
+
+
+def album_changed(sender, **kwargs):
+    """
+    This signal follows the location of albums that are saved or deleted.
+    """
+    tag_index.changed(albums=[kwargs['instance'].pk])
+
+
+def person_deleted(sender, **kwargs):
+    """
+    This signal forgets a deleted person, whose tags are deleted without
+    signals.
+    """
+    tag_index.changed(people=[kwargs['instance'].pk])
+
+
+def location_deleted(sender, **kwargs):
+    """
+    This signal forgets a deleted location, whose albums are left without one.
+    """
+    tag_index.changed(locations=[kwargs['instance'].pk])
+
+
+def tags_changed(sender, **kwargs):
+    """
+    This signal follows tags being added and removed, from either side.
+    """
+    if kwargs['action'] not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if kwargs['reverse']:
+        tag_index.changed(people=[kwargs['instance'].pk])
+    else:
+        tag_index.changed(photos=[kwargs['instance'].pk])
+
+
+def flush_changes(sender, **kwargs):
+    """
+    This signal applies the changes a request made once it is done, and so
+    are its transactions.
+    """
+    tag_index.flush()
+
+
+models.signals.post_save.connect(photo_changed, sender=Photo)
+models.signals.post_delete.connect(photo_changed, sender=Photo)
+models.signals.post_save.connect(album_changed, sender=Album)
+models.signals.post_delete.connect(album_changed, sender=Album)
+models.signals.post_delete.connect(person_deleted, sender=Person)
+models.signals.post_delete.connect(location_deleted, sender=Location)
+models.signals.m2m_changed.connect(tags_changed, sender=Photo.people.through)
+request_finished.connect(flush_changes)
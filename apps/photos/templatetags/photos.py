@@ -0,0 +1,77 @@
+from django import template
+from django.conf import settings
+from django.utils.html import format_html
+
+from apps.photos.utils import ImageHandler, Placeholder, get_thumbnail_formats
+
+register = template.Library()
+
+
+@register.simple_tag
+def thumbnail_url(photo, size):
+    """
+    Returns the url of the (JPEG) thumbnail with the given size for the given
+    photo. With THUMBNAIL_ON_DEMAND this is the signed url of the on-demand
+    thumbnail view. Usage:
+        {% thumbnail_url photo '200x200-fit' %}
+    """
+    if settings.THUMBNAIL_ON_DEMAND:
+        return photo.get_thumbnail_url(size)
+    return photo.thumbnail(size).url
+
+
+def get_srcset(photo, ladder, webp=False):
+    """
+    Return a srcset with a thumbnail for each size in the given ladder, in
+    WebP if webp is True. Thumbnails that are not generated yet (or that have
+    no WebP version, if webp is True) are left out.
+    """
+    sizes = settings.THUMBNAIL_LADDERS[ladder]
+    files = photo.thumbnails(sizes, webp=webp)
+    srcset = []
+    for size in sizes:
+        file = files[size]
+        if isinstance(file, Placeholder) or (webp and not file.name.endswith('.webp')):
+            continue
+        (width, height), method = ImageHandler.parse_size(size)
+        srcset.append('{} {}w'.format(file.url, width))
+    return ', '.join(srcset)
+
+
+@register.simple_tag
+def thumbnail_srcset(photo, ladder):
+    """
+    Returns a srcset with a (JPEG) thumbnail for each size in the given ladder
+    (see THUMBNAIL_LADDERS), so the browser only downloads the one it needs.
+    Thumbnails that are not generated yet are left out, unless they are
+    rendered on demand (see THUMBNAIL_ON_DEMAND). Usage:
+        <img srcset="{% thumbnail_srcset photo 'grid' %}" sizes="200px" ...>
+    """
+    if settings.THUMBNAIL_ON_DEMAND:
+        srcset = []
+        for size in settings.THUMBNAIL_LADDERS[ladder]:
+            (width, height), method = ImageHandler.parse_size(size)
+            srcset.append('{} {}w'.format(photo.get_thumbnail_url(size), width))
+        return ', '.join(srcset)
+    return get_srcset(photo, ladder)
+
+
+@register.simple_tag
+def thumbnail_webp_source(photo, ladder, sizes):
+    """
+    Returns a <source> with the WebP thumbnails of the given ladder, for a
+    <picture> around the JPEG <img>. The browser picks the format itself, so
+    the page is the same for everyone (and can be cached as such). Nothing is
+    returned if there are no WebP thumbnails, or with THUMBNAIL_ON_DEMAND,
+    where the thumbnail view picks the format instead. Usage:
+        <picture>
+            {% thumbnail_webp_source photo 'grid' '200px' %}
+            <img srcset="{% thumbnail_srcset photo 'grid' %}" sizes="200px" ...>
+        </picture>
+    """
+    if settings.THUMBNAIL_ON_DEMAND or 'WEBP' not in get_thumbnail_formats():
+        return ''
+    srcset = get_srcset(photo, ladder, webp=True)
+    if not srcset:
+        return ''
+    return format_html('<source type="image/webp" srcset="{}" sizes="{}">', srcset, sizes)
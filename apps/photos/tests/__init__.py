@@ -1,18 +1,76 @@
+from io import BytesIO
 import json
 import shutil
+import struct
 import tempfile
 
+from PIL import Image
+
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import TestCase, Client, override_settings, SimpleTestCase
+from django.test.signals import setting_changed
+
+from apps.photos.models import thumbnail_cache
 
 MEDIA_ROOT = tempfile.mkdtemp()
 
 
+def configure_thumbnail_cache(sender, **kwargs):
+    """
+    This signal applies changes to the THUMBNAIL_CACHE_* settings made by
+    tests, since the cache is only configured when the models are loaded.
+    """
+    if kwargs['setting'] in ('THUMBNAIL_CACHE_SIZE', 'THUMBNAIL_CACHE_BACKEND'):
+        thumbnail_cache.configure(settings.THUMBNAIL_CACHE_SIZE,
+                                  backend=settings.THUMBNAIL_CACHE_BACKEND)
+
+
+setting_changed.connect(configure_thumbnail_cache)
+
+
+def make_jpeg(name, size, exif=()):
+    """
+    Return an uploaded JPEG file with the given size and EXIF tags. Each tag is
+    a (tag, value) tuple where the value is a string, an int or a (numerator,
+    denominator) tuple.
+    """
+    # A big endian TIFF header followed by a single IFD, with the values that
+    # do not fit in an entry after it
+    entries, data = b'', b''
+    data_offset = 8 + 2 + 12 * len(exif) + 4
+    for tag, value in sorted(exif):
+        if isinstance(value, str):
+            type_, raw = 2, value.encode('ascii') + b'\x00'
+            count = len(raw)
+        elif isinstance(value, tuple):
+            type_, raw, count = 5, struct.pack('>II', *value), 1
+        else:
+            type_, raw, count = 3, struct.pack('>H', value), 1
+        if len(raw) <= 4:
+            field = raw.ljust(4, b'\x00')
+        else:
+            field = struct.pack('>I', data_offset + len(data))
+            data += raw
+        entries += struct.pack('>HHI', tag, type_, count) + field
+    tiff = b'MM\x00\x2a\x00\x00\x00\x08' + struct.pack('>H', len(exif)) + entries + \
+        b'\x00\x00\x00\x00' + data
+
+    buf = BytesIO()
+    if exif:
+        Image.new('RGB', size).save(buf, 'JPEG', exif=b'Exif\x00\x00' + tiff)
+    else:
+        Image.new('RGB', size).save(buf, 'JPEG')
+    return SimpleUploadedFile(name, buf.getvalue())
+
+
 @override_settings(MEDIA_ROOT=MEDIA_ROOT)
 class MediaMixin(SimpleTestCase):
     @classmethod
     def tearDownClass(cls):
         shutil.rmtree(MEDIA_ROOT)
+        super().tearDownClass()
 
 
 class SuperuserTest(TestCase):
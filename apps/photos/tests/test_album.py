@@ -1,7 +1,20 @@
+from io import BytesIO
+import os
+import time
+import zipfile
+
+from django.conf import settings
+from django.core.files import File
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.http import urlencode
 
-from apps.photos.models import Album, Location
-from apps.photos.tests import SuperuserTest
+from apps.photos.archives import AlbumArchive
+from apps.photos.models import Album, Location, Photo
+from apps.photos.tests import MEDIA_ROOT, MediaMixin, SuperuserTest
+from apps.photos.utils import get_exif_orientation
 
 
 class AlbumListView(SuperuserTest):
@@ -13,6 +26,28 @@ class AlbumListView(SuperuserTest):
         self.assertTrue('album_list' in response.context)
         self.assertTrue('paginator' in response.context)
 
+    def test_list_queries(self):
+        """
+        Test that the album list takes the same number of queries however many
+        albums there are on the page.
+        """
+        def count_queries():
+            self.client.get(reverse('albums'))
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(reverse('albums'))
+            return len(queries)
+
+        def add_album(i):
+            album = Album.objects.create(name='album{}'.format(i))
+            album.photo_set.create(name='photo1', file='photos/photo/none.jpg')
+
+        add_album(0)
+        with self.settings(THUMBNAIL_QUEUE=True):
+            queries = count_queries()
+            for i in range(1, 5):
+                add_album(i)
+            self.assertEqual(count_queries(), queries)
+
 
 class AlbumCreateView(SuperuserTest):
     def test_create(self):
@@ -39,6 +74,37 @@ class AlbumDetailView(SuperuserTest):
         self.assertTrue('paginator' in response.context)
         self.assertTrue('photo_list' in response.context)
 
+    def test_detail_thumbnails(self):
+        """
+        Test that the album detail view loads thumbnails along with photos.
+        """
+        album = Album.objects.create(name='album1')
+        album.photo_set.create(name='photo1', file='photos/photo/none.jpg')
+        with self.settings(THUMBNAIL_QUEUE=True):
+            response = self.client.get(reverse('album', kwargs=dict(pk=1)))
+        photo = response.context['photo_list'][0]
+        self.assertTrue(hasattr(photo, '_thumb_200x200_fit'))
+
+    def test_detail_nameless(self):
+        """
+        Test that the pages of an album go through the photos without a name
+        as well, where the database sorts them.
+        """
+        album = Album.objects.create(name='album1')
+        Photo.objects.bulk_create(
+            Photo(album=album, name=None if i % 2 else 'photo{:02}'.format(i),
+                  file='photos/photo/none.jpg', width=1, height=1)
+            for i in range(settings.PHOTOS_PER_PAGE + 10))
+        pages, url = [], reverse('album', kwargs={'pk': album.pk})
+        while url:
+            with self.settings(THUMBNAIL_QUEUE=True):
+                page = self.client.get(url).context['page_obj']
+            pages.append([photo.pk for photo in page])
+            url = page.next_cursor and '{}?{}'.format(
+                reverse('album', kwargs={'pk': album.pk}), urlencode({'after': page.next_cursor}))
+        ids = list(album.photo_set.order_by('name', 'id').values_list('id', flat=True))
+        self.assertEqual(pages, [ids[:settings.PHOTOS_PER_PAGE], ids[settings.PHOTOS_PER_PAGE:]])
+
     def test_detail_location(self):
         """
         Test that the album detail view works properly from location.
@@ -81,3 +147,112 @@ class AlbumDeleteView(SuperuserTest):
         self.json_post_value(
             reverse('album_delete', kwargs=dict(pk=1)), 'url', data)
         self.assertEqual(Album.objects.count(), 0)
+
+
+class AlbumDownloadView(MediaMixin, SuperuserTest):
+    def setUp(self):
+        super().setUp()
+        self.album = Album.objects.create(name='album1')
+        for x in range(1, 3):
+            self.add_photo('photo%s' % x)
+
+    def add_photo(self, name):
+        imgfile = File(open('apps/photos/fixtures/milkyway.jpg', 'rb'))
+        return self.album.photo_set.create(name=name, file=imgfile)
+
+    def get_archive(self, response):
+        if response.streaming:
+            content = b''.join(response.streaming_content)
+        else:
+            content = response.content
+        return zipfile.ZipFile(BytesIO(content))
+
+    @override_settings(ALBUM_ARCHIVE_MAX_SIZE=0)
+    def test_download(self):
+        """
+        Test that the originals of an album are streamed as a zip file.
+        """
+        response = self.client.get(reverse('album_download', kwargs={'pk': self.album.pk}))
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="album1.zip"; filename*=UTF-8\'\'album1.zip')
+        with self.get_archive(response) as archive:
+            self.assertEqual(len(archive.namelist()), 2)
+            with open('apps/photos/fixtures/milkyway.jpg', 'rb') as original:
+                self.assertEqual(archive.read(archive.namelist()[0]), original.read())
+        # Nothing needs a local path when archives are not kept
+        self.assertIsNone(AlbumArchive(self.album).path)
+        self.assertFalse(AlbumArchive(self.album).exists())
+
+    @override_settings(ALBUM_ARCHIVE_MAX_SIZE=0)
+    def test_download_rotated(self):
+        """
+        Test that rotated photos are put in the zip file turned the new way.
+        """
+        photo = self.album.photo_set.get(name='photo1')
+        photo.orientation = 6
+        photo.save()
+        response = self.client.get(reverse('album_download', kwargs={'pk': self.album.pk}))
+        with self.get_archive(response) as archive:
+            orientations = [get_exif_orientation(BytesIO(archive.read(name)))
+                            for name in archive.namelist()]
+        self.assertEqual(sorted(orientations), [1, 6])
+
+    def test_download_cached(self):
+        """
+        Test that archives are kept for the next requests until the album
+        changes, and that the old versions are deleted.
+        """
+        url = reverse('album_download', kwargs={'pk': self.album.pk})
+        with self.get_archive(self.client.get(url)) as archive:
+            self.assertEqual(len(archive.namelist()), 2)
+        first = AlbumArchive(self.album)
+        self.assertTrue(first.exists())
+        response = self.client.get(url)
+        self.assertIn('ETag', response)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="album1.zip"; filename*=UTF-8\'\'album1.zip')
+        with self.get_archive(response) as archive:
+            self.assertEqual(len(archive.namelist()), 2)
+
+        photo = self.add_photo('photo3')
+        with self.get_archive(self.client.get(url)) as archive:
+            self.assertEqual(len(archive.namelist()), 3)
+        self.assertFalse(first.exists())
+        photo.orientation = 6
+        photo.save()
+        self.assertNotEqual(AlbumArchive(self.album).version, first.version)
+        photo.delete()
+        self.assertEqual(AlbumArchive(self.album).version, first.version)
+
+    def test_download_slow_client(self):
+        """
+        Test that the archive is built, and the lock released, without waiting
+        for the response to be read.
+        """
+        response = self.client.get(reverse('album_download', kwargs={'pk': self.album.pk}))
+        archive = AlbumArchive(self.album)
+        deadline = time.time() + 10
+        while not archive.exists() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(archive.exists())
+        archive.lock().close()
+        with self.get_archive(response) as streamed:
+            self.assertEqual(len(streamed.namelist()), 2)
+        with open(archive.path, 'rb') as handle:
+            self.assertEqual(handle.read()[:2], b'PK')
+
+    def test_download_eviction(self):
+        """
+        Test that the least recently used archives are evicted to make room.
+        """
+        other = Album.objects.create(name='album2')
+        other.photo_set.create(name='photo', file=self.album.photo_set.first().file.name)
+        response = self.client.get(reverse('album_download', kwargs={'pk': other.pk}))
+        b''.join(response.streaming_content)
+        archive_dir = os.path.join(MEDIA_ROOT, 'photos', 'archive')
+        size = os.path.getsize(AlbumArchive(other).path)
+        with self.settings(ALBUM_ARCHIVE_MAX_SIZE=size):
+            response = self.client.get(reverse('album_download', kwargs={'pk': self.album.pk}))
+            b''.join(response.streaming_content)
+        self.assertTrue(AlbumArchive(self.album).exists())
+        self.assertFalse(AlbumArchive(other).exists())
+        self.assertEqual(len([n for n in os.listdir(archive_dir) if n.endswith('.zip')]), 1)
@@ -1,12 +1,21 @@
 from io import StringIO
 import os
+import tempfile
+from datetime import timedelta
 
+from django.contrib.auth.models import User
 from django.core.files import File
-from django.core.management import call_command
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.db import connection
 from django.test import TestCase
+from django.utils import timezone
 
-from apps.photos.models import Album, Photo
-from apps.photos.tests import MEDIA_ROOT, MediaMixin
+from apps.photos.models import (
+    Album, Location, Person, Photo, Rendition, Thumbnail, ThumbnailJob, UploadSession)
+from apps.photos.tests import MEDIA_ROOT, MediaMixin, make_jpeg
+from apps.photos.utils import UPRIGHT_DIR, get_upright_original
+from apps.photos.views import get_search_queryset
 
 
 class TestCleanupPhotosCommand(MediaMixin, TestCase):
@@ -29,12 +38,246 @@ class TestCleanupPhotosCommand(MediaMixin, TestCase):
         Test that the management command works properly.
         """
         photo_dir = os.path.join(MEDIA_ROOT, 'photos', 'photo')
-        thumb_dir = os.path.join(MEDIA_ROOT, 'photos', 'thumbnail')
-        # When the test starts there should be 4 files in each directory
+        rendition_dir = os.path.join(MEDIA_ROOT, 'photos', 'rendition')
+        # When the test starts there should be 4 photos, which all share the
+        # same thumbnail since they are identical
         self.assertEqual(len(os.listdir(photo_dir)), 4)
-        self.assertEqual(len(os.listdir(thumb_dir)), 4)
+        self.assertEqual(len(os.listdir(rendition_dir)), 1)
+        self.assertEqual(Rendition.objects.get().reference_count, 1)
+        # Plus a rendition file that is not in the database
+        with open(os.path.join(rendition_dir, 'orphan.jpg'), 'wb') as handle:
+            handle.write(b'orphan')
         # Then we call the command to clean up
         call_command('cleanup_photos', stdout=StringIO(), verbosity=2)
         # And it should delete all but one of the files
         self.assertEqual(len(os.listdir(photo_dir)), 1)
-        self.assertEqual(len(os.listdir(thumb_dir)), 1)
+        self.assertEqual(len(os.listdir(rendition_dir)), 1)
+
+    def test_upright_copies(self):
+        """
+        Test that the copies of rotated originals are deleted once no photo
+        is turned like them anymore.
+        """
+        photo = self.album.photo_set.get()
+        storage = photo.file.storage
+        for orientation in (6, 3):
+            get_upright_original(storage, photo.file.name, photo.get_checksum(), orientation)
+        Photo.objects.filter(pk=photo.pk).update(orientation=3)
+        call_command('cleanup_photos', stdout=StringIO())
+        self.assertEqual(os.listdir(os.path.join(MEDIA_ROOT, UPRIGHT_DIR)),
+                         ['{}-3.jpg'.format(photo.checksum)])
+
+    def test_stale_upload_sessions(self):
+        """
+        Test that abandoned chunked uploads are deleted with their files.
+        """
+        user = User.objects.create_user('uploader')
+        for filename in ('old.jpg', 'new.jpg'):
+            session = UploadSession(user=user, album=self.album, filename=filename,
+                                    size=10, chunk_size=10)
+            session.file.save('upload.part', ContentFile(b''))
+        UploadSession.objects.filter(filename='old.jpg').update(
+            updated=timezone.now() - timedelta(days=2))
+        upload_dir = os.path.join(MEDIA_ROOT, 'photos', 'uploadsession')
+        self.assertEqual(len(os.listdir(upload_dir)), 2)
+        call_command('cleanup_photos', stdout=StringIO())
+        self.assertEqual(UploadSession.objects.get().filename, 'new.jpg')
+        self.assertEqual(len(os.listdir(upload_dir)), 1)
+
+
+class TestProcessThumbnailsCommand(MediaMixin, TestCase):
+    def setUp(self):
+        """
+        Create a photo with a few queued thumbnails.
+        """
+        self.album = Album.objects.create(name='album1')
+        self.photo = self.album.photo_set.create(name='photo1')
+        self.photo.file = File(open('apps/photos/fixtures/milkyway.jpg', 'rb'))
+        self.photo.save()
+        for size in ('200x200-fit', '1024x768-thumb'):
+            ThumbnailJob.objects.create(photo=self.photo, size=size)
+        ThumbnailJob.objects.create(photo=self.photo, size='bad-size')
+
+    def test_command(self):
+        """
+        Test that the worker generates the queued thumbnails, retries the
+        failing job up to max_attempts, and keeps it around with its error.
+        """
+        stderr = StringIO()
+        call_command('process_thumbnails', once=True, max_attempts=2, stdout=StringIO(), stderr=stderr)
+        self.assertEqual(Thumbnail.objects.count(), 2)
+        job = ThumbnailJob.objects.get()
+        self.assertEqual(job.size, 'bad-size')
+        self.assertEqual(job.attempts, 2)
+        self.assertIsNone(job.started)
+        self.assertTrue(job.error)
+        self.assertTrue('bad-size' in stderr.getvalue())
+
+
+class TestGenerateThumbnailsCommand(MediaMixin, TestCase):
+    def setUp(self):
+        """
+        Create some photos, one of which already has a thumbnail.
+        """
+        self.album = Album.objects.create(name='album1')
+        for x in range(1, 5):
+            p = self.album.photo_set.create(name='photo%s' % x)
+            p.file = File(open('apps/photos/fixtures/milkyway.jpg', 'rb'))
+            p.save()
+        p.thumbnail('200x200-fit')
+        handle, self.checkpoint = tempfile.mkstemp()
+        os.close(handle)
+        os.remove(self.checkpoint)
+
+    def tearDown(self):
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+    def call(self, **options):
+        stdout = StringIO()
+        options.setdefault('sizes', ['200x200-fit', '100x100-thumb'])
+        call_command('generate_thumbnails', stdout=stdout, stderr=StringIO(),
+                     checkpoint=self.checkpoint, **options)
+        return stdout.getvalue()
+
+    def test_command(self):
+        """
+        Test that the command renders the missing sizes in worker processes
+        and records its progress.
+        """
+        output = self.call(processes=2, batch=3)
+        # the photos are identical, so by the time the second batch (photo 4)
+        # comes along its renditions exist and it does not need rendering
+        self.assertTrue('Rendered 3 photos' in output)
+        self.assertTrue('photos/s' in output)
+        self.assertEqual(Thumbnail.objects.filter(size='200x200-fit').count(), 4)
+        self.assertEqual(Thumbnail.objects.filter(size='100x100-thumb').count(), 4)
+        self.assertEqual(Photo.objects.get(pk=1).thumbnail('100x100-thumb').width, 100)
+        with open(self.checkpoint) as handle:
+            self.assertEqual(handle.read(), '4')
+
+    def test_resume(self):
+        """
+        Test that a run given a checkpoint skips the photos before it.
+        """
+        with open(self.checkpoint, 'w') as handle:
+            handle.write('2')
+        output = self.call(processes=0)
+        self.assertTrue('Rendered 2 photos' in output)
+        self.assertFalse(Photo.objects.get(pk=1).thumbnail_set.exists())
+        self.assertEqual(Photo.objects.get(pk=3).thumbnail_set.count(), 2)
+
+    def test_resume_failed(self):
+        """
+        Test that the progress stops before a photo that failed, so it is
+        tried again when the run is resumed.
+        """
+        photo = Photo.objects.get(pk=2)
+        original = photo.file.read()
+        photo.file.close()
+        with open(photo.file.path, 'wb') as handle:
+            handle.write(b'broken')
+        Photo.objects.filter(pk=2).update(checksum='')
+        output = self.call(processes=0, batch=2)
+        self.assertTrue('(1 failed)' in output)
+        self.assertEqual(Photo.objects.get(pk=3).thumbnail_set.count(), 2)
+        with open(self.checkpoint) as handle:
+            self.assertEqual(handle.read(), '1')
+
+        with open(photo.file.path, 'wb') as handle:
+            handle.write(original)
+        output = self.call(processes=0, batch=2)
+        self.assertTrue('(0 failed)' in output)
+        self.assertEqual(Photo.objects.get(pk=2).thumbnail_set.count(), 2)
+        with open(self.checkpoint) as handle:
+            self.assertEqual(handle.read(), '4')
+
+    def test_invalid_size(self):
+        """
+        Test that the command refuses sizes it can not render.
+        """
+        with self.assertRaises(CommandError):
+            self.call(sizes=['big'])
+
+
+class TestExtractExifCommand(MediaMixin, TestCase):
+    def setUp(self):
+        """
+        Create photos the way they were added before their metadata was read.
+        """
+        self.album = Album.objects.create(name='album1')
+        for x in range(1, 4):
+            imgfile = File(open('apps/photos/fixtures/milkyway.jpg', 'rb'))
+            self.album.photo_set.create(name='photo%s' % x, file=imgfile)
+        Photo.objects.update(width=None, height=None)
+
+    def test_command(self):
+        """
+        Test that the command reads the photos without metadata in batches.
+        """
+        Photo.objects.filter(pk=3).update(width=1, height=1)
+        output = StringIO()
+        call_command('extract_exif', batch=1, stdout=output)
+        self.assertTrue('Read the metadata of 2 photos (0 failed).' in output.getvalue())
+        self.assertEqual(Photo.objects.filter(width=1300, height=800).count(), 2)
+        call_command('extract_exif', stdout=output, all=True)
+        self.assertEqual(Photo.objects.filter(width=1300, height=800).count(), 3)
+
+
+class TestFindDuplicatesCommand(MediaMixin, TestCase):
+    def test_command(self):
+        """
+        Test that the command hashes the photos that need it and lists the
+        groups of duplicates.
+        """
+        album = Album.objects.create(name='album1')
+        for x in range(1, 4):
+            imgfile = File(open('apps/photos/fixtures/milkyway.jpg', 'rb'))
+            album.photo_set.create(name='photo%s' % x, file=imgfile)
+        album.photo_set.create(name='other', file=make_jpeg('other.jpg', (40, 20)))
+        Photo.objects.filter(pk=1).update(dhash_0=None)
+        output = StringIO()
+        call_command('find_duplicates', stdout=output)
+        self.assertTrue('3 photos:' in output.getvalue())
+        self.assertTrue('album1 / photo1 (1)' in output.getvalue())
+        self.assertTrue('Found 1 groups of duplicates.' in output.getvalue())
+        self.assertIsNotNone(Photo.objects.get(pk=1).dhash)
+
+
+class TestRebuildSearchIndexCommand(TestCase):
+    def test_command(self):
+        """
+        Test that the command indexes photos the index missed.
+        """
+        album = Album.objects.create(name='album1')
+        album.photo_set.create(name='photo1', file='photos/photo/none.jpg')
+        album.photo_set.create(name='photo2', file='photos/photo/none.jpg')
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM photos_photo_fts')
+        self.assertFalse(get_search_queryset('q=photo1').exists())
+        stdout = StringIO()
+        call_command('rebuild_search_index', stdout=stdout)
+        self.assertEqual(stdout.getvalue().strip(), 'Indexed 2 photos.')
+        self.assertEqual([photo.name for photo in get_search_queryset('q=photo1')], ['photo1'])
+
+
+class TestReconcileCountersCommand(TestCase):
+    def test_command(self):
+        """
+        Test that the command repairs counters and covers that drifted.
+        """
+        location = Location.objects.create(name='location1')
+        album = location.album_set.create(name='album1')
+        photo = album.photo_set.create(name='photo1', file='photos/photo/none.jpg')
+        person = Person.objects.create(name='person1')
+        photo.people.add(person)
+        Album.objects.update(photo_count=5, cover_photo=None)
+        Person.objects.update(photo_count=0)
+        Location.objects.update(album_count=0, cover_photo=None)
+        stdout = StringIO()
+        call_command('reconcile_counters', stdout=stdout)
+        self.assertEqual(stdout.getvalue().strip(), 'Updated 1 albums, 1 people and 1 locations.')
+        album, person, location = Album.objects.get(), Person.objects.get(), Location.objects.get()
+        self.assertEqual((album.photo_count, album.cover_photo), (1, photo))
+        self.assertEqual((person.photo_count, person.cover_photo), (1, photo))
+        self.assertEqual((location.album_count, location.cover_photo), (1, photo))
@@ -1,9 +1,12 @@
 from django.core.files import File
 from django.db.models.fields.files import ImageFieldFile
-from django.test import TestCase
+from django.test import TestCase, override_settings
 
-from apps.photos.models import Person, Location, Thumbnail, Photo
+from apps.photos.forms import AlbumMergeForm
+from apps.photos.models import (
+    Album, Person, Location, Rendition, Thumbnail, ThumbnailJob, Photo, thumbnail_cache)
 from apps.photos.tests import MediaMixin
+from apps.photos.utils import Placeholder
 
 
 class ModelTest(MediaMixin, TestCase):
@@ -31,10 +34,54 @@ class ModelTest(MediaMixin, TestCase):
         """
         Test that cover photo is an instance of Photo.
         """
+        for obj in (self.location, self.album, self.person):
+            obj.refresh_from_db()
         self.assertTrue(isinstance(self.location.cover_photo, Photo))
         self.assertTrue(isinstance(self.album.cover_photo, Photo))
         self.assertTrue(isinstance(self.person.cover_photo, Photo))
 
+    def assertCounters(self, obj, count, cover):
+        obj = type(obj).objects.get(pk=obj.pk)
+        self.assertEqual(getattr(obj, 'album_count', None) or getattr(obj, 'photo_count', 0), count)
+        self.assertEqual(obj.cover_photo, cover)
+
+    def test_counters(self):
+        """
+        Test that counts and covers follow photos being added, renamed, moved,
+        tagged, untagged and deleted, and albums being merged.
+        """
+        other = self.album.photo_set.create(name='a photo', file=self.photo.file.name)
+        self.assertCounters(self.album, 2, other)
+        self.assertCounters(self.location, 1, other)
+        self.assertCounters(self.person, 1, self.photo)
+        other.people.add(self.person)
+        self.assertCounters(self.person, 2, other)
+        other.name = 'z photo'
+        other.save()
+        self.assertCounters(self.album, 2, self.photo)
+        self.assertCounters(self.person, 2, self.photo)
+        self.person.photo_set.remove(self.photo)
+        self.assertCounters(self.person, 1, other)
+        album2 = Album.objects.create(name='a album')
+        other.album = album2
+        other.save()
+        self.assertCounters(self.album, 1, self.photo)
+        self.assertCounters(album2, 1, other)
+        album2.location = self.location
+        album2.save()
+        self.assertCounters(self.location, 2, other)
+        other.people.clear()
+        self.assertCounters(self.person, 0, None)
+        other.delete()
+        self.assertCounters(album2, 0, None)
+        self.assertCounters(self.location, 2, self.photo)
+
+        form = AlbumMergeForm({'new_album': album2.pk}, instance=self.album)
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertCounters(album2, 1, self.photo)
+        self.assertCounters(self.location, 1, self.photo)
+
     def test_photo_thumbnail(self):
         """
         Test that a thumbnail can be created for a photo.
@@ -49,6 +96,141 @@ class ModelTest(MediaMixin, TestCase):
         self.assertEqual(self.photo.file_thumb.height, 200)
         self.assertEqual(self.photo.file_thumb.width, 200)
 
+    @override_settings(THUMBNAIL_QUEUE=True)
+    def test_photo_thumbnail_queue(self):
+        """
+        Test that a missing thumbnail is queued instead of generated.
+        """
+        thumbnail = self.photo.thumbnail('800x600-fit')
+        self.assertTrue(isinstance(thumbnail, Placeholder))
+        self.assertTrue(thumbnail.url.endswith('img/cover-blank.png'))
+        self.assertFalse(self.photo.thumbnail_set.filter(size='800x600-fit').exists())
+        self.assertEqual(ThumbnailJob.objects.filter(size='800x600-fit').count(), 1)
+        # asking again (from a fresh instance) does not queue it twice
+        Photo.objects.get(pk=self.photo.pk).thumbnail('800x600-fit')
+        self.assertEqual(ThumbnailJob.objects.count(), 1)
+        # existing thumbnails are returned as usual
+        self.assertTrue(isinstance(self.photo.file_thumb, ImageFieldFile))
+
+    def test_thumbnail_job_run(self):
+        """
+        Test that running a job generates the thumbnail and removes the job.
+        """
+        job = ThumbnailJob.objects.create(photo=self.photo, size='800x600-fit')
+        self.assertTrue(job.claim(stale_after=600))
+        self.assertFalse(job.claim(stale_after=600))
+        job.run()
+        self.assertTrue(self.photo.thumbnail_set.filter(size='800x600-fit').exists())
+        self.assertEqual(ThumbnailJob.objects.count(), 0)
+
+    def test_with_thumbnails(self):
+        """
+        Test that with_thumbnails loads existing thumbnails in one query.
+        """
+        imgfile = File(open('apps/photos/fixtures/milkyway.jpg', 'rb'))
+        for x in range(2, 5):
+            photo = self.album.photo_set.create(name='photo%s' % x, file=imgfile)
+            photo.thumbnail('200x200-fit')
+        # one query for the photos and one for all of their thumbnails
+        with self.assertNumQueries(2):
+            photos = list(Photo.objects.with_thumbnails('200x200-fit'))
+            for photo in photos:
+                self.assertTrue(isinstance(photo.file_thumb, ImageFieldFile))
+        # slicing (as the paginator does) keeps the thumbnails
+        with self.assertNumQueries(2):
+            photos = list(self.album.photo_set.with_thumbnails('200x200-fit')[:2])
+            self.assertEqual(photos[1].file_thumb.width, 200)
+        # values() and values_list() (which clone with a positional klass)
+        # still work on these querysets
+        photos = Photo.objects.with_thumbnails('200x200-fit')
+        self.assertEqual(len(photos.values_list('pk', flat=True)), 4)
+        self.assertEqual(photos.values('name')[0], {'name': 'photo1'})
+
+    @override_settings(THUMBNAIL_CACHE_SIZE=100)
+    def test_thumbnail_cache(self):
+        """
+        Test that thumbnails are remembered across instances, and forgotten
+        when the photo is rotated or deleted.
+        """
+        list(Photo.objects.with_thumbnails('200x200-fit'))
+        self.assertEqual(thumbnail_cache.stats()['misses'], 1)
+        # only the photos are queried now
+        with self.assertNumQueries(1):
+            photo = Photo.objects.with_thumbnails('200x200-fit').get()
+            self.assertEqual(photo.file_thumb.name, self.thumbnail.file.name)
+        with self.assertNumQueries(0):
+            self.assertEqual(photo.thumbnail('200x200-fit', webp=True).width, 200)
+        self.assertEqual(thumbnail_cache.stats()['hits'], 1)
+
+        # a new checksum (as after a rotate) does not use the old entry
+        photo = Photo.objects.get()
+        photo.checksum = 'rotated'
+        self.assertIsNone(photo.find_thumbnail('300x300-fit'))
+        self.assertEqual(photo.find_thumbnail('200x200-fit').pk, self.thumbnail.pk)
+        self.assertEqual(thumbnail_cache.stats()['hits'], 2)
+
+        photo.delete()
+        self.assertEqual(thumbnail_cache.stats()['size'], 0)
+
+    def test_with_thumbnails_generate(self):
+        """
+        Test that with_thumbnails generates missing thumbnails in bulk when
+        the queue is disabled.
+        """
+        imgfile = File(open('apps/photos/fixtures/milkyway.jpg', 'rb'))
+        for x in range(2, 5):
+            self.album.photo_set.create(name='photo%s' % x, file=imgfile)
+        photos = list(Photo.objects.with_thumbnails('200x200-fit'))
+        self.assertEqual(Thumbnail.objects.filter(size='200x200-fit').count(), 4)
+        for photo in photos:
+            self.assertEqual(photo.file_thumb.width, 200)
+
+    @override_settings(THUMBNAIL_QUEUE=True)
+    def test_with_thumbnails_queue(self):
+        """
+        Test that with_thumbnails queues all missing thumbnails in bulk.
+        """
+        imgfile = File(open('apps/photos/fixtures/milkyway.jpg', 'rb'))
+        for x in range(2, 5):
+            self.album.photo_set.create(name='photo%s' % x, file=imgfile)
+        photos = list(Photo.objects.with_thumbnails('200x200-fit'))
+        self.assertTrue(isinstance(photos[0].file_thumb, ImageFieldFile))
+        for photo in photos[1:]:
+            self.assertTrue(isinstance(photo.file_thumb, Placeholder))
+        self.assertEqual(ThumbnailJob.objects.count(), 3)
+        # already queued jobs are not queued again
+        list(Photo.objects.with_thumbnails('200x200-fit'))
+        self.assertEqual(ThumbnailJob.objects.count(), 3)
+
+    def test_shared_renditions(self):
+        """
+        Test that identical photos share their renditions, and that the
+        rendition goes away with the last thumbnail using it.
+        """
+        imgfile = File(open('apps/photos/fixtures/milkyway.jpg', 'rb'))
+        duplicate = self.album.photo_set.create(name='photo2', file=imgfile)
+        self.assertEqual(duplicate.file_thumb.name, self.photo.file_thumb.name)
+        rendition = Rendition.objects.get()
+        self.assertEqual(rendition.reference_count, 2)
+        self.assertEqual(rendition.checksum, self.photo.get_checksum())
+        storage = rendition.file.storage
+        self.photo.delete()
+        self.assertEqual(Rendition.objects.get().reference_count, 1)
+        self.assertTrue(storage.exists(rendition.file.name))
+        duplicate.delete()
+        self.assertEqual(Rendition.objects.count(), 0)
+        self.assertFalse(storage.exists(rendition.file.name))
+
+    def test_rendition_version(self):
+        """
+        Test that changing THUMBNAIL_VERSION renders thumbnails again.
+        """
+        with self.settings(THUMBNAIL_VERSION=99):
+            imgfile = File(open('apps/photos/fixtures/milkyway.jpg', 'rb'))
+            photo = self.album.photo_set.create(name='photo2', file=imgfile)
+            self.assertTrue(photo.file_thumb.name.endswith('-v99.jpg'))
+        self.assertEqual(Rendition.objects.count(), 2)
+
     def test_album_date_display(self):
         """
         Test the date display for an album.
@@ -1,9 +1,33 @@
+from datetime import datetime
+from io import BytesIO, StringIO
+import json
+import os
+import zipfile
+
+from PIL import Image
+
+from django.conf import settings
 from django.core.files import File
+from django.core.files.uploadedfile import SimpleUploadedFile
 
+from django.core.cache import cache
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.datastructures import MultiValueDict
+from django.utils.http import urlencode
+from django.utils.timezone import utc
 
-from apps.photos.models import Person, Location, Thumbnail, Photo, Album
-from apps.photos.tests import SuperuserTest, MediaMixin
+from apps.photos.forms import UploadForm
+from apps.photos.models import (
+    Person, Location, Thumbnail, ThumbnailJob, Photo, Album, Rendition, UploadSession)
+from apps.photos.search import forget_availability, is_available
+from apps.photos.tests import MEDIA_ROOT, SuperuserTest, MediaMixin, make_jpeg
+from apps.photos.tags import TAG_INDEX_VERSION_KEY, tag_index
+from apps.photos.utils import get_exif_orientation, sign_thumbnail_size
+from apps.photos.views import get_search_facets, get_search_queryset
 
 
 class PhotoTest(MediaMixin, SuperuserTest):
@@ -66,6 +90,85 @@ class PhotoDetailView(PhotoTest):
         kwargs = {'pk': 1, 'location_pk': 1, 'album_pk': 1}
         response = self.get_photo_detail(kwargs)
         self.assertIsNotNone(response.context['location'])
+        other = self.location.album_set.create(name='album2')
+        response = self.client.get(reverse('photo', kwargs={
+            'pk': 1, 'location_pk': self.location.pk, 'album_pk': other.pk}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_detail_neighbours(self):
+        """
+        Test that the previous and next photos and the position follow the
+        names, then the ids for photos with the same name.
+        """
+        self.create_data()
+        second = self.album.photo_set.create(name='photo1', file=self.photo.file.name)
+        first = self.album.photo_set.create(name='a photo', file=self.photo.file.name)
+        self.album.photo_set.create(name='photo2', file=self.photo.file.name)
+        paginator = self.get_photo_detail({'pk': second.pk}).context['paginator']
+        self.assertEqual(paginator['previous_url'], reverse('photo', kwargs={'pk': self.photo.pk}))
+        self.assertEqual((paginator['index'], paginator['count']), (3, 4))
+        paginator = self.get_photo_detail({'pk': first.pk}).context['paginator']
+        self.assertFalse(paginator['has_previous'])
+        self.assertEqual(paginator['next_url'], reverse('photo', kwargs={'pk': self.photo.pk}))
+        self.assertEqual((paginator['index'], paginator['count']), (1, 4))
+        # The position is cached until photos change
+        self.album.photo_set.create(name='0', file=self.photo.file.name)
+        paginator = self.get_photo_detail({'pk': first.pk}).context['paginator']
+        self.assertEqual((paginator['index'], paginator['count']), (2, 5))
+        # Photos that are not among the results are not found
+        response = self.client.get(reverse('photo', kwargs={'pk': first.pk, 'query': 'q=photo2'}))
+        self.assertEqual(response.status_code, 404)
+
+    def assertNeighbours(self, queryset, **kwargs):
+        """
+        Assert that each photo in the queryset links to the ones before and
+        after it in the queryset's own order, and knows its position.
+        """
+        ids = list(queryset.values_list('id', flat=True))
+        for i, pk in enumerate(ids):
+            paginator = self.get_photo_detail(dict(kwargs, pk=pk)).context['paginator']
+            self.assertEqual(paginator['previous_url'], reverse(
+                'photo', kwargs=dict(kwargs, pk=ids[i - 1])) if i > 0 else None)
+            self.assertEqual(paginator['next_url'], reverse(
+                'photo', kwargs=dict(kwargs, pk=ids[i + 1])) if i + 1 < len(ids) else None)
+            self.assertEqual((paginator['index'], paginator['count']), (i + 1, len(ids)))
+        return ids
+
+    def test_detail_nameless(self):
+        """
+        Test that photos without a name have neighbours and a position like
+        the others.
+        """
+        self.create_data()
+        self.album.photo_set.create(file=self.photo.file.name)
+        self.album.photo_set.create(name='a photo', file=self.photo.file.name)
+        self.album.photo_set.create(file=self.photo.file.name)
+        ids = self.assertNeighbours(self.album.photo_set.order_by('name', 'id'))
+        self.assertEqual(len(ids), 4)
+        self.assertNeighbours(get_search_queryset('o=name'), query='o=name')
+
+    def test_detail_orderings(self):
+        """
+        Test that the previous and next results follow the order of the
+        results, when they are sorted by date taken or ranked.
+        """
+        self.create_data()
+        self.photo.exif_datetime = datetime(2015, 6, 1, tzinfo=utc)
+        self.photo.save()
+        self.album.photo_set.create(name='x early', file=self.photo.file.name,
+                                    exif_datetime=datetime(2014, 6, 1, tzinfo=utc))
+        self.album.photo_set.create(name='undated', file=self.photo.file.name)
+        self.album.photo_set.create(file=self.photo.file.name)
+        ids = self.assertNeighbours(get_search_queryset('o=taken'), query='o=taken')
+        self.assertNotEqual(ids, sorted(ids))
+        self.assertNeighbours(get_search_queryset('o=-taken'), query='o=-taken')
+        # The photo named after the words ranks first
+        self.album.photo_set.create(name='beach', file=self.photo.file.name)
+        self.album.name = 'beach album'
+        self.album.save()
+        ids = self.assertNeighbours(get_search_queryset('q=beach'), query='q=beach')
+        self.assertEqual(Photo.objects.get(pk=ids[0]).name, 'beach')
+        self.assertEqual(len(ids), 5)
 
 
 class PhotoRotateView(PhotoTest):
@@ -74,8 +177,14 @@ class PhotoRotateView(PhotoTest):
         Test that the photo rotate view works properly.
         """
         self.create_data()
+        checksum = self.photo.get_checksum()
         self.json_post_value(
             reverse('photo_rotate', kwargs=dict(pk=1)), 'url', {'submit': 1})
+        photo = Photo.objects.get(pk=1)
+        self.assertEqual(photo.orientation, 6)
+        # the original is left alone, only the thumbnails are rendered again
+        self.assertEqual(photo.checksum, checksum)
+        self.assertIn('-o6-', photo.file_thumb.name)
 
 
 class PhotoRenameView(PhotoTest):
@@ -132,3 +241,654 @@ class PhotoDeleteView(PhotoTest):
         data = {'submit': True}
         self.json_post_value(reverse('photo_delete', kwargs=dict(pk=1)), 'url', data)
         self.assertEqual(Photo.objects.count(), 0)
+
+
+class PhotoDownloadView(PhotoTest):
+    def test_download(self):
+        """
+        Test that the original is sent as an attachment, in parts if asked.
+        """
+        self.create_data()
+        url = reverse('photo_download', kwargs={'pk': self.photo.pk})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        filename = self.photo.file.name.split('/')[-1]
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename="{0}"; filename*=UTF-8\'\'{0}'.format(filename))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        with open('apps/photos/fixtures/milkyway.jpg', 'rb') as original:
+            data = original.read()
+        self.assertEqual(b''.join(response.streaming_content), data)
+        response = self.client.get(url, HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), data[100:200])
+
+    def test_download_rotated(self):
+        """
+        Test that a rotated photo is sent as a copy that says it is turned
+        the new way.
+        """
+        self.create_data()
+        self.json_post_value(
+            reverse('photo_rotate', kwargs=dict(pk=self.photo.pk)), 'url', {'submit': 1})
+        response = self.client.get(reverse('photo_download', kwargs={'pk': self.photo.pk}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertIn('attachment', response['Content-Disposition'])
+        self.assertIn('ETag', response)
+        data = b''.join(response.streaming_content)
+        self.assertEqual(get_exif_orientation(BytesIO(data)), 6)
+        # Only the EXIF orientation changed, the image data is the same
+        with open('apps/photos/fixtures/milkyway.jpg', 'rb') as original:
+            self.assertEqual(len(data), len(original.read()))
+
+
+class PhotoThumbnailView(PhotoTest):
+    def test_thumbnail(self):
+        """
+        Test that the on-demand thumbnail view renders the thumbnail on the
+        first request and answers conditional requests with 304.
+        """
+        self.create_data()
+        url = self.photo.get_thumbnail_url('300x300-fit')
+        self.assertEqual(self.photo.thumbnail_set.filter(size='300x300-fit').count(), 0)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('Accept', response['Vary'])
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'\xff\xd8'))
+        self.assertEqual(self.photo.thumbnail_set.filter(size='300x300-fit').count(), 1)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_thumbnail_signature(self):
+        """
+        Test that sizes without a valid signature are not rendered.
+        """
+        self.create_data()
+        kwargs = {'pk': 1, 'size': '300x300-fit', 'signature': sign_thumbnail_size('200x200-fit')}
+        response = self.client.get(reverse('photo_thumbnail', kwargs=kwargs))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.photo.thumbnail_set.filter(size='300x300-fit').count(), 0)
+
+    def test_thumbnail_url_version(self):
+        """
+        Test that the thumbnail url changes when the photo is rotated.
+        """
+        self.create_data()
+        self.photo.get_checksum()
+        url = self.photo.get_thumbnail_url('200x200-fit')
+        self.json_post_value(
+            reverse('photo_rotate', kwargs=dict(pk=1)), 'url', {'submit': 1})
+        self.assertNotEqual(Photo.objects.get(pk=1).get_thumbnail_url('200x200-fit'), url)
+
+
+class PhotoSearch(PhotoTest):
+    def create_exif_data(self):
+        self.create_data()
+        self.canon = self.album.photo_set.create(name='canon', file=make_jpeg('canon.jpg', (40, 20), [
+            (0x0110, 'Canon EOS 5D'), (0xa434, 'EF24-105mm f/4L'), (0x8827, 400),
+            (0x9003, '2015:07:04 18:30:00')]))
+        self.nikon = self.album.photo_set.create(name='nikon', file=make_jpeg('nikon.jpg', (40, 20), [
+            (0x0110, 'NIKON D7000'), (0x8827, 1600), (0x9003, '2016:01:01 09:00:00')]))
+
+    def test_search_exif(self):
+        """
+        Test that search filters and sorts on the EXIF metadata.
+        """
+        self.create_exif_data()
+        scenarios = {
+            'c=Canon+EOS+5D': ['canon'],
+            'n=EF24-105mm+f%2F4L': ['canon'],
+            'c=Canon+EOS+5D&c=NIKON+D7000&o=-taken': ['nikon', 'canon'],
+            'f=2015-07-04&t=2015-07-04': ['canon'],
+            'f=2015-07-05': ['nikon'],
+            't=2015-02-30': ['canon', 'nikon', 'photo1'],
+            'iso_min=800': ['nikon'],
+            'iso_max=800&o=taken': ['canon'],
+        }
+        for query, names in scenarios.items():
+            photos = get_search_queryset(query)
+            self.assertEqual([photo.name for photo in photos], names, query)
+
+    def test_search_view(self):
+        """
+        Test that queries with spaces and slashes make it to the results, and
+        that the ISO range is checked.
+        """
+        self.create_exif_data()
+        data = {'n': 'EF24-105mm f/4L', 'o': 'name'}
+        response = self.client.post(reverse('search'), data, follow=True)
+        self.assertEqual(list(response.context['object_list']), [self.canon])
+        response = self.client.get(reverse('photo', kwargs={
+            'pk': self.canon.pk, 'query': response.context['query']}))
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(reverse('search'), {'iso_min': '800'}, follow=True)
+        self.assertEqual(list(response.context['object_list']), [self.nikon])
+        response = self.client.post(reverse('search'), {'iso_min': '-1', 'iso_max': 'high'})
+        self.assertEqual(sorted(response.context['form'].errors), ['iso_max', 'iso_min'])
+
+
+class PhotoTextSearch(PhotoTest):
+    def search(self, q):
+        return [photo.name for photo in get_search_queryset(urlencode({'q': q}))]
+
+    def create_search_data(self):
+        self.create_data()
+        self.album.name = 'Beach holiday'
+        self.album.save()
+        self.beach = self.album.photo_set.create(name='sunset', file=self.photo.file.name)
+        self.other = Album.objects.create(name='Birthday').photo_set.create(
+            name='beach ball', file=self.photo.file.name)
+
+    def test_search(self):
+        """
+        Test that words (or the start of them) are found in the names of
+        photos, albums, people and locations, best matches first.
+        """
+        self.create_search_data()
+        # A match on the name of the photo ranks first
+        results = self.search('beach')
+        self.assertEqual(results[0], 'beach ball')
+        self.assertEqual(sorted(results[1:]), ['photo1', 'sunset'])
+        self.assertEqual(self.search('beach sun'), ['sunset'])
+        self.assertEqual(self.search('pers'), ['photo1'])
+        self.assertEqual(sorted(self.search('location1')), ['photo1', 'sunset'])
+        self.assertEqual(sorted(self.search('holiday -')), ['photo1', 'sunset'])
+        self.assertEqual(self.search('nothing'), [])
+
+    def test_search_index_signals(self):
+        """
+        Test that the index follows renames, tags, moves and deletes.
+        """
+        self.create_search_data()
+        self.beach.name = 'sunrise'
+        self.beach.save()
+        self.assertEqual(self.search('sunset'), [])
+        self.beach.people.add(self.person)
+        self.assertEqual(sorted(self.search('person1')), ['photo1', 'sunrise'])
+        self.person.name = 'someone'
+        self.person.save()
+        self.assertEqual(sorted(self.search('someone')), ['photo1', 'sunrise'])
+        self.person.delete()
+        self.assertEqual(self.search('someone'), [])
+        self.location.name = 'island'
+        self.location.save()
+        self.assertEqual(sorted(self.search('island')), ['photo1', 'sunrise'])
+        self.location.delete()
+        self.assertEqual(self.search('island'), [])
+        self.album.delete()
+        self.assertEqual(self.search('holiday'), [])
+        self.assertEqual(self.search('birthday'), ['beach ball'])
+
+    def test_search_facets(self):
+        """
+        Test that the results come with the number of matches per album,
+        person and location, which are cached per query.
+        """
+        self.create_search_data()
+        self.beach.people.add(self.person)
+        cache.clear()
+        # One query per facet (the full-text index was already looked for)
+        with self.assertNumQueries(3):
+            facets = get_search_facets('q=beach')
+        self.assertEqual(facets, {
+            'a': [(self.album.pk, 'Beach holiday', 2), (self.other.album.pk, 'Birthday', 1)],
+            'p': [(self.person.pk, 'person1', 2)],
+            'l': [(self.location.pk, 'location1', 2)],
+        })
+        with self.assertNumQueries(0):
+            get_search_facets('q=beach')
+        self.assertEqual(get_search_facets('q=beach&a={}'.format(self.other.album.pk))['p'], [])
+
+        response = self.client.get(reverse('results', kwargs={'query': 'q=beach'}))
+        albums = response.context['facets'][0][1]
+        self.assertEqual(albums[1][:2], ('Birthday', 1))
+        response = self.client.get(albums[1][2])
+        self.assertEqual([photo.name for photo in response.context['object_list']], ['beach ball'])
+
+    def test_search_available(self):
+        """
+        Test that the full-text index is only looked up once per connection.
+        """
+        is_available()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(is_available())
+        self.assertEqual(len(queries), 0)
+
+    def test_search_fallback(self):
+        """
+        Test that search works without the full-text index.
+        """
+        self.create_search_data()
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TABLE photos_photo_fts')
+        forget_availability()
+        # The table is back once the test is rolled back
+        self.addCleanup(forget_availability)
+        self.assertEqual(self.search('beach'), ['beach ball', 'photo1', 'sunset'])
+        self.assertEqual(self.search('ach bal'), ['beach ball'])
+        self.assertEqual(self.search('person1'), ['photo1'])
+
+
+class PhotoTagSearch(PhotoTest):
+    def search(self, **params):
+        query = urlencode(params, doseq=True)
+        return sorted(photo.name for photo in get_search_queryset(query))
+
+    def create_tag_data(self):
+        self.create_data()
+        self.person2 = Person.objects.create(name='person2')
+        self.both = self.album.photo_set.create(name='both', file=self.photo.file.name)
+        self.both.people.add(self.person, self.person2)
+        self.other = Album.objects.create(name='album2').photo_set.create(
+            name='other', file=self.photo.file.name)
+        self.other.people.add(self.person2)
+
+    def test_search_tags(self):
+        """
+        Test that albums, locations and people can be combined with AND, OR
+        and NOT, and that each photo is only found once.
+        """
+        self.create_tag_data()
+        person, person2 = self.person.pk, self.person2.pk
+        self.assertEqual(self.search(p=[person, person2]), ['both', 'other', 'photo1'])
+        self.assertEqual(self.search(pa=[person, person2]), ['both'])
+        self.assertEqual(self.search(p=[person2], px=[person]), ['other'])
+        self.assertEqual(self.search(px=[person2]), ['photo1'])
+        self.assertEqual(self.search(l=[self.location.pk], pa=[person2]), ['both'])
+        self.assertEqual(self.search(a=[self.other.album.pk], p=[person]), [])
+        self.assertEqual(self.search(p=['nobody']), [])
+
+    @override_settings(PAGINATION_COUNT_TIMEOUT=300)
+    def test_search_tags_no_results(self):
+        """
+        Test that the results page works when nothing matches in the tag
+        index.
+        """
+        self.create_tag_data()
+        person3 = Person.objects.create(name='person3')
+        self.other.people.add(person3)
+        empty = Album.objects.create(name='empty')
+        for query in ('a={}'.format(empty.pk),
+                      'pa={}&pa={}'.format(self.person.pk, person3.pk),
+                      'q=photo&pa={}&pa={}'.format(self.person.pk, person3.pk)):
+            response = self.client.get(reverse('results', kwargs={'query': query}))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(list(response.context['object_list']), [])
+            self.assertEqual(response.context['facets'], [])
+            response = self.client.get(
+                reverse('photo', kwargs={'pk': self.photo.pk, 'query': query}))
+            self.assertEqual(response.status_code, 404)
+
+
+@override_settings(TAG_INDEX_TIMEOUT=300)
+class PhotoTagIndexUpdates(TransactionTestCase):
+    """
+    The index is only updated once changes are committed, which never
+    happens in a TestCase.
+    """
+
+    def setUp(self):
+        self.person = Person.objects.create(name='person1')
+        self.person2 = Person.objects.create(name='person2')
+        self.location = Location.objects.create(name='location1')
+        self.album = self.location.album_set.create(name='album1')
+        self.photo = self.create_photo(self.album, 'photo1', [self.person])
+        self.both = self.create_photo(self.album, 'both', [self.person, self.person2])
+        self.other = self.create_photo(
+            Album.objects.create(name='album2'), 'other', [self.person2])
+        tag_index.invalidate()
+
+    def create_photo(self, album, name, people):
+        photo = album.photo_set.create(
+            name=name, file='photos/photo/{}.jpg'.format(name), width=1, height=1)
+        photo.people.add(*people)
+        return photo
+
+    def search(self, **params):
+        query = urlencode(params, doseq=True)
+        return sorted(photo.name for photo in get_search_queryset(query))
+
+    def test_search_tags_updates(self):
+        """
+        Test that the index follows tags, moves and deletes as they happen,
+        without being built again.
+        """
+        self.assertEqual(self.search(pa=[self.person.pk]), ['both', 'photo1'])
+        built = tag_index.built
+        self.other.people.add(self.person)
+        self.photo.people.remove(self.person)
+        self.person2.photo_set.remove(self.both)
+        self.assertEqual(self.search(pa=[self.person.pk]), ['both', 'other'])
+        self.assertEqual(self.search(p=[self.person2.pk]), ['other'])
+        self.other.album = self.album
+        self.other.save()
+        self.assertEqual(self.search(a=[self.album.pk], px=[self.person2.pk]), ['both', 'photo1'])
+        self.both.delete()
+        self.person2.delete()
+        self.assertEqual(self.search(l=[self.location.pk]), ['other', 'photo1'])
+        self.assertEqual(tag_index.built, built)
+        # Nothing was missed compared to building the index again
+        people = dict(tag_index.people)
+        photo_people = dict(tag_index.photo_people)
+        tag_index.invalidate()
+        self.assertEqual(self.search(a=[self.album.pk]), ['other', 'photo1'])
+        self.assertEqual(
+            dict((pk, bitmap) for pk, bitmap in people.items() if bitmap), tag_index.people)
+        self.assertEqual(
+            dict((pk, ids) for pk, ids in photo_people.items() if ids),
+            dict(tag_index.photo_people))
+
+    def test_search_tags_rollback(self):
+        """
+        Test that changes that are rolled back never reach the index.
+        """
+        self.assertEqual(self.search(p=[self.person.pk]), ['both', 'photo1'])
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                self.other.people.add(self.person)
+                self.photo.delete()
+                self.assertEqual(self.search(p=[self.person.pk]), ['both', 'other'])
+                raise ValueError
+        self.assertEqual(self.search(p=[self.person.pk]), ['both', 'photo1'])
+
+    def test_search_tags_other_process(self):
+        """
+        Test that the index is built again when another process changed the
+        photos.
+        """
+        self.assertEqual(self.search(p=[self.person2.pk]), ['both', 'other'])
+        built = tag_index.built
+        Photo.people.through.objects.filter(person=self.person2).delete()
+        cache.incr(TAG_INDEX_VERSION_KEY)
+        self.assertEqual(self.search(p=[self.person2.pk]), [])
+        self.assertNotEqual(tag_index.built, built)
+
+
+class PhotoUploadView(PhotoTest):
+    def get_upload(self, name, size, quality=90):
+        buf = BytesIO()
+        image = Image.open('apps/photos/fixtures/milkyway.jpg').resize(size)
+        image.save(buf, 'JPEG', quality=quality)
+        return SimpleUploadedFile(name, buf.getvalue())
+
+    def test_upload_duplicates(self):
+        """
+        Test that photos that are already in the gallery (even resized and
+        recompressed) are skipped, unless asked otherwise.
+        """
+        self.create_data()
+        data = {
+            'album': self.album.pk,
+            'photos': [self.get_upload('copy.jpg', (650, 400), 60),
+                       make_jpeg('other.jpg', (40, 20))],
+            'skip_duplicates': 'on',
+        }
+        response = self.client.post(reverse('upload'), data, follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.album.photo_set.count(), 2)
+        self.assertFalse(self.album.photo_set.filter(name='copy').exists())
+        self.assertIn('copy.jpg', str(list(response.context['messages'])[0]))
+
+        data = {'album': self.album.pk, 'photos': [self.get_upload('copy.jpg', (650, 400))]}
+        self.client.post(reverse('upload'), data)
+        copy = self.album.photo_set.get(name='copy')
+        self.assertEqual(copy.get_near_duplicates(), [self.photo])
+
+    def test_upload_flat_duplicates(self):
+        """
+        Test that photos are not skipped unless asked, and that flat images
+        (which all get the same hash) are never taken for duplicates.
+        """
+        self.create_data()
+        self.assertFalse(UploadForm().fields['skip_duplicates'].initial)
+        data = {
+            'album': self.album.pk,
+            'photos': [make_jpeg('flat1.jpg', (40, 20)), make_jpeg('flat2.jpg', (30, 30))],
+            'skip_duplicates': 'on',
+        }
+        self.client.post(reverse('upload'), data)
+        flat = self.album.photo_set.get(name='flat2')
+        self.assertEqual(flat.dhash, 0)
+        self.assertTrue(self.album.photo_set.filter(name='flat1').exists())
+        self.assertEqual(flat.get_near_duplicates(), [])
+
+    def test_upload_zip(self):
+        """
+        Test that the images in a zip file are added one by one, and that the
+        other files in it are skipped.
+        """
+        self.create_data()
+        buf = BytesIO()
+        with zipfile.ZipFile(buf, 'w') as archive:
+            archive.writestr('holiday/beach.jpg', self.get_upload('beach.jpg', (650, 400)).read())
+            archive.writestr('holiday/night.jpg', make_jpeg('night.jpg', (40, 20)).read())
+            archive.writestr('holiday/', b'')
+            archive.writestr('holiday/notes.txt', b'not a photo')
+            archive.writestr('holiday/broken.png', b'not a photo either')
+            archive.writestr('__MACOSX/holiday/._night.jpg', b'')
+        data = {'album': self.album.pk, 'photos': [SimpleUploadedFile('holiday.zip', buf.getvalue())]}
+        response = self.client.post(reverse('upload'), data, follow=True)
+        self.assertEqual(response.status_code, 200)
+        names = sorted(self.album.photo_set.values_list('name', flat=True))
+        self.assertEqual(names, ['beach', 'night', 'photo1'])
+        self.assertEqual(self.album.photo_set.get(name='beach').thumbnail_set.count(), 3)
+        self.assertIn('Skipped 3 files', str(list(response.context['messages'])[0]))
+
+        data = {'album': self.album.pk, 'photos': [SimpleUploadedFile('bad.zip', b'not a zip')]}
+        response = self.client.post(reverse('upload'), data)
+        self.assertIn('bad.zip', response.content.decode('utf-8'))
+
+    def test_upload_duplicates_in_upload(self):
+        """
+        Test that a photo that looks the same as one earlier in the same
+        upload is skipped too.
+        """
+        album = Album.objects.create(name='album1')
+        form = UploadForm(data={'album': album.pk, 'skip_duplicates': 'on'}, files=MultiValueDict(
+            {'photos': [self.get_upload('first.jpg', (650, 400)),
+                        self.get_upload('second.jpg', (600, 370), 60)]}))
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertEqual(list(album.photo_set.values_list('name', flat=True)), ['first'])
+        self.assertEqual(form.duplicates, ['second.jpg'])
+
+    def get_media_files(self):
+        return dict((dirname, sorted(os.listdir(os.path.join(MEDIA_ROOT, 'photos', dirname))))
+                    for dirname in ('photo', 'rendition'))
+
+    @override_settings(THUMBNAIL_WORKERS=4)
+    def test_upload_rollback(self):
+        """
+        Test that an upload that fails adds none of its photos, even from the
+        batches before the one that failed, and that the files stored for it
+        are deleted again.
+        """
+        self.create_data()
+        self.photo.thumbnail('200x200-fit')
+        files = self.get_media_files()
+        uploads = [make_jpeg('a.jpg', (40, 20)), self.get_upload('copy.jpg', (650, 400)),
+                   make_jpeg('b.jpg', (20, 40)), SimpleUploadedFile('broken.jpg', b'broken')]
+        form = UploadForm(data={'album': self.album.pk},
+                          files=MultiValueDict({'photos': uploads}))
+        self.assertTrue(form.is_valid())
+        with self.assertRaises(OSError):
+            form.save()
+        self.assertEqual(self.album.photo_set.count(), 1)
+        self.assertEqual(self.get_media_files(), files)
+        self.assertEqual(self.photo.thumbnail('200x200-fit').read()[:2], b'\xff\xd8')
+        self.assertEqual(Rendition.objects.get(file=self.photo.file_thumb.name).reference_count, 1)
+
+        form = UploadForm(data={'album': self.album.pk},
+                          files=MultiValueDict({'photos': uploads[1:]}))
+        form.thumbnail_batch = 2
+        self.assertTrue(form.is_valid())
+        with self.assertRaises(OSError):
+            form.save()
+        self.assertEqual(self.album.photo_set.count(), 1)
+        self.assertEqual(Album.objects.get(pk=self.album.pk).photo_count, 1)
+        self.assertEqual(self.get_media_files(), files)
+        self.assertEqual(Rendition.objects.get(file=self.photo.file_thumb.name).reference_count, 1)
+
+    @override_settings(THUMBNAIL_QUEUE=True)
+    def test_upload_renders_thumbnails(self):
+        """
+        Test that the thumbnails of uploaded photos are rendered right away,
+        even when missing thumbnails are otherwise queued.
+        """
+        self.create_data()
+        form = UploadForm(data={'album': self.album.pk}, files=MultiValueDict(
+            {'photos': [make_jpeg('a.jpg', (40, 20)), make_jpeg('b.jpg', (20, 40))]}))
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertEqual(form.photo_count, 2)
+        self.assertEqual(ThumbnailJob.objects.count(), 0)
+        for photo in form.added:
+            self.assertEqual(photo.thumbnail_set.count(), len(settings.THUMBNAIL_LADDERS['grid']))
+
+
+@override_settings(CHUNKED_UPLOAD_CHUNK_SIZE=1000)
+class PhotoChunkedUploadView(PhotoTest):
+    def get_json(self, response):
+        return json.loads(response.content.decode('utf-8'))
+
+    def start_upload(self, filename, data):
+        response = self.client.post(reverse('upload_session_create'), {
+            'album': self.album.pk, 'filename': filename, 'size': len(data)})
+        self.assertEqual(response.status_code, 201)
+        return self.get_json(response)
+
+    def put_chunk(self, session, data, offset, length=1000):
+        return self.client.put('{}?offset={}'.format(session['url'], offset),
+                               data[offset:offset + length],
+                               content_type='application/octet-stream')
+
+    def test_upload(self):
+        """
+        Test that chunks can be sent in any order and again, and that the
+        photo is added once all of them are in.
+        """
+        self.create_data()
+        data = make_jpeg('big.jpg', (400, 300)).read()
+        session = self.start_upload('big.jpg', data)
+        self.assertEqual(session['chunk_size'], 1000)
+        offsets = list(range(0, len(data), 1000))
+        self.assertEqual(session['missing'], list(range(len(offsets))))
+        for offset in reversed(offsets[1:]):
+            self.assertEqual(self.put_chunk(session, data, offset).status_code, 200)
+        # A lost chunk is sent again, and finalizing waits for the first one
+        self.assertEqual(self.put_chunk(session, data, offsets[-1]).status_code, 200)
+        response = self.client.post(session['finalize_url'])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.get_json(response)['missing'], [0])
+        # Chunks of the wrong length or at the wrong offset are refused
+        self.assertEqual(self.put_chunk(session, data, 0, 999).status_code, 400)
+        self.assertEqual(self.put_chunk(session, data, 500).status_code, 400)
+        self.assertEqual(self.put_chunk(session, data, 0).status_code, 200)
+        self.assertEqual(self.get_json(self.client.get(session['url']))['missing'], [])
+
+        response = self.client.post(session['finalize_url'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_json(response)['photo_count'], 1)
+        photo = self.album.photo_set.get(name='big')
+        self.assertEqual(photo.file.read(), data)
+        # The file is gone, the outcome is kept for a retried request
+        upload = UploadSession.objects.get()
+        self.assertEqual(upload.state, UploadSession.DONE)
+        self.assertFalse(upload.file)
+        self.assertEqual(UploadSession.objects.reserved_size(), 0)
+        self.assertEqual(self.get_json(self.client.get(session['url']))['state'], 'done')
+        self.assertEqual(self.put_chunk(session, data, 0).status_code, 409)
+
+    def test_upload_finalize_once(self):
+        """
+        Test that finalizing again, while the upload is imported or after it
+        was, only reports on the import, and that a failed import can be
+        sent and finalized again.
+        """
+        self.create_data()
+        data = make_jpeg('big.jpg', (400, 300)).read()
+        session = self.start_upload('big.jpg', data)
+        broken = bytes(1000) + data[1000:]
+        for offset in range(0, len(data), 1000):
+            self.put_chunk(session, broken, offset)
+        UploadSession.objects.update(state=UploadSession.IMPORTING)
+        response = self.client.post(session['finalize_url'])
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(self.get_json(response)['state'], 'importing')
+        self.assertEqual(self.client.delete(session['url']).status_code, 409)
+        # The first chunk is not the one of the file, which fails the import
+        UploadSession.objects.update(state=UploadSession.UPLOADING)
+        with self.assertRaises(OSError):
+            self.client.post(session['finalize_url'])
+        self.assertEqual(UploadSession.objects.get().state, UploadSession.FAILED)
+        self.assertEqual(self.album.photo_set.count(), 1)
+        self.assertEqual(self.put_chunk(session, data, 0).status_code, 200)
+        response = self.client.post(session['finalize_url'])
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(session['finalize_url'])
+        self.assertEqual(self.get_json(response)['photo_count'], 1)
+        self.assertEqual(self.album.photo_set.count(), 2)
+
+    @override_settings(CHUNKED_UPLOAD_QUEUE=True)
+    def test_upload_queue(self):
+        """
+        Test that a finalized upload is imported by the process_uploads
+        command when uploads are queued.
+        """
+        self.create_data()
+        data = make_jpeg('big.jpg', (400, 300)).read()
+        session = self.start_upload('big.jpg', data)
+        for offset in range(0, len(data), 1000):
+            self.put_chunk(session, data, offset)
+        response = self.client.post(session['finalize_url'])
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(self.get_json(response)['state'], 'queued')
+        self.assertEqual(self.client.post(session['finalize_url']).status_code, 202)
+        self.assertEqual(self.album.photo_set.count(), 1)
+        call_command('process_uploads', once=True, stdout=StringIO())
+        response = self.client.get(session['url'])
+        self.assertEqual(self.get_json(response)['state'], 'done')
+        self.assertEqual(self.get_json(response)['photo_count'], 1)
+        self.assertEqual(self.album.photo_set.count(), 2)
+        call_command('process_uploads', once=True, stdout=StringIO())
+        self.assertEqual(self.album.photo_set.count(), 2)
+
+    def test_upload_zip(self):
+        """
+        Test that a zip file sent in chunks is added like a normal upload.
+        """
+        self.create_data()
+        buf = BytesIO()
+        with zipfile.ZipFile(buf, 'w') as archive:
+            archive.writestr('a.jpg', make_jpeg('a.jpg', (40, 20)).read())
+            archive.writestr('b.jpg', make_jpeg('b.jpg', (20, 40)).read())
+        data = buf.getvalue()
+        session = self.start_upload('photos.zip', data)
+        for offset in range(0, len(data), 1000):
+            self.put_chunk(session, data, offset)
+        response = self.client.post(session['finalize_url'])
+        self.assertEqual(self.get_json(response)['photo_count'], 2)
+        self.assertEqual(self.album.photo_set.count(), 3)
+
+    @override_settings(CHUNKED_UPLOAD_MAX_SIZE=2000, CHUNKED_UPLOAD_MAX_TOTAL=3000)
+    def test_upload_limits(self):
+        """
+        Test that files that are too big, or that do not fit next to the
+        uploads in progress, are refused.
+        """
+        self.create_data()
+        url = reverse('upload_session_create')
+        data = {'album': self.album.pk, 'filename': 'a.jpg', 'size': 2001}
+        self.assertEqual(self.client.post(url, data).status_code, 400)
+        data['size'] = 2000
+        self.assertEqual(self.client.post(url, data).status_code, 201)
+        self.assertEqual(self.client.post(url, data).status_code, 400)
+        data['filename'] = 'a.txt'
+        data['size'] = 1000
+        self.assertIn('filename', self.get_json(self.client.post(url, data))['errors'])
@@ -1,6 +1,20 @@
-from django.test import TestCase
+from io import BytesIO
+from unittest import skipUnless
 
-from apps.photos.utils import friendly_name
+from PIL import Image
+
+from django.core.files import File
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.template import Context, Template
+from django.test import RequestFactory, TestCase
+from django.utils import timezone
+
+from apps.photos.models import Album, Photo
+from apps.photos.tests import MediaMixin, make_jpeg
+from apps.photos.utils import (
+    ImageHandler, accepts_webp, friendly_name, get_chunk_variants, get_dhash, get_exif_data,
+    get_exif_orientation, get_thumbnail_formats, get_upright_original, hamming_distance,
+    join_dhash, read_jpeg_segments, split_dhash)
 
 
 class UtilsTest(TestCase):
@@ -17,3 +31,228 @@ class UtilsTest(TestCase):
             result = friendly_name(input)
             self.assertEqual(result, output)
         self.assertEqual('A' * 200, friendly_name('A' * 201))
+
+    def test_dhash_chunks(self):
+        """
+        Test that hashes survive being split into chunks, and that the chunk
+        variants cover the given distance.
+        """
+        value = 0x0123456789abcdef
+        self.assertEqual(split_dhash(value), [0xcdef, 0x89ab, 0x4567, 0x0123])
+        self.assertEqual(join_dhash(split_dhash(value)), value)
+        self.assertEqual(hamming_distance(0b1011, 0b0110), 3)
+        self.assertEqual(get_chunk_variants(5, 3), [5])
+        variants = get_chunk_variants(5, 8)
+        self.assertEqual(len(variants), 1 + 16 + 120)
+        self.assertTrue(all(hamming_distance(5, variant) <= 2 for variant in variants))
+
+
+class ImageHandlerTest(MediaMixin, TestCase):
+    def setUp(self):
+        imgfile = File(open('apps/photos/fixtures/milkyway.jpg', 'rb'))
+        album = Album.objects.create(name='album1')
+        self.photo = album.photo_set.create(name='photo1', file=imgfile)
+
+    def test_render(self):
+        """
+        Test that render creates every size from a single handler.
+        """
+        sizes = ['200x200-fit', '1024x768-thumb', '100x50-thumb', '2000x2000-fit']
+        data = ImageHandler(self.photo.file).render(sizes)
+        self.assertEqual(sorted(data.keys()), sorted(sizes))
+        expected = {
+            '200x200-fit': (200, 200),
+            '1024x768-thumb': (1024, 630),
+            '100x50-thumb': (81, 50),
+            '2000x2000-fit': (2000, 2000),
+        }
+        for size, dimensions in expected.items():
+            image = Image.open(BytesIO(data[size]['JPEG']))
+            self.assertEqual(image.size, dimensions)
+            self.assertEqual(image.format, 'JPEG')
+
+    def test_render_orientation(self):
+        """
+        Test that thumbnails are turned upright according to the orientation.
+        """
+        sizes = ['200x100-fit', '1024x768-thumb']
+        data = ImageHandler(self.photo.file, orientation=6).render(sizes)
+        self.assertEqual(Image.open(BytesIO(data['200x100-fit']['JPEG'])).size, (200, 100))
+        self.assertEqual(Image.open(BytesIO(data['1024x768-thumb']['JPEG'])).size, (472, 768))
+
+    def test_exif_orientation(self):
+        """
+        Test that the EXIF orientation of an image is read, and that images
+        without one are upright.
+        """
+        upload = make_jpeg('rotated.jpg', (40, 20), [(0x0112, 6)])
+        self.assertEqual(get_exif_orientation(upload), 6)
+        photo = self.photo.album.photo_set.create(name='rotated', file=upload)
+        self.assertEqual(photo.orientation, 6)
+        thumbnail = photo.thumbnail('100x100-thumb')
+        self.assertEqual((thumbnail.width, thumbnail.height), (20, 40))
+        self.assertEqual(get_exif_orientation(self.photo.file), 1)
+
+    def test_exif_data(self):
+        """
+        Test that the EXIF metadata and dimensions of a new photo are stored.
+        """
+        upload = make_jpeg('exif.jpg', (40, 20), [
+            (0x010f, 'Canon'), (0x0110, 'Canon EOS 5D'), (0xa434, 'EF24-105mm f/4L'),
+            (0x8827, 400), (0x829a, (1, 250)), (0x829d, (28, 10)), (0x920a, (50, 1)),
+            (0x0132, '2015:07:05 10:00:00'), (0x9003, '2015:07:04 18:30:00'),
+        ])
+        photo = self.photo.album.photo_set.create(name='exif', file=upload)
+        photo = Photo.objects.get(pk=photo.pk)
+        self.assertEqual(photo.exif_make, 'Canon')
+        self.assertEqual(photo.exif_model, 'Canon EOS 5D')
+        self.assertEqual(photo.exif_lens, 'EF24-105mm f/4L')
+        self.assertEqual(photo.exif_iso, 400)
+        self.assertEqual(photo.exif_exposure, '1/250')
+        self.assertEqual(photo.exif_fnumber, 2.8)
+        self.assertEqual(photo.exif_focal, 50)
+        self.assertEqual(timezone.localtime(photo.exif_datetime).timetuple()[:5], (2015, 7, 4, 18, 30))
+        self.assertEqual((photo.width, photo.height), (40, 20))
+        self.assertEqual((self.photo.width, self.photo.height), (1300, 800))
+        self.assertIsNone(self.photo.exif_datetime)
+
+    def test_upright_original(self):
+        """
+        Test that rotated originals are copied once with only their EXIF
+        orientation changed, whether they had one, other EXIF data or none.
+        """
+        storage = self.photo.file.storage
+        for exif in ([(0x0112, 1), (0x0110, 'EOS 5D')], [(0x0110, 'EOS 5D')], []):
+            photo = self.photo.album.photo_set.create(
+                name='original', file=make_jpeg('original.jpg', (40, 20), exif))
+            self.assertEqual(get_upright_original(
+                storage, photo.file.name, photo.checksum, 1), photo.file.name)
+            name = get_upright_original(storage, photo.file.name, photo.checksum, 6)
+            self.assertNotEqual(name, photo.file.name)
+            self.assertEqual(get_upright_original(storage, photo.file.name, '', 6), name)
+            with storage.open(name, 'rb') as copy, storage.open(photo.file.name, 'rb') as original:
+                data = get_exif_data(copy)
+                self.assertEqual(data['orientation'], 6)
+                self.assertEqual(data.get('exif_model'), 'EOS 5D' if exif else None)
+                self.assertEqual(get_exif_orientation(copy), 6)
+                read_jpeg_segments(copy)
+                read_jpeg_segments(original)
+                self.assertEqual(copy.read(), original.read())
+            photo.delete()
+
+    def test_dhash(self):
+        """
+        Test that the perceptual hash of a photo is stored, and does not change
+        much when the photo is resized or rotated back upright.
+        """
+        self.assertEqual(self.photo.dhash, get_dhash(self.photo.file))
+        buf = BytesIO()
+        Image.open(self.photo.file).resize((325, 200)).save(buf, 'JPEG', quality=50)
+        self.assertLessEqual(hamming_distance(self.photo.dhash, get_dhash(buf)), 6)
+        buf = BytesIO()
+        Image.open(self.photo.file).transpose(Image.ROTATE_90).save(buf, 'JPEG')
+        self.assertLessEqual(hamming_distance(self.photo.dhash, get_dhash(buf, 6)), 6)
+        self.assertIsNone(get_dhash(BytesIO(b'not an image')))
+
+    def test_render_png(self):
+        """
+        Test that thumbnails of transparent PNGs are encoded as JPEG.
+        """
+        buf = BytesIO()
+        Image.new('RGBA', (400, 300), (255, 0, 0, 0)).save(buf, 'PNG')
+        photo = self.photo.album.photo_set.create(
+            name='photo2', file=SimpleUploadedFile('photo2.png', buf.getvalue()))
+        data = ImageHandler(photo.file).render(['200x200-fit'])
+        image = Image.open(BytesIO(data['200x200-fit']['JPEG']))
+        self.assertEqual(image.format, 'JPEG')
+        self.assertEqual(image.getpixel((0, 0)), (255, 255, 255))
+
+    @skipUnless('WEBP' in get_thumbnail_formats(), 'Pillow has no WebP support')
+    def test_render_webp(self):
+        """
+        Test that thumbnails can also be encoded as WebP.
+        """
+        data = ImageHandler(self.photo.file).render(['200x200-fit'], ['JPEG', 'WEBP'])
+        image = Image.open(BytesIO(data['200x200-fit']['WEBP']))
+        self.assertEqual(image.format, 'WEBP')
+        self.assertTrue(self.photo.thumbnail('200x200-fit', webp=True).name.endswith('.webp'))
+
+    def test_accepts_webp(self):
+        """
+        Test that WebP is only sent to browsers that accept it with a quality
+        above 0.
+        """
+        scenarios = {
+            'image/webp,image/*': True,
+            'image/*': False,
+            'image/webp;q=0.8, image/*;q=0.5': True,
+            'image/webp;q=0, image/*': False,
+            'image/webp;q=high': False,
+            '': False,
+        }
+        for accept, expected in scenarios.items():
+            request = RequestFactory().get('/', HTTP_ACCEPT=accept)
+            self.assertEqual(accepts_webp(request), expected, accept)
+
+    def test_thumbnail_url_tag(self):
+        """
+        Test that the thumbnail_url tag always gives the JPEG thumbnail, so
+        pages do not depend on the browser that asked for them.
+        """
+        template = Template("{% load photos %}{% thumbnail_url photo '200x200-fit' %}")
+        request = RequestFactory().get('/', HTTP_ACCEPT='image/webp,image/*')
+        url = template.render(Context({'photo': self.photo, 'request': request}))
+        self.assertTrue(url.endswith('.jpg'))
+
+    def test_thumbnail_webp_source_tag(self):
+        """
+        Test that the thumbnail_webp_source tag lists the WebP thumbnails of
+        the ladder, and is left out when there are none.
+        """
+        template = Template("{% load photos %}{% thumbnail_webp_source photo 'grid' '200px' %}")
+        with self.settings(THUMBNAIL_LADDERS={'grid': ('100x100-fit', '300x300-fit')}):
+            source = template.render(Context({'photo': self.photo}))
+            with self.settings(THUMBNAIL_ON_DEMAND=True):
+                self.assertEqual(template.render(Context({'photo': self.photo})), '')
+        if 'WEBP' not in get_thumbnail_formats():
+            self.assertEqual(source, '')
+            return
+        self.assertTrue(source.startswith('<source type="image/webp" srcset="'))
+        self.assertIn('.webp 300w', source)
+        self.assertTrue(source.endswith('sizes="200px">'))
+
+    def test_thumbnail_srcset_tag(self):
+        """
+        Test that the thumbnail_srcset tag lists every size of the ladder.
+        """
+        template = Template("{% load photos %}{% thumbnail_srcset photo 'grid' %}")
+        with self.settings(THUMBNAIL_LADDERS={'grid': ('100x100-fit', '300x300-fit')}):
+            srcset = template.render(Context({'photo': self.photo}))
+        urls = [entry.split(' ') for entry in srcset.split(', ')]
+        self.assertEqual([width for url, width in urls], ['100w', '300w'])
+        self.assertEqual(self.photo.thumbnail_set.count(), 2)
+        self.assertEqual(self.photo.thumbnail('300x300-fit').width, 300)
+
+    def test_thumbnail_tags_on_demand(self):
+        """
+        Test that with THUMBNAIL_ON_DEMAND the tags only build signed urls.
+        """
+        template = Template("{% load photos %}{% thumbnail_url photo '200x200-fit' %}|"
+                            "{% thumbnail_srcset photo 'grid' %}")
+        with self.settings(THUMBNAIL_ON_DEMAND=True,
+                           THUMBNAIL_LADDERS={'grid': ('100x100-fit', '300x300-fit')}):
+            with self.assertNumQueries(0):
+                url, srcset = template.render(Context({'photo': self.photo})).split('|')
+        self.assertEqual(url, self.photo.get_thumbnail_url('200x200-fit'))
+        self.assertIn('/r/300x300-fit/', srcset)
+        self.assertTrue(srcset.endswith(' 300w'))
+        self.assertEqual(self.photo.thumbnail_set.count(), 0)
+
+    def test_render_draft(self):
+        """
+        Test that small sizes are decoded at a reduced resolution.
+        """
+        handler = ImageHandler(self.photo.file)
+        original = handler.pil.size
+        handler.render(['100x100-thumb'])
+        self.assertTrue(handler.pil.size[0] < original[0])
@@ -0,0 +1,45 @@
+import json
+
+from django.core.files import File
+from django.utils.datastructures import MultiValueDict
+
+from apps.photos.forms import UploadForm
+from apps.photos.models import UploadChunk, UploadSession
+from apps.stream.utils import send_action
+
+
+def import_session(session):
+    """
+    Add the file of a session that is being imported (see
+    UploadSession.finalize) to its album through UploadForm, and record what
+    was added on the session. The file is deleted once it is imported, the
+    session itself is left for the client to read the outcome from (until the
+    cleanup_photos command deletes it). If the import fails, the error is
+    recorded and the session can be finalized again: nothing was added (see
+    UploadForm.save).
+    """
+    try:
+        storage = session.file.storage
+        with storage.open(session.file.name, 'rb') as handle:
+            upload = File(handle, name=session.filename)
+            form = UploadForm(
+                data={'album': session.album_id, 'skip_duplicates': session.skip_duplicates},
+                files=MultiValueDict({'photos': [upload]}))
+            if not form.is_valid():
+                session.set_state(UploadSession.FAILED, (UploadSession.IMPORTING, ),
+                                  error=json.dumps(form.errors))
+                return None
+            album = form.save()
+    except Exception as e:
+        session.set_state(UploadSession.FAILED, (UploadSession.IMPORTING, ), error=str(e))
+        raise
+    session.file.delete(save=False)
+    UploadChunk.objects.filter(session=session).delete()
+    session.set_state(UploadSession.DONE, (UploadSession.IMPORTING, ), file='', result=json.dumps({
+        'photo_count': form.photo_count,
+        'duplicates': form.duplicates,
+        'skipped': form.skipped,
+    }))
+    action = 'added {} photos to the album'.format(form.photo_count)
+    send_action(session.user, action, target=album)
+    return album
@@ -1,12 +1,19 @@
 from django.conf.urls import url
 
 from apps.photos import views
-from apps.photos.views import album, photo, person, location
+from apps.photos.views import album, photo, person, location, chunked
 
 urlpatterns = [
     url(r'^upload/$', views.upload, name='upload'),
+    url(r'^uploads/$', chunked.create, name='upload_session_create'),
+    url(r'^uploads/(?P<token>[0-9a-f]{32})/$', chunked.session, name='upload_session'),
+    url(r'^uploads/(?P<token>[0-9a-f]{32})/finalize/$', chunked.finalize,
+        name='upload_session_finalize'),
     url(r'^search/$', views.search, name='search'),
-    url(r'^search/(?P<query>[\w=&]+)/$', views.results, name='results'),
+    # before results, since the query of the results can contain slashes
+    url(r'^search/(?P<query>.+)/photos/(?P<pk>\d+)/$', photo.detail,
+        name='photo'),
+    url(r'^search/(?P<query>.+)/$', views.results, name='results'),
 
     url(r'^albums/$', album.list, name='albums'),
     url(r'^albums/create.ajax/$', album.create, name='album_create'),
@@ -47,6 +54,8 @@ urlpatterns = [
         name='photo_delete'),
     url(r'^photos/(?P<pk>\d+)/download/$', photo.download,
         name='photo_download'),
+    url(r'^photos/(?P<pk>\d+)/r/(?P<size>\d+x\d+-\w+)/(?P<signature>[0-9a-f]+)/$',
+        photo.thumbnail, name='photo_thumbnail'),
 
     # alternate ways to get to an album
     url(r'^locations/(?P<location_pk>\d+)/albums/(?P<pk>\d+)/$',
@@ -57,6 +66,4 @@ urlpatterns = [
         photo.detail, name='photo'),
     url(r'^people/(?P<person_pk>\d+)/photos/(?P<pk>\d+)/$', photo.detail,
         name='photo'),
-    url(r'^search/(?P<query>[\w=&]+)/photos/(?P<pk>\d+)/$', photo.detail,
-        name='photo'),
 ]
\ No newline at end of file
@@ -1,20 +1,59 @@
-import tempfile
+from datetime import datetime
+from io import BytesIO
+from itertools import combinations
+import math
 import re
+import shutil
+import struct
+import tempfile
 
 from PIL import Image, ImageOps
 
+from django.conf import settings
+from django.core.files import File
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.templatetags.static import static
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+from utils.uploads import get_file_checksum, split_extension
+
 
-from utils.uploads import split_extension
+# EXIF tags that are copied into Photo columns
+EXIF_MAKE = 0x010f
+EXIF_MODEL = 0x0110
+EXIF_DATETIME = 0x0132
+EXIF_EXPOSURE = 0x829a
+EXIF_FNUMBER = 0x829d
+EXIF_ISO = 0x8827
+EXIF_DATETIME_ORIGINAL = 0x9003
+EXIF_FOCAL = 0x920a
+EXIF_LENS = 0xa434
+
+# EXIF orientation tag, and the transposes that turn an image stored with
+# each orientation upright.
+EXIF_ORIENTATION = 0x0112
+ORIENTATION_TRANSPOSES = {
+    1: (),
+    2: (Image.FLIP_LEFT_RIGHT, ),
+    3: (Image.ROTATE_180, ),
+    4: (Image.FLIP_TOP_BOTTOM, ),
+    5: (Image.ROTATE_90, Image.FLIP_TOP_BOTTOM),
+    6: (Image.ROTATE_270, ),
+    7: (Image.ROTATE_90, Image.FLIP_LEFT_RIGHT),
+    8: (Image.ROTATE_90, ),
+}
+# The orientation of an image after turning it another 90 degrees clockwise
+ORIENTATION_CLOCKWISE = {1: 6, 6: 3, 3: 8, 8: 1, 2: 7, 7: 4, 4: 5, 5: 2}
 
 
 class ImageHandler:
-    def __init__(self, file_field):
+    def __init__(self, file_field, orientation=1):
         self.file_field = file_field
         self.name = file_field.name
         self.storage = file_field.storage
+        self.orientation = orientation
         self.pil = self._get_pil_image()
-        self.temp = self._get_temp_file()
 
     def _get_pil_image(self):
         """
@@ -22,15 +61,8 @@ class ImageHandler:
         """
         return Image.open(self.storage.open(self.file_field))
 
-    def _get_temp_file(self):
-        """
-        Generate and return a temporary file instance with the same extension
-        as self.file_field.
-        """
-        filename, ext = split_extension(self.file_field.name)
-        return tempfile.NamedTemporaryFile(suffix='.%s' % ext)
-
-    def parse_size(self, size):
+    @staticmethod
+    def parse_size(size):
         """
         Converts a size specified as '800x600-fit' to a tuple like (800, 600)
         and a string 'fit'.
@@ -53,39 +85,183 @@ class ImageHandler:
 
     def resize(self, size):
         """
-        Create a thumbnail with the given size/method, save it to the temp
-        file, and return the data for it.
+        Create a thumbnail with the given size/method and return the (JPEG)
+        data for it.
+        """
+        return self.render([size])[size]['JPEG']
+
+    def render(self, sizes, formats=('JPEG', )):
+        """
+        Create a thumbnail for each of the given sizes and encode it in each of
+        the given formats. Return a dictionary of size -> {format: data}.
+        """
+        return dict(
+            (size, dict((format, self._encode(image, format)) for format in formats))
+            for size, image in self.resize_all(sizes).items())
+
+    def resize_all(self, sizes):
+        """
+        Create a thumbnail for each of the given sizes from a single decode of
+        the original and return a dictionary of size -> Image.
+
+        The original is decoded at a reduced resolution when the largest
+        thumbnail is much smaller than it (JPEG draft mode), and the sizes are
+        then produced from the largest to the smallest, each one resized from
+        the previous intermediate image instead of from the full original.
+
+        The thumbnails are turned upright according to self.orientation. This
+        is done last, so only the (small) thumbnails are transposed.
+        """
+        parsed = dict((size, self._get_stored_size(*self.parse_size(size))) for size in sizes)
+        scales = dict((size, self._get_scale(*parsed[size])) for size in sizes)
+        # Only as large as the largest thumbnail needs, never upscale
+        largest = min(1, max(scales.values()))
+        original_size = self.pil.size
+        self.pil.draft(self.pil.mode, self._scaled(original_size, largest))
+
+        working = self.pil
+        images = {}
+        for size in sorted(sizes, key=lambda s: scales[s], reverse=True):
+            (width, height), method = parsed[size]
+            needed = self._scaled(original_size, min(1, scales[size]))
+            # Cascade: shrink the intermediate image once it is at least twice
+            # as large as needed, so smaller sizes resample fewer pixels
+            if working.size[0] >= needed[0] * 2 and working.size[1] >= needed[1] * 2:
+                working = working.resize(needed, Image.ANTIALIAS)
+            if method == 'thumb':
+                # Same dimensions Image.thumbnail would give the original
+                target = self._get_thumb_size(original_size, (width, height))
+                image = working.resize(target, Image.ANTIALIAS)
+            if method == 'fit':
+                # PILImageOps.fit returns an Image instance
+                image = ImageOps.fit(working, (width, height), method=Image.ANTIALIAS)
+            for transpose in ORIENTATION_TRANSPOSES[self.orientation]:
+                image = image.transpose(transpose)
+            images[size] = image
+        return images
+
+    def _get_stored_size(self, size, method):
+        """
+        Return the given size and method as they apply to the image as it is
+        stored, before it is turned upright (i.e. with width and height swapped
+        for orientations that turn it on its side).
         """
-        size, method = self.parse_size(size)
+        if self.orientation in (5, 6, 7, 8):
+            size = (size[1], size[0])
+        return size, method
 
+    def _get_scale(self, size, method):
+        """
+        Return the factor the original has to be scaled by so that it still
+        covers the given size, for the given method.
+        """
+        width, height = self.pil.size
         if method == 'thumb':
-            # Image.thumbnail resizes the image in place
-            self.pil.thumbnail(size, Image.ANTIALIAS)
-        if method == 'fit':
-            # PILImageOps.fit returns an Image instance
-            self.pil = ImageOps.fit(self.pil, size, method=Image.ANTIALIAS)
-        self.pil.save(self.temp, self.pil.format)
-        self.temp.seek(0)
-        return self.temp.read()
+            return min(size[0] / width, size[1] / height)
+        return max(size[0] / width, size[1] / height)
 
-    def rotate(self, degrees):
+    def _get_thumb_size(self, original_size, size):
         """
-        Rotate the image the given degrees, save it to the temp file, and
-        return the data for it.
+        Return the dimensions of a thumbnail of original_size that fits in
+        size, keeping the aspect ratio and never upscaling.
         """
-        self.pil = self.pil.rotate(degrees)
-        self.pil.save(self.temp, self.pil.format)
-        self.temp.seek(0)
-        return self.temp.read()
+        x, y = original_size
+        if x > size[0]:
+            y = int(max(y * size[0] / x, 1))
+            x = int(size[0])
+        if y > size[1]:
+            x = int(max(x * size[1] / y, 1))
+            y = int(size[1])
+        return x, y
 
-    def save_to_storage(self):
+    def _scaled(self, size, scale):
         """
-        Save the current file to the field's storage. This will overwrite the
-        existing file (if it exists). Actually does a delete then save, since
-        Django storage will not overwrite the file.
+        Return the given (width, height) multiplied by scale, rounded up.
         """
-        self.storage.delete(self.file_field.name)
-        self.storage.save(self.file_field.name, self.temp)
+        return (max(1, int(math.ceil(size[0] * scale))),
+                max(1, int(math.ceil(size[1] * scale))))
+
+    def _encode(self, image, format):
+        """
+        Return the data for the given image in the given format (JPEG or
+        WEBP). Transparency is flattened onto white for JPEG.
+        """
+        if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+            image = image.convert('RGBA')
+            if format == 'JPEG':
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.split()[3])
+                image = background
+        elif image.mode not in ('RGB', 'L') or (format == 'WEBP' and image.mode == 'L'):
+            image = image.convert('RGB')
+        buf = BytesIO()
+        image.save(buf, format)
+        return buf.getvalue()
+
+
+THUMBNAIL_EXTENSIONS = {'JPEG': 'jpg', 'WEBP': 'webp'}
+
+
+class Placeholder:
+    """
+    Stands in for a thumbnail file that has not been generated yet. It only
+    provides what the templates need, which is a url.
+    """
+
+    def __init__(self, size):
+        self.size = size
+
+    @property
+    def url(self):
+        return static(settings.THUMBNAIL_PLACEHOLDER)
+
+
+def get_thumbnail_formats():
+    """
+    Return the formats thumbnails are encoded in: always JPEG, plus WEBP when
+    THUMBNAIL_WEBP is on and Pillow was built with WebP support.
+    """
+    Image.init()
+    if settings.THUMBNAIL_WEBP and 'WEBP' in Image.SAVE:
+        return ('JPEG', 'WEBP')
+    return ('JPEG', )
+
+
+def accepts_webp(request):
+    """
+    Return True if the browser that made the given request says (through the
+    Accept header) that it can display WebP images, with a quality above 0.
+    Responses that depend on this have to vary on Accept (see ThumbnailFile).
+    """
+    for media_range in request.META.get('HTTP_ACCEPT', '').split(','):
+        media_type, *params = media_range.split(';')
+        if media_type.strip().lower() != 'image/webp':
+            continue
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def sign_thumbnail_size(size):
+    """
+    Return the signature that goes in the url of the on-demand thumbnail view
+    for the given size, so that only sizes handed out by the site itself get
+    rendered (and stored) on request.
+    """
+    return salted_hmac('apps.photos.thumbnail', size).hexdigest()[:16]
+
+
+def check_thumbnail_signature(size, signature):
+    """
+    Return True if the given signature is the one for the given size.
+    """
+    return constant_time_compare(sign_thumbnail_size(size), signature)
 
 
 def friendly_name(filename):
@@ -103,21 +279,327 @@ def friendly_name(filename):
     return filename.strip()[:200]
 
 
-def rotate_image(file_field):
+def _exif_float(value):
+    """
+    Return an EXIF number (which older versions of Pillow give as a
+    (numerator, denominator) tuple) as a float, or None.
+    """
+    if isinstance(value, tuple):
+        return value[0] / value[1] if value[1] else None
+    return float(value)
+
+
+def _exif_string(value, max_length=100):
     """
-    Rotate (clockwise) the file associated with the given file_field.
-    Return True if successful.
+    Return an EXIF string without the padding some cameras add.
     """
-    handler = ImageHandler(file_field)
-    handler.rotate(270)
-    handler.save_to_storage()
-    return True
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'ignore')
+    return value.strip(' \x00')[:max_length]
+
+
+def _exif_datetime(value):
+    """
+    Return an EXIF date and time ('2015:07:04 18:30:00', in the camera's
+    local time) as an aware datetime in the current time zone.
+    """
+    value = datetime.strptime(_exif_string(value), '%Y:%m:%d %H:%M:%S')
+    if settings.USE_TZ:
+        value = timezone.make_aware(value)
+    return value
+
+
+def _exif_exposure(value):
+    """
+    Return an exposure time the way cameras show it, such as '1/250' or '2'.
+    """
+    seconds = _exif_float(value)
+    if not seconds:
+        return ''
+    if seconds < 1:
+        return '1/{}'.format(int(round(1 / seconds)))
+    return '{:g}'.format(seconds)
+
+
+EXIF_FIELDS = (
+    ('exif_make', EXIF_MAKE, _exif_string),
+    ('exif_model', EXIF_MODEL, _exif_string),
+    ('exif_lens', EXIF_LENS, _exif_string),
+    ('exif_iso', EXIF_ISO, lambda value: int(value[0] if isinstance(value, tuple) else value)),
+    ('exif_focal', EXIF_FOCAL, _exif_float),
+    ('exif_fnumber', EXIF_FNUMBER, _exif_float),
+    ('exif_exposure', EXIF_EXPOSURE, _exif_exposure),
+    ('exif_datetime', EXIF_DATETIME, _exif_datetime),
+    ('exif_datetime', EXIF_DATETIME_ORIGINAL, _exif_datetime),
+)
+
+
+def get_exif_data(file_handle):
+    """
+    Read the given image file and return a dictionary of Photo field -> value
+    with its EXIF metadata, its orientation, and its dimensions (as shown,
+    i.e. after it is turned upright). Values that are missing or cannot be
+    read are left out. Only the headers of the file are read.
+    """
+    try:
+        file_handle.seek(0)
+        image = Image.open(file_handle)
+        exif = image._getexif() if hasattr(image, '_getexif') else None
+        width, height = image.size
+        file_handle.seek(0)
+    except Exception:
+        return {}
+
+    exif = exif or {}
+    data = {'orientation': exif.get(EXIF_ORIENTATION, 1)}
+    if data['orientation'] not in ORIENTATION_TRANSPOSES:
+        data['orientation'] = 1
+    if data['orientation'] in (5, 6, 7, 8):
+        width, height = height, width
+    data['width'], data['height'] = width, height
+    # Later tags win, so the original capture time wins over the file time
+    for field, tag, convert in EXIF_FIELDS:
+        if tag in exif:
+            try:
+                data[field] = convert(exif[tag])
+            except Exception:
+                # Cameras write all sorts of values, skip what makes no sense
+                pass
+    return data
+
+
+def get_exif_orientation(file_handle):
+    """
+    Return the EXIF orientation (1 to 8) of the given image file, or 1 if it
+    does not have one.
+    """
+    return get_exif_data(file_handle).get('orientation', 1)
+
+
+# Where the copies of rotated originals are kept (see get_upright_original)
+UPRIGHT_DIR = 'photos/upright'
+JPEG_SOI, JPEG_SOS, JPEG_APP0, JPEG_APP1 = b'\xff\xd8', b'\xff\xda', b'\xff\xe0', b'\xff\xe1'
+EXIF_HEADER = b'Exif\x00\x00'
+
+
+def read_jpeg_segments(file_handle):
+    """
+    Return the segments of the given JPEG file that come before its image data
+    as a list of (marker, payload), and leave the file at the image data.
+    Raises ValueError if it is not a JPEG file.
+    """
+    file_handle.seek(0)
+    if file_handle.read(2) != JPEG_SOI:
+        raise ValueError('Not a JPEG file.')
+    segments = []
+    while True:
+        marker = file_handle.read(2)
+        if len(marker) != 2 or marker[0] != 0xff:
+            raise ValueError('Invalid JPEG segment.')
+        if marker == JPEG_SOS:
+            file_handle.seek(-2, 1)
+            return segments
+        length = struct.unpack('>H', file_handle.read(2))[0]
+        segments.append((marker, file_handle.read(length - 2)))
+
+
+def set_exif_orientation(payload, orientation):
+    """
+    Return the given APP1 Exif payload with its orientation tag set to the
+    given orientation. A tag that is missing is added to a copy of the first
+    IFD at the end of the payload, so the offsets of the other tags stay the
+    same. Raises ValueError if the payload cannot be read.
+    """
+    try:
+        tiff = bytearray(payload[len(EXIF_HEADER):])
+        order = {b'II': '<', b'MM': '>'}[bytes(tiff[:2])]
+        ifd = struct.unpack_from(order + 'I', tiff, 4)[0]
+        count = struct.unpack_from(order + 'H', tiff, ifd)[0]
+        entries = []
+        for offset in range(ifd + 2, ifd + 2 + 12 * count, 12):
+            tag = struct.unpack_from(order + 'H', tiff, offset)[0]
+            if tag == EXIF_ORIENTATION:
+                # SHORT (3) with a count of 1, stored in the entry itself
+                struct.pack_into(order + 'HHIHH', tiff, offset, tag, 3, 1, orientation, 0)
+                return EXIF_HEADER + bytes(tiff)
+            entries.append(bytes(tiff[offset:offset + 12]))
+        next_ifd = bytes(tiff[ifd + 2 + 12 * count:ifd + 6 + 12 * count])
+    except (KeyError, struct.error) as e:
+        raise ValueError('Invalid EXIF data.') from e
+    entries.append(struct.pack(order + 'HHIHH', EXIF_ORIENTATION, 3, 1, orientation, 0))
+    entries.sort(key=lambda entry: struct.unpack_from(order + 'H', entry)[0])
+    if len(tiff) % 2:
+        tiff.append(0)
+    struct.pack_into(order + 'I', tiff, 4, len(tiff))
+    tiff += struct.pack(order + 'H', len(entries)) + b''.join(entries) + next_ifd
+    return EXIF_HEADER + bytes(tiff)
+
+
+def write_oriented_jpeg(file_handle, output, orientation):
+    """
+    Copy the given JPEG file to output with its EXIF orientation set to the
+    given orientation. Only the EXIF data changes, the image data is copied as
+    it is, so nothing is lost. Raises ValueError if the file is not a JPEG
+    file or its EXIF data cannot be changed.
+    """
+    segments = read_jpeg_segments(file_handle)
+    for index, (marker, payload) in enumerate(segments):
+        if marker == JPEG_APP1 and payload.startswith(EXIF_HEADER):
+            segments[index] = (marker, set_exif_orientation(payload, orientation))
+            break
+    else:
+        # The EXIF segment goes after the JFIF one, which has to come first
+        index = 1 if segments and segments[0][0] == JPEG_APP0 else 0
+        payload = set_exif_orientation(
+            EXIF_HEADER + b'MM\x00\x2a\x00\x00\x00\x08\x00\x00\x00\x00\x00\x00', orientation)
+        segments.insert(index, (JPEG_APP1, payload))
+    output.write(JPEG_SOI)
+    for marker, payload in segments:
+        if len(payload) + 2 > 0xffff:
+            raise ValueError('JPEG segment too long.')
+        output.write(marker + struct.pack('>H', len(payload) + 2) + payload)
+    shutil.copyfileobj(file_handle, output)
+
+
+def get_upright_original(storage, name, checksum, orientation):
+    """
+    Return the storage name of the given original as its photo is turned, for
+    downloads: the original itself if its own EXIF orientation already says
+    how to turn it (as is the case until the photo is rotated), or else a copy
+    that says so instead. The copy is made once and kept for the checksum and
+    orientation. JPEG copies only differ in their EXIF orientation, other
+    formats are turned upright and encoded again (without EXIF data).
+    """
+    with storage.open(name, 'rb') as handle:
+        if get_exif_orientation(handle) == orientation:
+            return name
+        checksum = checksum or get_file_checksum(handle)
+        ext = split_extension(name)[1]
+        upright_name = '{}/{}-{}.{}'.format(UPRIGHT_DIR, checksum, orientation, ext)
+        if storage.exists(upright_name):
+            return upright_name
+        with tempfile.TemporaryFile() as output:
+            try:
+                write_oriented_jpeg(handle, output, orientation)
+            except ValueError:
+                output.seek(0)
+                output.truncate()
+                handle.seek(0)
+                image = Image.open(handle)
+                format = image.format
+                for transpose in ORIENTATION_TRANSPOSES[orientation]:
+                    image = image.transpose(transpose)
+                image.save(output, format, **({'quality': 95} if format == 'JPEG' else {}))
+            output.seek(0)
+            saved_name = storage.save(upright_name, File(output))
+    if saved_name != upright_name:
+        # Another request made the same copy in the meantime
+        storage.delete(saved_name)
+    return upright_name
+
+
+# The 64 bit difference hash is stored (and looked up) in 4 chunks of 16 bits
+DHASH_CHUNKS = 4
+DHASH_CHUNK_BITS = 16
+# The hashes of images whose brightness never (or always) drops from one pixel
+# to the next, such as flat images. These all look the same to the hash, so
+# they are never taken for duplicates.
+DEGENERATE_DHASHES = (0, (1 << DHASH_CHUNKS * DHASH_CHUNK_BITS) - 1)
+
+
+def get_dhash(file_handle, orientation=1):
+    """
+    Return the 64 bit difference hash (dHash) of the given image file turned
+    upright, or None if it cannot be read. Each bit says whether a pixel of the
+    image shrunk to 9x8 grays is brighter than its right neighbour, so resized
+    or recompressed copies of a photo get (nearly) the same hash.
+    """
+    try:
+        file_handle.seek(0)
+        image = Image.open(file_handle)
+        # The hash only needs a tiny image, decode (JPEGs) at a fraction
+        image.draft('L', (64, 64))
+        image = image.convert('L')
+        stored_size = (8, 9) if orientation in (5, 6, 7, 8) else (9, 8)
+        image = image.resize(stored_size, Image.ANTIALIAS)
+        for transpose in ORIENTATION_TRANSPOSES[orientation]:
+            image = image.transpose(transpose)
+        pixels = list(image.getdata())
+        file_handle.seek(0)
+    except Exception:
+        return None
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left, right = pixels[row * 9 + col], pixels[row * 9 + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def split_dhash(value):
+    """
+    Return the chunks of the given hash, lowest bits first.
+    """
+    mask = (1 << DHASH_CHUNK_BITS) - 1
+    return [(value >> (DHASH_CHUNK_BITS * i)) & mask for i in range(DHASH_CHUNKS)]
+
+
+def join_dhash(chunks):
+    """
+    Return the hash made of the given chunks (see split_dhash).
+    """
+    value = 0
+    for i, chunk in enumerate(chunks):
+        value |= chunk << (DHASH_CHUNK_BITS * i)
+    return value
+
+
+def hamming_distance(a, b):
+    """
+    Return the number of bits that differ between the two hashes.
+    """
+    return bin(a ^ b).count('1')
+
+
+def get_chunk_variants(chunk, distance):
+    """
+    Return every chunk value within the given Hamming distance of chunk.
+
+    Two hashes within distance d of each other have at least one chunk within
+    d // DHASH_CHUNKS of the same chunk of the other (otherwise every chunk
+    would differ in more bits, and so would the whole hash). Looking up these
+    variants of each chunk finds every near-duplicate without a full scan.
+    """
+    radius = distance // DHASH_CHUNKS
+    variants = [chunk]
+    for bits in range(1, radius + 1):
+        for positions in combinations(range(DHASH_CHUNK_BITS), bits):
+            variant = chunk
+            for position in positions:
+                variant ^= 1 << position
+            variants.append(variant)
+    return variants
 
 
 def generate_thumbnail(file_field, size):
     """
-    Generate a thumbnail from the given file_field and size.
-    Returns a SimpleUploadedFile with the same name as the file_field.
+    Generate a (JPEG) thumbnail from the given file_field and size.
+    Returns a SimpleUploadedFile named like the file_field.
+    """
+    return generate_thumbnails(file_field, [size])[size]['JPEG']
+
+
+def generate_thumbnails(file_field, sizes, orientation=1):
+    """
+    Generate thumbnails for all the given sizes from the given file_field,
+    decoding the original only once, in each of the thumbnail formats, and
+    turned upright according to the given (EXIF) orientation.
+    Returns a dictionary of size -> {format: SimpleUploadedFile} named like
+    the file_field with the extension of the format.
     """
-    handler = ImageHandler(file_field)
-    return SimpleUploadedFile(handler.name, handler.resize(size))
+    handler = ImageHandler(file_field, orientation)
+    basename, ext = split_extension(handler.name)
+    rendered = handler.render(sizes, get_thumbnail_formats())
+    return dict((size, dict(
+        (format, SimpleUploadedFile('{}.{}'.format(basename, THUMBNAIL_EXTENSIONS[format]), data))
+        for format, data in encoded.items())) for size, encoded in rendered.items())
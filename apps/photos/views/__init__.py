@@ -1,20 +1,53 @@
+from datetime import datetime, time, timedelta
+import hashlib
+
 from django.conf import settings
+from django.contrib import messages
 from django.contrib.auth.decorators import permission_required, login_required
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.db.models import Q
+from django.db.models import Count
+from django.db.models.sql.datastructures import EmptyResultSet
 from django.http import QueryDict
+from django.utils import timezone
+from django.utils.dateparse import parse_date
 from django.views.generic import FormView, ListView
 from django.utils.translation import ugettext as _
 
+from apps.photos.search import filter_photos
+from apps.photos.tags import tag_index
 from apps.photos.forms import UploadForm, SearchForm
-from apps.photos.models import Photo
+from apps.photos.models import Photo, prefetch_thumbnails
 from apps.stream.utils import send_action
+from utils.pagination import CursorPaginationMixin
+
+
+# Ways search results can be sorted, by the value of the 'o' parameter. Each
+# one ends with the primary key, so the order is stable.
+SEARCH_ORDERINGS = {
+    'name': ('name', 'id'),
+    'taken': ('exif_datetime', 'id'),
+    '-taken': ('-exif_datetime', '-id'),
+}
+
+
+def get_search_ids(values):
+    """
+    Return the primary keys in a list of search parameter values, or [0] (which
+    matches nothing) if there were values but none of them were valid.
+    """
+    ids = [int(value) for value in values if value.isdigit()]
+    return (ids or [0]) if values else []
 
 
 def get_search_queryset(query):
     """
     Build and return a Photo queryset based on the parameters passed in, which will be a querystring
-    containing the user's search terms.
+    containing the user's search terms. The text is looked up in the full-text index (see
+    apps.photos.search) and the results are ranked by how well they match, unless another ordering
+    is asked for. Albums, locations and people (any of 'p', all of 'pa' and none of 'px') are
+    looked up in the tag index (see apps.photos.tags), without joins. The EXIF filters (camera,
+    lens, dates and ISO) and the orderings only use indexed columns.
     """
     data = QueryDict(query)
     queryset = Photo.objects.all()
@@ -22,20 +55,138 @@ def get_search_queryset(query):
     q = data.get('q')
     a = data.getlist('a')
     p = data.getlist('p')
+    pa = data.getlist('pa')
+    px = data.getlist('px')
     l = data.getlist('l')
+    c = data.getlist('c')
+    n = data.getlist('n')
+    taken_from = get_search_date(data.get('f'))
+    taken_to = get_search_date(data.get('t'))
+    iso_min = data.get('iso_min')
+    iso_max = data.get('iso_max')
+    order = data.get('o')
 
     if q:
-        queryset = queryset.filter(Q(name__icontains=q) | Q(album__name__icontains=q))
-    if a:
-        queryset = queryset.filter(album__in=a)
-    if p:
-        queryset = queryset.filter(people__in=p)
-    if l:
-        queryset = queryset.filter(album__location__in=l)
+        queryset = filter_photos(queryset, q)
+    if a or p or pa or px or l:
+        photo_ids = tag_index.query(
+            albums=get_search_ids(a), locations=get_search_ids(l), any_people=get_search_ids(p),
+            all_people=get_search_ids(pa), no_people=get_search_ids(px))
+        if not photo_ids:
+            return queryset.none()
+        # The ids are all ints, and inlining them avoids SQLite's limit on query parameters
+        queryset = queryset.extra(where=['{}.id IN ({})'.format(
+            Photo._meta.db_table, ', '.join(map(str, photo_ids)))])
+    if c:
+        queryset = queryset.filter(exif_model__in=c)
+    if n:
+        queryset = queryset.filter(exif_lens__in=n)
+    if taken_from:
+        queryset = queryset.filter(exif_datetime__gte=get_day_start(taken_from))
+    if taken_to:
+        queryset = queryset.filter(exif_datetime__lt=get_day_start(taken_to + timedelta(days=1)))
+    if iso_min and iso_min.isdigit():
+        queryset = queryset.filter(exif_iso__gte=int(iso_min))
+    if iso_max and iso_max.isdigit():
+        queryset = queryset.filter(exif_iso__lte=int(iso_max))
+    if order in SEARCH_ORDERINGS:
+        queryset = queryset.order_by(*SEARCH_ORDERINGS[order])
+    elif 'search_rank' in queryset.query.extra_select:
+        queryset = queryset.order_by('search_rank', 'name')
 
     return queryset
 
 
+def get_search_facets(query):
+    """
+    Return the number of results of the query (see get_search_queryset) in each
+    album, person and location, as a dictionary of search parameter ('a', 'p'
+    or 'l') -> list of (pk, name, count) sorted by count. They take one grouped
+    query each and are cached for SEARCH_FACETS_TIMEOUT seconds, so paging
+    through the results does not count them again.
+    """
+    key = 'photos:facets:{}'.format(hashlib.md5(query.encode('utf-8')).hexdigest())
+    facets = cache.get(key)
+    if facets is not None:
+        return facets
+    photos = get_search_queryset(query).order_by()
+    # The full-text search refers to the photo table by name, which a nested
+    # queryset would alias, so the subquery is passed as SQL
+    try:
+        sql, params = photos.values('pk').query.sql_with_params()
+    except EmptyResultSet:
+        # Nothing matched (in the tag index, for one)
+        return {'a': [], 'p': [], 'l': []}
+    tags = Photo.people.through.objects.extra(
+        where=['{}.photo_id IN ({})'.format(Photo.people.through._meta.db_table, sql)],
+        params=params)
+    groups = (
+        ('a', photos, 'album'),
+        ('p', tags, 'person'),
+        ('l', photos.filter(album__location__isnull=False), 'album__location'),
+    )
+    facets = {}
+    for param, queryset, field in groups:
+        name = '{}__name'.format(field)
+        counts = queryset.values_list(field, name).annotate(count=Count('pk', distinct=True))
+        facets[param] = list(counts.order_by('-count', name))
+    cache.set(key, facets, settings.SEARCH_FACETS_TIMEOUT)
+    return facets
+
+
+def get_search_date(value):
+    """
+    Return the date in the given YYYY-MM-DD string, or None if it is not one.
+    """
+    try:
+        return parse_date(value or '')
+    except ValueError:
+        return None
+
+
+def get_day_start(day):
+    """
+    Return the (aware) start of the given day in the current time zone.
+    """
+    start = datetime.combine(day, time())
+    if settings.USE_TZ:
+        start = timezone.make_aware(start)
+    return start
+
+
+class ThumbnailListMixin:
+    """
+    Loads the thumbnails for the current page of photos in one query instead
+    of one query per photo while the template renders. Not needed with
+    THUMBNAIL_ON_DEMAND, where the template only builds urls.
+    """
+
+    thumbnail_sizes = settings.THUMBNAIL_LADDERS['grid']
+
+    def paginate_queryset(self, queryset, page_size):
+        if not settings.THUMBNAIL_ON_DEMAND:
+            queryset = queryset.with_thumbnails(*self.thumbnail_sizes)
+        return super().paginate_queryset(queryset, page_size)
+
+
+class CoverListMixin:
+    """
+    Loads the covers of the current page of albums, people or locations, and
+    their thumbnails, along with them. Together with their counts (see
+    apps.photos.counters) the page renders in the same number of queries
+    however many there are on it.
+    """
+
+    thumbnail_sizes = settings.THUMBNAIL_LADDERS['grid']
+
+    def paginate_queryset(self, queryset, page_size):
+        result = super().paginate_queryset(queryset.select_related('cover_photo'), page_size)
+        if not settings.THUMBNAIL_ON_DEMAND:
+            covers = [obj.cover_photo for obj in result[2] if obj.cover_photo_id]
+            prefetch_thumbnails(covers, self.thumbnail_sizes)
+        return result
+
+
 class Upload(FormView):
     template_name = 'photos/upload.html'
     form_class = UploadForm
@@ -45,6 +196,12 @@ class Upload(FormView):
         self.success_url = album.get_absolute_url()
         action = 'added {} photos to the album'.format(form.photo_count)
         send_action(self.request.user, action, target=album)
+        if form.duplicates:
+            messages.info(self.request, _('Skipped photos that are already in the gallery: %s')
+                          % ', '.join(form.duplicates))
+        if form.skipped:
+            messages.info(self.request, _('Skipped %s files that are not photos.')
+                          % len(form.skipped))
         return super().form_valid(form)
 
 
@@ -60,9 +217,15 @@ class Search(FormView):
         return super().form_valid(form)
 
 
-class Results(ListView):
+class Results(ThumbnailListMixin, CursorPaginationMixin, ListView):
+    """
+    The results of a search. Results sorted by name are paginated by cursor,
+    the others (ranked or sorted by when they were taken) by page number.
+    """
+
     paginate_by = settings.PHOTOS_PER_PAGE
     template_name = 'photos/photo_list.html'
+    fragment_template_name = 'photos/_photo_list_items.html'
 
     def get_queryset(self):
         return get_search_queryset(self.kwargs['query'])
@@ -74,8 +237,28 @@ class Results(ListView):
         context['query'] = self.kwargs['query']
         context['back_link'] = back_link
         context['page_title'] = _('Results')
+        context['facets'] = self.get_facets()
         return context
 
+    def get_facets(self):
+        """
+        Return the facets of the query (see get_search_facets) for the template,
+        as (title, [(name, count, url)]) tuples. Each url narrows the results
+        down to that album, person or location.
+        """
+        facets = get_search_facets(self.kwargs['query'])
+        titles = (('a', _('Albums')), ('p', _('People')), ('l', _('Locations')))
+        result = []
+        for param, title in titles:
+            values = []
+            for pk, name, count in facets[param]:
+                data = QueryDict(self.kwargs['query'], mutable=True)
+                data.setlist(param, [str(pk)])
+                values.append((name, count, reverse('results', kwargs={'query': data.urlencode()})))
+            if values:
+                result.append((title, values))
+        return result
+
 
 upload = permission_required('photos.add_photo')(Upload.as_view())
 search = login_required(Search.as_view())
@@ -1,21 +1,22 @@
-from tempfile import NamedTemporaryFile
-from zipfile import ZipFile
-from os import path
-
 from django.conf import settings
 from django.contrib.auth.decorators import login_required, permission_required
 from django.core.urlresolvers import reverse, reverse_lazy
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils.translation import ugettext as _
 from django.views.generic import ListView, DetailView
 
+from apps.photos.archives import AlbumArchive
 from apps.photos.forms import AlbumForm, AlbumMergeForm
 from apps.photos.models import Album, Location
+from apps.photos.views import CoverListMixin, ThumbnailListMixin
+from utils.http import get_content_disposition, serve_file
+from utils.pagination import CursorPaginationMixin
 from utils.views import AjaxCreateView, AjaxUpdateView, AjaxDeleteView
+from utils.zip import stream_zip
 
 
-class List(ListView):
+class List(CoverListMixin, ListView):
     model = Album
     paginate_by = settings.PHOTOS_PER_PAGE
     template_name = 'photos/album_list.html'
@@ -26,10 +27,11 @@ class List(ListView):
         return context
 
 
-class Detail(ListView):
+class Detail(ThumbnailListMixin, CursorPaginationMixin, ListView):
     paginate_by = settings.PHOTOS_PER_PAGE
     actions_template_name = 'photos/_album_actions.html'
     template_name = 'photos/photo_list.html'
+    fragment_template_name = 'photos/_photo_list_items.html'
 
     def get_album(self):
         return get_object_or_404(Album, pk=self.kwargs['pk'])
@@ -106,21 +108,32 @@ class Delete(AjaxDeleteView):
 
 
 class Download(DetailView):
+    """
+    Sends the originals of an album as a zip file, which is built while it is
+    sent so neither the archive nor the photos are ever held in full. Unless
+    ALBUM_ARCHIVE_MAX_SIZE is 0, the archive is also kept for the next
+    requests (see AlbumArchive).
+    """
     model = Album
 
-    def get_zip_file(self):
-        zip_file = NamedTemporaryFile()
-        with ZipFile(zip_file, 'w') as handle:
-            for photo in self.object.photo_set.all():
-                full_path = path.join(settings.MEDIA_ROOT, photo.file.name)
-                handle.write(full_path, photo.file.name.split('/')[-1])
-        zip_file.seek(0)
-        return zip_file
-
     def get(self, request, *args, **kwargs):
         self.object = self.get_object()
-        response = HttpResponse(self.get_zip_file().read(), content_type='application/zip')
-        response['Content-Disposition'] = 'attachment; filename={}.zip'.format(self.object.name)
+        filename = '{}.zip'.format(self.object.name)
+        archive = AlbumArchive(self.object)
+        if archive.enabled and not archive.exists():
+            lock = archive.lock()
+            if not archive.exists():
+                return self.stream(archive.build(lock), filename)
+            # Another request built it while we were waiting
+            lock.close()
+        if archive.exists():
+            archive.touch()
+            return serve_file(request, archive.storage, archive.name, filename=filename)
+        return self.stream(stream_zip(archive.get_files(archive.get_photos().iterator())), filename)
+
+    def stream(self, content, filename):
+        response = StreamingHttpResponse(content, content_type='application/zip')
+        response['Content-Disposition'] = get_content_disposition(filename)
         return response
 
 
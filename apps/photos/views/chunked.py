@@ -0,0 +1,125 @@
+import json
+
+from django.contrib.auth.decorators import permission_required
+from django.core.urlresolvers import reverse
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404
+from django.utils.translation import ugettext as _
+from django.views.generic import View
+
+from apps.photos.forms import UploadSessionForm
+from apps.photos.models import UploadSession
+from apps.photos.uploads import import_session
+
+
+class SessionMixin:
+    """
+    Looks up the upload session of the current user, and describes it in
+    JSON responses.
+    """
+
+    def get_session(self):
+        return get_object_or_404(
+            UploadSession, token=self.kwargs['token'], user=self.request.user)
+
+    def json(self, session, status=200, **data):
+        data.update({
+            'url': reverse('upload_session', kwargs={'token': session.token}),
+            'finalize_url': reverse('upload_session_finalize', kwargs={'token': session.token}),
+            'size': session.size,
+            'chunk_size': session.chunk_size,
+            'state': session.state,
+        })
+        if session.state in (UploadSession.UPLOADING, UploadSession.FAILED):
+            data['missing'] = session.get_missing_chunks()
+        if session.state == UploadSession.DONE:
+            data['album_url'] = session.album.get_absolute_url()
+            data.update(json.loads(session.result))
+        if session.state == UploadSession.FAILED:
+            data['error'] = session.error
+        return JsonResponse(data, status=status)
+
+    def json_busy(self, session):
+        return self.json(session, status=409, errors={'state': [
+            _('The upload was finalized already.')]})
+
+
+class Create(SessionMixin, View):
+    """
+    Starts a chunked upload. POST album, filename, size (in bytes) and
+    optionally skip_duplicates. The response has the url to PUT the chunks to,
+    the chunk size, and the chunks that are missing.
+    """
+
+    def post(self, request, *args, **kwargs):
+        form = UploadSessionForm(request.POST)
+        if not form.is_valid():
+            return JsonResponse({'errors': form.errors}, status=400)
+        return self.json(form.save(request.user), status=201)
+
+
+class Session(SessionMixin, View):
+    """
+    GET describes the upload (use it to find the chunks to send again after
+    a connection was lost, or to follow the import once it is finalized), PUT
+    ?offset=N writes the chunk that starts at byte N (a multiple of the chunk
+    size) from the request body, and DELETE cancels the upload. Chunks can
+    only be written, and the upload cancelled, until it is finalized (or
+    after its import failed).
+    """
+
+    def get(self, request, *args, **kwargs):
+        return self.json(self.get_session())
+
+    def put(self, request, *args, **kwargs):
+        session = self.get_session()
+        if session.state not in (UploadSession.UPLOADING, UploadSession.FAILED):
+            return self.json_busy(session)
+        try:
+            offset = int(request.GET.get('offset', ''))
+        except ValueError:
+            offset = -1
+        if offset < 0 or offset >= session.size or offset % session.chunk_size:
+            return JsonResponse({'errors': {'offset': [_('Invalid chunk offset.')]}}, status=400)
+        index = offset // session.chunk_size
+        if not session.write_chunk(index, request):
+            return JsonResponse({'errors': {'chunk': [
+                _('The chunk must be %s bytes.') % session.get_chunk_length(index)]}}, status=400)
+        return self.json(session)
+
+    def delete(self, request, *args, **kwargs):
+        session = self.get_session()
+        if session.state in (UploadSession.QUEUED, UploadSession.IMPORTING):
+            return self.json_busy(session)
+        session.delete()
+        return JsonResponse({})
+
+
+class Finalize(SessionMixin, View):
+    """
+    Adds the uploaded file to the album, through UploadForm, once every chunk
+    is in. The import is queued for the process_uploads command when
+    CHUNKED_UPLOAD_QUEUE is on (the response is a 202, GET the session until
+    its state is done or failed), otherwise it is done right away. Posting
+    again only reports the state of the import, unless it failed, so
+    retrying never imports the file twice. Once it is done, the response has
+    the url of the album and what was added.
+    """
+
+    def post(self, request, *args, **kwargs):
+        session = self.get_session()
+        if session.state in (UploadSession.UPLOADING, UploadSession.FAILED):
+            if session.get_missing_chunks():
+                return self.json(session, status=409)
+            if session.finalize() and session.state == UploadSession.IMPORTING:
+                import_session(session)
+        if session.state == UploadSession.DONE:
+            return self.json(session)
+        if session.state == UploadSession.FAILED:
+            return self.json(session, status=400)
+        return self.json(session, status=202)
+
+
+create = permission_required('photos.add_photo')(Create.as_view())
+session = permission_required('photos.add_photo')(Session.as_view())
+finalize = permission_required('photos.add_photo')(Finalize.as_view())
@@ -7,20 +7,23 @@ from django.views.generic import ListView
 
 from apps.photos.forms import LocationNameForm
 from apps.photos.models import Location
+from apps.photos.views import CoverListMixin
 from apps.stream.utils import send_action
+from utils.pagination import CursorPaginationMixin
 from utils.views import AjaxCreateView, AjaxUpdateView, AjaxDeleteView
 
 
-class List(ListView):
+class List(CoverListMixin, ListView):
     model = Location
     paginate_by = settings.PHOTOS_PER_PAGE
     template_name = 'photos/location_list.html'
 
 
-class Detail(ListView):
+class Detail(CoverListMixin, CursorPaginationMixin, ListView):
     paginate_by = settings.PHOTOS_PER_PAGE
     actions_template_name = 'photos/_location_actions.html'
     template_name = 'photos/album_list.html'
+    fragment_template_name = 'photos/_album_list_items.html'
 
     def get_location(self):
         return get_object_or_404(Location, pk=self.kwargs['pk'])
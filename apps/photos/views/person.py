@@ -8,11 +8,13 @@ from django.views.generic import ListView
 
 from apps.photos.forms import PersonNameForm
 from apps.photos.models import Person
+from apps.photos.views import CoverListMixin, ThumbnailListMixin
 from apps.stream.utils import send_action
+from utils.pagination import CursorPaginationMixin
 from utils.views import AjaxDeleteView, AjaxCreateView, AjaxUpdateView
 
 
-class List(ListView):
+class List(CoverListMixin, ListView):
     model = Person
     paginate_by = settings.PHOTOS_PER_PAGE
     template_name = 'photos/person_list.html'
@@ -23,10 +25,11 @@ class List(ListView):
         return context
 
 
-class Detail(ListView):
+class Detail(ThumbnailListMixin, CursorPaginationMixin, ListView):
     paginate_by = settings.PHOTOS_PER_PAGE
     actions_template_name = 'photos/_person_actions.html'
     template_name = 'photos/photo_list.html'
+    fragment_template_name = 'photos/_photo_list_items.html'
 
     def get_person(self):
         return get_object_or_404(Person, pk=self.kwargs['pk'])
@@ -1,19 +1,88 @@
-import mimetypes
+import hashlib
 
+from django.conf import settings
 from django.utils.translation import ugettext as _
 from django.contrib.auth.decorators import login_required, permission_required
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.http import Http404
 from django.shortcuts import get_object_or_404
+from django.utils.cache import patch_vary_headers
 from django.views.generic import DetailView, View
 
 from apps.photos.forms import PhotoMoveForm, PhotoNameForm, PhotoTagForm
 from apps.photos.models import Person, Photo, Location
-from apps.photos.utils import rotate_image
+from apps.photos.tags import TAG_INDEX_VERSION_KEY
+from apps.photos.utils import (
+    ORIENTATION_CLOCKWISE, accepts_webp, check_thumbnail_signature, get_dhash,
+    get_upright_original)
 from apps.photos.views import get_search_queryset
+from utils.http import serve_file
+from utils.pagination import get_keyset_filter, reverse_ordering
 from utils.views import AjaxDeleteView, AjaxUpdateView, AjaxFormMixin
 
 
+def get_photo_cache_key(prefix, queryset):
+    """
+    Return a cache key for the photos of the queryset that changes when photos are added, removed,
+    renamed or tagged anywhere (which changes the version of the tag index), or None if the
+    queryset cannot match anything.
+    """
+    try:
+        sql, params = queryset.values('id').query.sql_with_params()
+    except EmptyResultSet:
+        return None
+    return 'photos:{}:{}'.format(prefix, hashlib.md5(repr(
+        (sql, params, cache.get(TAG_INDEX_VERSION_KEY))).encode('utf-8')).hexdigest())
+
+
+def get_photo_position(queryset, before):
+    """
+    Return the position of a photo in the queryset (counting from 1) and the number of photos in
+    it, given a filter for the photos that come before it. Both are cached for
+    PHOTO_POSITION_TIMEOUT seconds, or until the photos change.
+    """
+    queryset = queryset.order_by()
+    key = get_photo_cache_key('position', queryset.filter(before))
+    position = cache.get(key) if key is not None else None
+    if position is None:
+        position = (queryset.filter(before).count() + 1, queryset.count())
+        if key is not None:
+            cache.set(key, position, settings.PHOTO_POSITION_TIMEOUT)
+    return position
+
+
+def get_photo_ids(queryset):
+    """
+    Return the ids of the photos in the queryset, in its order, for orderings that cannot be
+    compared in a query (such as the rank of a text search). They are cached like the position.
+    """
+    key = get_photo_cache_key('ids', queryset)
+    if key is None:
+        return []
+    ids = cache.get(key)
+    if ids is None:
+        ids = list(queryset.values_list('id', flat=True))
+        cache.set(key, ids, settings.PHOTO_POSITION_TIMEOUT)
+    return ids
+
+
+def get_keyset_ordering(queryset):
+    """
+    Return the ordering of the queryset, ending with the id, if it is only made of the photos'
+    own fields, otherwise None.
+    """
+    ordering = list(queryset.query.order_by or queryset.model._meta.ordering)
+    fields = set(field.name for field in queryset.model._meta.concrete_fields
+                 if not field.is_relation) | {'pk'}
+    if any(field.lstrip('-') not in fields for field in ordering):
+        return None
+    if not ordering or ordering[-1].lstrip('-') not in ('id', 'pk'):
+        ordering.append('id')
+    return tuple(ordering)
+
+
 class Detail(DetailView):
     model = Photo
     template_name = 'photos/photo_detail.html'
@@ -23,31 +92,50 @@ class Detail(DetailView):
 
     def paginate(self, queryset, obj):
         """
-        Figure out where this photo is located in the queryset (sorted by id). Queryset can be variable
-        based on how the user accessed the photo. Return a simple paginator dictionary.
+        Figure out where this photo is located in the queryset, in its own order (name, date taken
+        or search rank). Queryset can be variable based on how the user accessed the photo. When
+        the order is made of the photos' fields, the previous and next photos are found with one
+        indexed query each, and the position ("N of M") is cached, so none of this depends on how
+        many photos there are. Other orders go through the (cached) list of ids. Return a simple
+        paginator dictionary.
         """
-        values_list = list(queryset.order_by('name').values_list('id', flat=True))
-        index = values_list.index(obj.id)
+        queryset = queryset.all()
+        ordering = get_keyset_ordering(queryset)
+        if ordering is None:
+            ids = get_photo_ids(queryset)
+            if obj.pk not in ids:
+                raise Http404(_('This photo is not in these photos.'))
+            i = ids.index(obj.pk)
+            prev_pk = ids[i - 1] if i > 0 else None
+            next_pk = ids[i + 1] if i + 1 < len(ids) else None
+            index, count = i + 1, len(ids)
+        else:
+            if not queryset.filter(pk=obj.pk).exists():
+                raise Http404(_('This photo is not in these photos.'))
+            values = [getattr(obj, field.lstrip('-')) for field in ordering]
+            before = get_keyset_filter(ordering, values, forward=False)
+            after = get_keyset_filter(ordering, values)
+            prev_pk = queryset.filter(before).order_by(
+                *reverse_ordering(ordering)).values_list('id', flat=True).first()
+            next_pk = queryset.filter(after).order_by(
+                *ordering).values_list('id', flat=True).first()
+            index, count = get_photo_position(queryset, before)
 
         def build_url(pk):
             newkwargs = self.kwargs.copy()
             newkwargs['pk'] = pk
             return reverse('photo', kwargs=newkwargs)
 
-        next_url, prev_url = None, None
-        if len(values_list) > 1:
-            if obj.id != values_list[0]:
-                prev_url = build_url(values_list[index - 1])
-            if obj.id != values_list[-1]:
-                next_url = build_url(values_list[index + 1])
+        next_url = build_url(next_pk) if next_pk is not None else None
+        prev_url = build_url(prev_pk) if prev_pk is not None else None
 
         self.paginator = {
             'has_next': (next_url is not None),
             'next_url': next_url,
             'has_previous': (prev_url is not None),
             'previous_url': prev_url,
-            'index': (index + 1),
-            'count': len(values_list)
+            'index': index,
+            'count': count
         }
         return obj
 
@@ -71,7 +159,7 @@ class Detail(DetailView):
 
         if 'location_pk' in self.kwargs:
             self.location = get_object_or_404(Location, pk=self.kwargs.get('location_pk'))
-            album = get_object_or_404(self.location.album_set, pk=self.kwargs.get('location_pk'))
+            album = get_object_or_404(self.location.album_set, pk=self.kwargs.get('album_pk'))
             self.back_link = reverse('album', kwargs={'pk': album.pk, 'location_pk': self.location.pk}), album.name
             self.paginate(album.photo_set, obj)
             return obj
@@ -81,6 +169,9 @@ class Detail(DetailView):
         return obj
 
     def get_context_data(self, **kwargs):
+        if not settings.THUMBNAIL_ON_DEMAND:
+            # Look up the whole srcset ladder at once (and render it in one pass)
+            self.object.thumbnails(settings.THUMBNAIL_LADDERS['detail'])
         context = super().get_context_data(**kwargs)
         context['query'] = self.query
         context['person'] = self.person
@@ -129,9 +220,15 @@ class Tag(AjaxUpdateView):
 class Rotate(AjaxFormMixin, View):
     def post(self, request, *args, **kwargs):
         photo = get_object_or_404(Photo, pk=kwargs['pk'])
-        rotate_image(photo.file)
-        for thumb in photo.thumbnail_set.all():
-            rotate_image(thumb.file)
+        # Only the orientation changes, the original is left alone. The
+        # thumbnails are rendered again (once) from the original, turned the
+        # new way.
+        sizes = list(photo.thumbnail_set.values_list('size', flat=True))
+        photo.thumbnail_set.all().delete()
+        photo.orientation = ORIENTATION_CLOCKWISE[photo.orientation]
+        photo.dhash = get_dhash(photo.file, photo.orientation)
+        photo.save()
+        photo.generate_thumbnails(sizes)
         return self.json(url=photo.get_absolute_url())
 
 
@@ -153,14 +250,45 @@ class Delete(AjaxDeleteView):
 
 
 class Download(DetailView):
+    """
+    Sends the original of a photo, which can be resumed with Range requests
+    (see serve_file). Photos that were rotated are sent as a copy that is
+    turned the new way (see get_upright_original).
+    """
     model = Photo
 
     def get(self, request, *args, **kwargs):
         self.object = self.get_object()
-        file_data = self.object.file.file.read()
-        mimetype = mimetypes.guess_type(self.object.file.name, strict=False)[0]
-        response = HttpResponse(file_data, content_type=mimetype)
-        response['Content-Disposition'] = 'attachment; filename={}'.format(self.object.file.name.split('/')[-1])
+        file = self.object.file
+        filename = file.name.split('/')[-1]
+        name = get_upright_original(
+            file.storage, file.name, self.object.checksum, self.object.orientation)
+        return serve_file(request, file.storage, name, filename=filename)
+
+
+class ThumbnailFile(View):
+    """
+    Serves a thumbnail through the signed url from Photo.get_thumbnail_url,
+    rendering it first if it does not exist yet. The WebP version is sent to
+    browsers that accept it.
+    """
+
+    def get(self, request, *args, **kwargs):
+        size = kwargs['size']
+        if not check_thumbnail_signature(size, kwargs['signature']):
+            raise Http404
+        photo = get_object_or_404(Photo, pk=kwargs['pk'])
+        thumbnail = photo.find_thumbnail(size)
+        if thumbnail is None:
+            photo.generate_thumbnails([size])
+            thumbnail = photo.thumbnail_set.get(size=size)
+
+        file = thumbnail.file
+        if thumbnail.file_webp and accepts_webp(request):
+            file = thumbnail.file_webp
+        response = serve_file(request, file.storage, file.name,
+                              cache_control=settings.THUMBNAIL_CACHE_CONTROL)
+        patch_vary_headers(response, ['Accept'])
         return response
 
 
@@ -171,3 +299,4 @@ tag = permission_required('photos.edit_photo')(Tag.as_view())
 rotate = permission_required('photos.edit_photo')(Rotate.as_view())
 delete = permission_required('photos.delete_album')(Delete.as_view())
 download = login_required(Download.as_view())
+thumbnail = login_required(ThumbnailFile.as_view())
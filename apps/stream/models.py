@@ -46,6 +46,8 @@ class Action(models.Model):
         verbose_name = _('action')
         verbose_name_plural = _('actions')
         ordering = ['-timestamp', ]
+        # For paginating the stream by cursor (see apps.stream.views.List)
+        index_together = [('timestamp', 'id')]
 
     def __str__(self):
         ctx = {
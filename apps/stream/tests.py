@@ -21,6 +21,25 @@ class StreamViews(TestCase):
             response,
             '%s?next=%s' % (reverse('accounts:login'), reverse('home')))
 
+    def test_views_pagination(self):
+        """
+        Test that the stream is paginated by cursor, and that ajax requests
+        only get the actions.
+        """
+        for i in range(60):
+            Action.objects.create(user=self.user, verb='did {}'.format(i))
+        client = Client()
+        client.login(username='jacob', password='secret')
+        response = client.get(reverse('home'))
+        page = response.context['page_obj']
+        self.assertEqual(response.context['action_list'][0].verb, 'did 59')
+        response = client.get(reverse('home'), {'after': page.next_cursor},
+                              HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual([action.verb for action in response.context['action_list']],
+                         ['did {}'.format(i) for i in range(9, -1, -1)])
+        self.assertEqual(response.templates[0].name, 'stream/_action_list_items.html')
+        self.assertNotContains(response, 'data-more')
+
     def test_views_authenticated(self):
         """
         Test to make sure an authenticated user can get to secure views.
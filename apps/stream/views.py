@@ -2,10 +2,13 @@ from django.contrib.auth.decorators import login_required
 from django.views.generic import ListView
 
 from apps.stream.models import Action
+from utils.pagination import CursorPaginationMixin
 
 
-class List(ListView):
+class List(CursorPaginationMixin, ListView):
     template_name = 'stream/action_list.html'
+    fragment_template_name = 'stream/_action_list_items.html'
+    cursor_orderings = (('-timestamp', '-id'),)
     paginate_by = 50
     model = Action
 
@@ -1,3 +1,4 @@
+from multiprocessing import cpu_count
 from os import path
 
 ### Application settings
@@ -139,3 +140,115 @@ AUTH_CODE_ADMIN = 'auth-code-admin'
 AUTH_CODE_ADMIN_GROUP = 'Admin Group'
 
 PHOTOS_PER_PAGE = 50
+
+# Long lists are paginated by cursor (see utils.pagination), which does not
+# need to count them. The total that is shown is counted at most once per
+# PAGINATION_COUNT_TIMEOUT seconds for each list, or not at all with None.
+PAGINATION_COUNT_TIMEOUT = 300
+
+# Missing thumbnails are queued for the process_thumbnails command instead of
+# being generated during the request. Until then THUMBNAIL_PLACEHOLDER (a
+# static file) is shown in their place.
+THUMBNAIL_QUEUE = True
+THUMBNAIL_PLACEHOLDER = 'img/cover-blank.png'
+
+# Thumbnails are shared between photos with identical originals. Bump the
+# version when the way thumbnails are rendered changes, so they are rendered
+# again instead of shared with the old ones.
+THUMBNAIL_VERSION = 2
+
+# Thumbnails are always encoded as JPEG. With THUMBNAIL_WEBP they are also
+# encoded as WebP (if Pillow supports it), which pages offer next to the JPEG
+# in a <picture> for the browsers that can display it.
+THUMBNAIL_WEBP = True
+
+# The thumbnails offered to the browser (through srcset) for the photo grid
+# and for the photo detail page. The width of each size is what the browser
+# uses to pick one, so list them from small to large.
+THUMBNAIL_LADDERS = {
+    'grid': ('200x200-fit', '400x400-fit', '600x600-fit'),
+    'detail': ('320x240-thumb', '640x480-thumb', '1024x768-thumb', '2048x1536-thumb'),
+}
+
+# Sizes that the generate_thumbnails command renders ahead of time.
+THUMBNAIL_SIZES = THUMBNAIL_LADDERS['grid'] + THUMBNAIL_LADDERS['detail']
+
+# With THUMBNAIL_ON_DEMAND pages only link to thumbnails through signed urls
+# and each thumbnail is looked up (and rendered the first time) when the
+# browser requests it. Those responses can be cached for a year, since the url
+# changes whenever the image does.
+THUMBNAIL_ON_DEMAND = True
+THUMBNAIL_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+# Each process remembers the storage names of up to THUMBNAIL_CACHE_SIZE
+# thumbnails (0 turns this off). THUMBNAIL_CACHE_BACKEND can name one of the
+# CACHES to share them between processes as well.
+THUMBNAIL_CACHE_SIZE = 10000
+THUMBNAIL_CACHE_BACKEND = None
+
+# Thumbnails that are rendered while handling a request (when THUMBNAIL_QUEUE
+# is off, or for uploads) are rendered by up to THUMBNAIL_WORKERS threads at
+# once. Pillow releases the GIL while it decodes, resizes and encodes.
+try:
+    THUMBNAIL_WORKERS = cpu_count()
+except NotImplementedError:
+    THUMBNAIL_WORKERS = 1
+
+# The Cache-Control header of media files served by Django, by the first
+# prefix (of their path in MEDIA_ROOT) that matches. Originals and thumbnails
+# get unique names and renditions are named after their content, so none of
+# them ever change. Files under a prefix with None are not served.
+MEDIA_CACHE_CONTROL = (
+    ('photos/rendition/', 'private, max-age=31536000, immutable'),
+    ('photos/thumbnail/', 'private, max-age=31536000, immutable'),
+    ('photos/photo/', 'private, max-age=31536000, immutable'),
+    ('photos/uploadsession/', None),
+    ('', 'private, no-cache'),
+)
+
+# Search results show how many photos matched in each album, person and
+# location. Those counts are cached per query for SEARCH_FACETS_TIMEOUT
+# seconds.
+SEARCH_FACETS_TIMEOUT = 300
+
+# Searches by album, location and people are answered from an index of them
+# kept in memory (see apps.photos.tags), which is rebuilt from the database at
+# least every TAG_INDEX_TIMEOUT seconds. Changes are picked up sooner through
+# the default cache, which has to be shared between processes for that (the
+# default local memory cache is not, so other processes only see changes
+# after TAG_INDEX_TIMEOUT).
+TAG_INDEX_TIMEOUT = 300
+
+# The position of a photo among the photos it was reached from ("3 of 120")
+# is cached for up to PHOTO_POSITION_TIMEOUT seconds.
+PHOTO_POSITION_TIMEOUT = 300
+
+# Album downloads are kept (as zip files in MEDIA_ROOT/photos/archive) until
+# the ones that were used the least recently have to make room for others, to
+# stay under ALBUM_ARCHIVE_MAX_SIZE bytes. Use 0 to build them every time.
+ALBUM_ARCHIVE_MAX_SIZE = 10 * 1024 * 1024 * 1024
+
+# Originals and thumbnails are streamed by Django, unless SENDFILE_BACKEND
+# hands them to the web server: 'x-accel-redirect' for nginx (with an
+# internal location at SENDFILE_URL that serves MEDIA_ROOT) or 'x-sendfile'
+# for Apache and lighttpd.
+SENDFILE_BACKEND = None
+SENDFILE_URL = '/protected/media/'
+
+# Large uploads can be sent in chunks of CHUNKED_UPLOAD_CHUNK_SIZE bytes (see
+# apps.photos.views.chunked). A single upload can be at most
+# CHUNKED_UPLOAD_MAX_SIZE bytes, and all unfinished uploads together at most
+# CHUNKED_UPLOAD_MAX_TOTAL bytes. Uploads that receive nothing for
+# CHUNKED_UPLOAD_EXPIRY seconds are deleted by the cleanup_photos command.
+CHUNKED_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+CHUNKED_UPLOAD_MAX_SIZE = 10 * 1024 * 1024 * 1024
+CHUNKED_UPLOAD_MAX_TOTAL = 50 * 1024 * 1024 * 1024
+CHUNKED_UPLOAD_EXPIRY = 24 * 60 * 60
+
+# Finalized chunked uploads are imported by the process_uploads command
+# instead of during the request, which can take a while for a large zip.
+CHUNKED_UPLOAD_QUEUE = True
+
+# Photos whose perceptual hashes differ in at most this many (of 64) bits are
+# considered duplicates of each other.
+DUPLICATE_DISTANCE = 6
@@ -11,3 +11,10 @@ SECRET_KEY = 'simple_key_for_testing'
 PASSWORD_HASHERS = (
     'django.contrib.auth.hashers.MD5PasswordHasher',
 )
+
+THUMBNAIL_QUEUE = False
+CHUNKED_UPLOAD_QUEUE = False
+THUMBNAIL_ON_DEMAND = False
+THUMBNAIL_CACHE_SIZE = 0
+TAG_INDEX_TIMEOUT = 0
+PAGINATION_COUNT_TIMEOUT = 0
@@ -829,7 +829,8 @@ if(event.which==39){navigation.goto("right");}
 if(event.which==40){navigation.goto("down");}
 if(event.which==38&&$(document).scrollTop()==0){navigation.goto("up");}});}};var form={process:function(data){if(data.url){window.location=data.url;return;}
 if(data.html){form.showModal(data);return;}
-ajax.error(data);},showModal:function(data){$('#modal-window').show();$('#modal').html(data.html);$("#modal select").chosen();$("#modal .cancel").click(function(event){form.hideModal();});$("#modal form").submit(function(event){event.preventDefault();ajax.post($(this).attr("action"),$(this).serialize(),form.process);});},hideModal:function(){$('#modal-window').hide();$("#modal").html("");},init:function(){$("[data-modal='form']").click(function(event){event.preventDefault();ajax.get($(this).attr("href"),form.showModal);});},};var rotate={process:function(data){img=$('.photo img');img.attr("src",img.attr("src").split("?")[0]+"?"+new Date().getTime());},init:function(){$("[data-modal='rotate']").click(function(event){event.preventDefault();ajax.post($(this).attr("href"),{},rotate.process);});}};$(function(){navigation.init();form.init();rotate.init()});(function(){var $,AbstractChosen,Chosen,SelectParser,_ref,__hasProp={}.hasOwnProperty,__extends=function(child,parent){for(var key in parent){if(__hasProp.call(parent,key))child[key]=parent[key];}function ctor(){this.constructor=child;}ctor.prototype=parent.prototype;child.prototype=new ctor();child.__super__=parent.prototype;return child;};SelectParser=(function(){function SelectParser(){this.options_index=0;this.parsed=[];}
+ajax.error(data);},showModal:function(data){$('#modal-window').show();$('#modal').html(data.html);$("#modal select").chosen();$("#modal .cancel").click(function(event){form.hideModal();});$("#modal form").submit(function(event){event.preventDefault();ajax.post($(this).attr("action"),$(this).serialize(),form.process);});},hideModal:function(){$('#modal-window').hide();$("#modal").html("");},init:function(){$("[data-modal='form']").click(function(event){event.preventDefault();ajax.get($(this).attr("href"),form.showModal);});},};var rotate={process:function(data){img=$('.photo img');img.attr("src",img.attr("src").split("?")[0]+"?"+new Date().getTime());},init:function(){$("[data-modal='rotate']").click(function(event){event.preventDefault();ajax.post($(this).attr("href"),{},rotate.process);});}};var scroll={loading:false,more:function(){var link=$("[data-scroll] [data-more]:last");if(scroll.loading||!link.length||link.offset().top>$(window).scrollTop()+$(window).height()*2){return;}
+scroll.loading=true;ajax.get(link.attr("href"),function(data){link.parent().replaceWith(data);scroll.loading=false;scroll.more();});},init:function(){if($("[data-scroll]").length){$(window).scroll(scroll.more);scroll.more();}}};$(function(){navigation.init();form.init();rotate.init();scroll.init();});(function(){var $,AbstractChosen,Chosen,SelectParser,_ref,__hasProp={}.hasOwnProperty,__extends=function(child,parent){for(var key in parent){if(__hasProp.call(parent,key))child[key]=parent[key];}function ctor(){this.constructor=child;}ctor.prototype=parent.prototype;child.prototype=new ctor();child.__super__=parent.prototype;return child;};SelectParser=(function(){function SelectParser(){this.options_index=0;this.parsed=[];}
 SelectParser.prototype.add_node=function(child){if(child.nodeName.toUpperCase()==="OPTGROUP"){return this.add_group(child);}else{return this.add_option(child);}};SelectParser.prototype.add_group=function(group){var group_position,option,_i,_len,_ref,_results;group_position=this.parsed.length;this.parsed.push({array_index:group_position,group:true,label:this.escapeExpression(group.label),title:group.title?group.title:void 0,children:0,disabled:group.disabled,classes:group.className});_ref=group.childNodes;_results=[];for(_i=0,_len=_ref.length;_i<_len;_i++){option=_ref[_i];_results.push(this.add_option(option,group_position,group.disabled));}
 return _results;};SelectParser.prototype.add_option=function(option,group_position,group_disabled){if(option.nodeName.toUpperCase()==="OPTION"){if(option.text!==""){if(group_position!=null){this.parsed[group_position].children+=1;}
 this.parsed.push({array_index:this.parsed.length,options_index:this.options_index,value:option.value,text:option.text,html:option.innerHTML,title:option.title?option.title:void 0,selected:option.selected,disabled:group_disabled===true?group_disabled:option.disabled,group_array_index:group_position,group_label:group_position!=null?this.parsed[group_position].label:null,classes:option.className,style:option.style.cssText});}else{this.parsed.push({array_index:this.parsed.length,options_index:this.options_index,empty:true});}
@@ -88,9 +88,33 @@ var rotate = {
         });
     }
 };
+var scroll = {
+    loading: false,
+    more: function () {
+        // Load the next page into the list once its "More" link is in view.
+        var link = $("[data-scroll] [data-more]:last");
+        if (scroll.loading || !link.length ||
+                link.offset().top > $(window).scrollTop() + $(window).height() * 2) {
+            return;
+        }
+        scroll.loading = true;
+        ajax.get(link.attr("href"), function (data) {
+            link.parent().replaceWith(data);
+            scroll.loading = false;
+            scroll.more();
+        });
+    },
+    init: function () {
+        if ($("[data-scroll]").length) {
+            $(window).scroll(scroll.more);
+            scroll.more();
+        }
+    }
+};
 
 $(function () {
     navigation.init();
     form.init();
-    rotate.init()
+    rotate.init();
+    scroll.init();
 });
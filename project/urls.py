@@ -1,9 +1,12 @@
+import re
+
 from django.conf.urls import include, url
-from django.conf.urls.static import static
 from django.contrib import admin
+from django.contrib.auth.decorators import login_required
 from django.conf import settings
 
 from apps.stream.views import list
+from utils.views import serve_media
 
 urlpatterns = [
     url(r'^$', list, name='home'),
@@ -12,4 +15,9 @@ urlpatterns = [
     url(r'^', include('apps.photos.urls')),
 ]
 
-urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+# Media can also be served by the web server (at MEDIA_URL, or through
+# SENDFILE_BACKEND), but serving it here keeps it behind the login.
+urlpatterns += [
+    url(r'^{}(?P<path>.+)$'.format(re.escape(settings.MEDIA_URL.lstrip('/'))),
+        login_required(serve_media), name='media'),
+]
@@ -0,0 +1,114 @@
+from collections import OrderedDict
+import threading
+
+from django.core.cache import caches
+
+
+class LRUCache:
+    """
+    A bounded, thread safe, in-process cache that keeps the most recently
+    used entries (at most maxsize of them, 0 disables it). When backend (the
+    alias of one of the CACHES) is given, that cache is shared by all
+    processes as a second level: local misses are looked up there, and sets
+    and deletes go to both.
+    """
+
+    def __init__(self, maxsize, backend=None, prefix=''):
+        self.maxsize = maxsize
+        self.backend = backend
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, maxsize, backend=None):
+        """
+        Change the size and backend of the cache, and empty it.
+        """
+        with self._lock:
+            self.maxsize = maxsize
+            self.backend = backend
+        self.clear()
+
+    def _backend_keys(self, keys):
+        return dict((self.prefix + key, key) for key in keys)
+
+    def _store(self, data):
+        """
+        Store the given entries locally, evicting the least recently used
+        ones. Call with the lock held.
+        """
+        for key, value in data.items():
+            self._data[key] = value
+            self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get_many(self, keys):
+        """
+        Return a dictionary with the entries found for the given keys.
+        """
+        if not self.maxsize:
+            return {}
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._data:
+                    self._data.move_to_end(key)
+                    found[key] = self._data[key]
+        missing = [key for key in keys if key not in found]
+        if missing and self.backend:
+            backend_keys = self._backend_keys(missing)
+            shared = dict((backend_keys[key], value) for key, value in
+                          caches[self.backend].get_many(list(backend_keys)).items())
+            found.update(shared)
+            with self._lock:
+                self._store(shared)
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def set_many(self, data):
+        if not self.maxsize or not data:
+            return
+        with self._lock:
+            self._store(data)
+        if self.backend:
+            caches[self.backend].set_many(dict(
+                (self.prefix + key, value) for key, value in data.items()), None)
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+        if self.backend and keys:
+            caches[self.backend].delete_many(list(self._backend_keys(keys)))
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def clear(self):
+        """
+        Empty the local cache and reset the counters. Entries in the backend
+        are left alone, since other processes share them.
+        """
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Return the hit and miss counters, and how full the local cache is.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._data), 'maxsize': self.maxsize}
@@ -0,0 +1,184 @@
+import hashlib
+import mimetypes
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+# Not known to older versions of the mimetypes module
+mimetypes.add_type('image/webp', '.webp')
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# Amount of a file that is read (and sent) at a time for range requests
+RANGE_CHUNK_SIZE = 64 * 1024
+
+
+def get_file_etag(name, size, modified):
+    """
+    Returns a strong ETag for a stored file, based on its name, size and
+    modification time (a timestamp, or None).
+    """
+    value = '{}:{}:{}'.format(name, size, modified or '')
+    return quote_etag(hashlib.md5(value.encode('utf-8')).hexdigest())
+
+
+def get_modified_timestamp(storage, name):
+    """
+    Returns the modification time of the given file as a timestamp, or None
+    if the storage does not know it.
+    """
+    try:
+        return int(storage.modified_time(name).timestamp())
+    except (NotImplementedError, OSError):
+        return None
+
+
+def not_modified(request, etag, modified):
+    """
+    Returns True if the client already has the current version of a file,
+    according to the If-None-Match and If-Modified-Since request headers.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return etag in tags or '*' in tags
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return (if_modified_since is not None and modified is not None and
+            modified <= if_modified_since)
+
+
+def get_range(request, etag, modified, size):
+    """
+    Returns the (start, end) byte positions (end included) of the part of a
+    file the client asked for with a Range header, None if it asked for all of
+    it, or False if the range cannot be satisfied. Only single ranges are
+    supported, for anything else the whole file is sent. An If-Range header
+    that does not match the current version also gets the whole file.
+    """
+    match = RANGE_RE.match(request.META.get('HTTP_RANGE', '').replace(' ', ''))
+    if not match or match.groups() == ('', ''):
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range is not None and if_range != etag:
+        if_range_date = parse_http_date_safe(if_range)
+        if if_range_date is None or modified is None or modified > if_range_date:
+            return None
+    first, last = match.groups()
+    if not first:
+        # A suffix range, such as bytes=-500 for the last 500 bytes
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), int(last) if last else size - 1
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+def read_range(handle, start, end):
+    """
+    Yields the bytes from start to end (included) of the given file a chunk at
+    a time, and closes it.
+    """
+    try:
+        handle.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = handle.read(min(RANGE_CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        handle.close()
+
+
+def get_content_disposition(filename):
+    """
+    Returns a Content-Disposition header value that sends a file as an
+    attachment with the given name. The name is quoted (with anything that is
+    not printable ASCII replaced) for older clients, and given in full as
+    UTF-8 in filename* (RFC 6266) for the others.
+    """
+    fallback = ''.join(char if ' ' <= char <= '~' else '_' for char in filename)
+    fallback = fallback.replace('\\', '\\\\').replace('"', '\\"')
+    return 'attachment; filename="{}"; filename*=UTF-8\'\'{}'.format(
+        fallback, quote(filename, safe=''))
+
+
+def get_sendfile_response(storage, name, content_type):
+    """
+    Returns an empty response that tells the web server to send the file
+    itself, according to SENDFILE_BACKEND, or None if it is not set. With
+    'x-accel-redirect' (nginx) the file is found at SENDFILE_URL followed by
+    its name, with 'x-sendfile' (Apache, lighttpd) at its path on disk. The
+    web server then handles Range requests as well.
+    """
+    backend = getattr(settings, 'SENDFILE_BACKEND', None)
+    if not backend:
+        return None
+    response = HttpResponse(content_type=content_type)
+    if backend == 'x-accel-redirect':
+        response['X-Accel-Redirect'] = settings.SENDFILE_URL + quote(name)
+    elif backend == 'x-sendfile':
+        response['X-Sendfile'] = storage.path(name)
+    else:
+        raise ValueError('Unknown SENDFILE_BACKEND: {}'.format(backend))
+    return response
+
+
+def get_file_response(request, storage, name, content_type, etag, modified, size):
+    """
+    Returns a response that streams the given file from storage, or the part
+    of it the client asked for (see get_range).
+    """
+    byte_range = get_range(request, etag, modified, size)
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */{}'.format(size)
+    elif byte_range is not None:
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            read_range(storage.open(name, 'rb'), start, end),
+            status=206, content_type=content_type)
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+        response['Content-Length'] = end - start + 1
+    else:
+        response = FileResponse(storage.open(name, 'rb'), content_type=content_type)
+        response['Content-Length'] = size
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def serve_file(request, storage, name, cache_control=None, filename=None):
+    """
+    Returns a response for the given file in storage without reading it into
+    memory. Sends ETag and Last-Modified headers and answers conditional
+    requests with 304 Not Modified, and Range requests with the part that was
+    asked for. If SENDFILE_BACKEND is set the web server sends the file
+    instead (see get_sendfile_response). If filename is given, the file is
+    sent as an attachment with that name.
+    """
+    size = storage.size(name)
+    modified = get_modified_timestamp(storage, name)
+    etag = get_file_etag(name, size, modified)
+    content_type = mimetypes.guess_type(name, strict=False)[0] or 'application/octet-stream'
+
+    if not_modified(request, etag, modified):
+        response = HttpResponseNotModified()
+    else:
+        response = get_sendfile_response(storage, name, content_type)
+        if response is None:
+            response = get_file_response(
+                request, storage, name, content_type, etag, modified, size)
+        if filename:
+            response['Content-Disposition'] = get_content_disposition(filename)
+
+    response['ETag'] = etag
+    if modified is not None:
+        response['Last-Modified'] = http_date(modified)
+    if cache_control:
+        response['Cache-Control'] = cache_control
+    return response
@@ -0,0 +1,227 @@
+import hashlib
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Q
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.http import Http404
+from django.utils.functional import cached_property
+from django.utils.translation import ugettext as _
+
+__all__ = ['CursorPaginator', 'CursorPage', 'CursorPaginationMixin']
+
+CURSOR_SALT = 'utils.pagination.cursor'
+
+
+def encode_cursor(index, values):
+    """
+    Return an opaque (signed) cursor for the object at the given (1-based)
+    index, with the given values of the ordering fields.
+    """
+    values = [value.isoformat() if hasattr(value, 'isoformat') else value for value in values]
+    return signing.dumps([index, values], salt=CURSOR_SALT, compress=True)
+
+
+def decode_cursor(cursor):
+    """
+    Return the (index, values) in a cursor made by encode_cursor. Raises
+    Http404 if it was not made by it.
+    """
+    try:
+        index, values = signing.loads(cursor, salt=CURSOR_SALT)
+        return int(index), list(values)
+    except (signing.BadSignature, TypeError, ValueError):
+        raise Http404(_('Invalid page.'))
+
+
+def reverse_ordering(ordering):
+    return tuple(field[1:] if field.startswith('-') else '-' + field for field in ordering)
+
+
+def get_comparison(name, lookup, value):
+    """
+    Return a Q that matches the objects whose field is greater ('gt') or less
+    ('lt') than the value, where NULL (None) compares the way the database
+    sorts it: above every other value (PostgreSQL, Oracle) or below (SQLite,
+    MySQL). Returns None if no object can match.
+    """
+    null_matches = connection.features.nulls_order_largest == (lookup == 'gt')
+    if value is None:
+        return None if null_matches else Q(**{'{}__isnull'.format(name): False})
+    query = Q(**{'{}__{}'.format(name, lookup): value})
+    if null_matches:
+        query |= Q(**{'{}__isnull'.format(name): True})
+    return query
+
+
+def get_keyset_filter(ordering, values, forward=True):
+    """
+    Return a Q that matches the objects that come after (or before, if not
+    forward) the given values of the ordering fields, such as name > 'x' OR
+    (name = 'x' AND id > 5) for ('name', 'id'). Fields can be NULL, except
+    for the last one.
+    """
+    query = None
+    for i, field in enumerate(ordering):
+        name = field.lstrip('-')
+        lookup = 'gt' if field.startswith('-') != forward else 'lt'
+        comparison = get_comparison(name, lookup, values[i])
+        if comparison is None:
+            continue
+        equal = Q()
+        for other, value in zip(ordering[:i], values):
+            if value is None:
+                equal &= Q(**{'{}__isnull'.format(other.lstrip('-')): True})
+            else:
+                equal &= Q(**{other.lstrip('-'): value})
+        equal &= comparison
+        query = equal if query is None else query | equal
+    return query
+
+
+class CursorPage:
+    """
+    A page of objects from CursorPaginator. It has the parts of Django's Page
+    that the templates use, plus the cursors of the pages next to it.
+    """
+
+    def __init__(self, object_list, paginator, start, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.start = start
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self):
+        return '<Page starting at {}>'.format(self.start)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def start_index(self):
+        return self.start if self.object_list else 0
+
+    def end_index(self):
+        return self.start + len(self.object_list) - 1
+
+
+class CursorPaginator:
+    """
+    Splits a queryset into pages by the values of its ordering fields (which
+    have to end with a unique field such as the primary key) instead of by
+    offset, so every page, however deep, costs one indexed query. Pages are
+    asked for with the cursor of the object they start after (or end before),
+    and each page carries the cursors of the pages next to it.
+    The total is counted once per PAGINATION_COUNT_TIMEOUT seconds (it is only
+    needed for display), or not at all when that is None.
+    """
+
+    def __init__(self, queryset, per_page, ordering):
+        self.queryset = queryset
+        self.per_page = int(per_page)
+        self.ordering = tuple(ordering)
+
+    @cached_property
+    def count(self):
+        timeout = settings.PAGINATION_COUNT_TIMEOUT
+        if timeout is None:
+            return None
+        try:
+            sql, params = self.queryset.values('pk').query.sql_with_params()
+        except EmptyResultSet:
+            return 0
+        key = 'pagination:count:{}'.format(
+            hashlib.md5(repr((sql, params)).encode('utf-8')).hexdigest())
+        count = cache.get(key)
+        if count is None:
+            count = self.queryset.count()
+            cache.set(key, count, timeout)
+        return count
+
+    def get_values(self, obj):
+        return [getattr(obj, field.lstrip('-')) for field in self.ordering]
+
+    def page(self, after=None, before=None):
+        """
+        Return the page after the cursor after, before the cursor before, or
+        the first page.
+        """
+        queryset = self.queryset
+        if before:
+            index, values = decode_cursor(before)
+            queryset = queryset.filter(get_keyset_filter(self.ordering, values, forward=False))
+            reverse = reverse_ordering(self.ordering)
+            object_list = list(queryset.order_by(*reverse)[:self.per_page + 1])
+            more = len(object_list) > self.per_page
+            object_list = object_list[:self.per_page][::-1]
+            start = max(index - len(object_list), 1)
+            next_cursor = encode_cursor(index, values)
+            previous_cursor = encode_cursor(start, self.get_values(object_list[0])) if more else None
+            return CursorPage(object_list, self, start, next_cursor, previous_cursor)
+
+        start, previous_cursor = 1, None
+        if after:
+            start, values = decode_cursor(after)
+            queryset = queryset.filter(get_keyset_filter(self.ordering, values))
+        object_list = list(queryset.order_by(*self.ordering)[:self.per_page + 1])
+        more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+        if after and object_list:
+            previous_cursor = encode_cursor(start, self.get_values(object_list[0]))
+        next_cursor = None
+        if more:
+            next_cursor = encode_cursor(
+                start + len(object_list), self.get_values(object_list[-1]))
+        return CursorPage(object_list, self, start, next_cursor, previous_cursor)
+
+
+class CursorPaginationMixin:
+    """
+    Paginates a ListView with CursorPaginator (by the 'after' and 'before'
+    parameters) when its queryset is sorted by one of cursor_orderings, and
+    by page number otherwise. Ajax requests get fragment_template_name, which
+    only renders the objects and the link to the next page, to load more of
+    them into the page as it is scrolled.
+    """
+
+    cursor_orderings = (('name', 'id'),)
+    fragment_template_name = None
+
+    def get_cursor_ordering(self, queryset):
+        """
+        Return the ordering of the queryset (with the primary key as the
+        tie-breaker) if it is one of cursor_orderings, otherwise None.
+        """
+        ordering = tuple(queryset.query.order_by or queryset.model._meta.ordering)
+        for cursor_ordering in self.cursor_orderings:
+            if ordering in (cursor_ordering, cursor_ordering[:-1]):
+                return cursor_ordering
+        return None
+
+    def paginate_queryset(self, queryset, page_size):
+        ordering = self.get_cursor_ordering(queryset)
+        if ordering is None:
+            return super().paginate_queryset(queryset, page_size)
+        paginator = CursorPaginator(queryset, page_size, ordering)
+        page = paginator.page(after=self.request.GET.get('after'),
+                              before=self.request.GET.get('before'))
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def get_template_names(self):
+        if self.request.is_ajax() and self.fragment_template_name:
+            return [self.fragment_template_name]
+        return super().get_template_names()
@@ -1,10 +1,25 @@
+from datetime import datetime
+from io import BytesIO
 import json
+import os
+import tempfile
+import time
+import zipfile
 
 from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
 from django.core.exceptions import PermissionDenied
-from django.test import TestCase, RequestFactory
+from django.http import Http404
+from django.test import TestCase, RequestFactory, override_settings
+from django.utils.timezone import utc
 
+from utils.cache import LRUCache
+from utils.http import get_content_disposition, serve_file
+from utils.pagination import CursorPaginator
 from utils.uploads import split_extension, file_allowed, get_unique_upload_path
+from utils.zip import stream_zip
 
 
 class FakeModel:
@@ -57,3 +72,243 @@ class Uploads(TestCase):
         self.assertEqual(len(filename), 55)
         self.assertEqual(filename[:19], 'testing/fake_model/')
         self.assertEqual(filename[-4:], '.jpg')
+
+
+class Cache(TestCase):
+    def test_lru_cache(self):
+        """
+        Test that LRUCache evicts the least recently used entries and counts
+        hits and misses.
+        """
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(cache.get_many(['a', 'b', 'c']), {'a': 1, 'c': 3})
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats(), {'hits': 3, 'misses': 2, 'size': 1, 'maxsize': 2})
+
+    def test_lru_cache_backend(self):
+        """
+        Test that LRUCache shares its entries through the backend cache.
+        """
+        cache = LRUCache(10, backend='default', prefix='test:')
+        cache.set('a', 1)
+        other = LRUCache(10, backend='default', prefix='test:')
+        self.assertEqual(other.get('a'), 1)
+        cache.delete('a')
+        other.clear()
+        self.assertIsNone(other.get('a'))
+
+
+class CursorPagination(TestCase):
+    def setUp(self):
+        for i, name in enumerate('cbacbab'):
+            User.objects.create(username='user{}'.format(i), first_name=name)
+
+    def walk(self, paginator):
+        """
+        Return the names on each page, going forward and then back again.
+        """
+        pages = [paginator.page()]
+        while pages[-1].has_next():
+            pages.append(paginator.page(after=pages[-1].next_cursor))
+        forward = [[user.username for user in page] for page in pages]
+        self.assertEqual([(page.start_index(), page.end_index()) for page in pages],
+                         [(1, 3), (4, 6), (7, 7)])
+        page, backward = pages[-1], []
+        while page.has_previous():
+            page = paginator.page(before=page.previous_cursor)
+            backward.insert(0, [user.username for user in page])
+        self.assertEqual(backward, forward[:-1])
+        return forward
+
+    def test_pages(self):
+        """
+        Test that pages follow the ordering, using the last field to break
+        ties, in both directions.
+        """
+        paginator = CursorPaginator(User.objects.all(), 3, ('first_name', 'id'))
+        self.assertEqual(self.walk(paginator), [
+            ['user2', 'user5', 'user1'], ['user4', 'user6', 'user0'], ['user3']])
+        self.assertEqual(paginator.count, 7)
+
+        paginator = CursorPaginator(User.objects.all(), 3, ('-first_name', '-id'))
+        self.assertEqual(self.walk(paginator), [
+            ['user3', 'user0', 'user6'], ['user4', 'user1', 'user5'], ['user2']])
+
+    def test_null_values(self):
+        """
+        Test that objects whose ordering field is NULL are paged through
+        where the database sorts them, in both directions.
+        """
+        for i, user in enumerate(User.objects.order_by('id')):
+            if i % 3:
+                user.last_login = datetime(2015, 1, 7 - i, tzinfo=utc)
+                user.save()
+        for ordering in (('last_login', 'id'), ('-last_login', '-id')):
+            usernames = list(User.objects.order_by(*ordering).values_list('username', flat=True))
+            paginator = CursorPaginator(User.objects.all(), 3, ordering)
+            self.assertEqual(self.walk(paginator), [usernames[:3], usernames[3:6], usernames[6:]])
+
+    def test_invalid_cursor(self):
+        """
+        Test that cursors that were not made by the paginator are not found.
+        """
+        paginator = CursorPaginator(User.objects.all(), 3, ('first_name', 'id'))
+        with self.assertRaises(Http404):
+            paginator.page(after='abc')
+
+    @override_settings(PAGINATION_COUNT_TIMEOUT=300)
+    def test_cached_count(self):
+        """
+        Test that the count is only done once per queryset.
+        """
+        CursorPaginator(User.objects.all(), 3, ('first_name', 'id')).count
+        with self.assertNumQueries(0):
+            self.assertEqual(CursorPaginator(User.objects.all(), 3, ('first_name', 'id')).count, 7)
+
+
+class Zip(TestCase):
+    def test_stream_zip(self):
+        """
+        Test that stream_zip yields a valid archive a chunk at a time.
+        """
+        with tempfile.TemporaryDirectory() as location:
+            storage = FileSystemStorage(location=location)
+            storage.save('a.jpg', ContentFile(b'a' * 250))
+            storage.save('b.jpg', ContentFile(b''))
+            files = [('one.jpg', storage.open('a.jpg'), None),
+                     ('twö.jpg', ContentFile(b''), 1500000000),
+                     ('old.jpg', ContentFile(b'old'), 0)]
+            chunks = list(stream_zip(files, chunk_size=100))
+        self.assertGreater(len(chunks), 3)
+        self.assertLess(max(len(chunk) for chunk in chunks), 200)
+        with zipfile.ZipFile(BytesIO(b''.join(chunks))) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.namelist(), ['one.jpg', 'twö.jpg', 'old.jpg'])
+            self.assertEqual(archive.read('one.jpg'), b'a' * 250)
+            self.assertEqual(archive.read('old.jpg'), b'old')
+            self.assertEqual(archive.getinfo('one.jpg').compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(archive.getinfo('twö.jpg').date_time,
+                             time.localtime(1500000000)[:5] + (time.localtime(1500000000)[5] // 2 * 2, ))
+            self.assertEqual(archive.getinfo('old.jpg').date_time, (1980, 1, 1, 0, 0, 0))
+
+
+class ServeFile(TestCase):
+    def setUp(self):
+        self.location = tempfile.TemporaryDirectory()
+        self.storage = FileSystemStorage(location=self.location.name)
+        self.storage.save('photo.jpg', ContentFile(b'0123456789'))
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        self.location.cleanup()
+
+    def get(self, **headers):
+        return serve_file(self.factory.get('/', **headers), self.storage, 'photo.jpg')
+
+    def test_content_disposition(self):
+        """
+        Test that attachment names are quoted, and sent in full as UTF-8.
+        """
+        self.assertEqual(get_content_disposition('Beach, day 1; "best".zip'),
+                         'attachment; filename="Beach, day 1; \\"best\\".zip"; '
+                         'filename*=UTF-8\'\'Beach%2C%20day%201%3B%20%22best%22.zip')
+        self.assertEqual(get_content_disposition('Café.zip'),
+                         'attachment; filename="Caf_.zip"; filename*=UTF-8\'\'Caf%C3%A9.zip')
+
+    def test_ranges(self):
+        """
+        Test that single ranges are answered with just that part of the file.
+        """
+        scenarios = {
+            'bytes=2-4': (b'234', 'bytes 2-4/10'),
+            'bytes=7-': (b'789', 'bytes 7-9/10'),
+            'bytes=-3': (b'789', 'bytes 7-9/10'),
+            'bytes=8-20': (b'89', 'bytes 8-9/10'),
+        }
+        for header, (content, content_range) in scenarios.items():
+            response = self.get(HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(b''.join(response.streaming_content), content)
+            self.assertEqual(response['Content-Range'], content_range)
+            self.assertEqual(response['Content-Length'], str(len(content)))
+
+        response = self.get(HTTP_RANGE='bytes=10-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */10')
+        # Multiple ranges and outdated If-Range headers get the whole file
+        response = self.get(HTTP_RANGE='bytes=0-1,4-5')
+        self.assertEqual(response.status_code, 200)
+        response = self.get(HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE='"other"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+        response = self.get(HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE=response['ETag'])
+        self.assertEqual(response.status_code, 206)
+
+    def test_not_modified(self):
+        """
+        Test that a client that has the file gets 304, even for a range.
+        """
+        etag = self.get()['ETag']
+        response = self.get(HTTP_IF_NONE_MATCH=etag, HTTP_RANGE='bytes=0-1')
+        self.assertEqual(response.status_code, 304)
+
+    def test_sendfile(self):
+        """
+        Test that the file is handed to the web server when configured.
+        """
+        with override_settings(SENDFILE_BACKEND='x-accel-redirect',
+                               SENDFILE_URL='/protected/'):
+            response = self.get()
+            self.assertEqual(response['X-Accel-Redirect'], '/protected/photo.jpg')
+            self.assertEqual(response['Content-Type'], 'image/jpeg')
+            self.assertEqual(response.content, b'')
+        with override_settings(SENDFILE_BACKEND='x-sendfile'):
+            response = self.get()
+            self.assertEqual(response['X-Sendfile'], self.storage.path('photo.jpg'))
+
+
+class ServeMedia(TestCase):
+    def setUp(self):
+        self.location = tempfile.TemporaryDirectory()
+        self.override = override_settings(MEDIA_ROOT=self.location.name)
+        self.override.enable()
+        for name in ('photos/rendition/a-200x200-fit-v2.jpg', 'photos/uploadsession/a.part',
+                     'photos/archive/album-1-a.zip'):
+            os.makedirs(os.path.join(self.location.name, os.path.dirname(name)), exist_ok=True)
+            with open(os.path.join(self.location.name, name), 'wb') as handle:
+                handle.write(b'0123456789')
+        User.objects.create_user('user', password='pass')
+        self.client.login(username='user', password='pass')
+
+    def tearDown(self):
+        self.override.disable()
+        self.location.cleanup()
+
+    def test_serve_media(self):
+        """
+        Test that media is served with the caching rules of its prefix.
+        """
+        response = self.client.get('/media/photos/rendition/a-200x200-fit-v2.jpg')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'private, max-age=31536000, immutable')
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        response = self.client.get('/media/photos/rendition/a-200x200-fit-v2.jpg',
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get('/media/photos/archive/album-1-a.zip', HTTP_RANGE='bytes=5-')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+        self.assertEqual(b''.join(response.streaming_content), b'56789')
+
+        for path in ('photos/uploadsession/a.part', 'photos/rendition/', 'photos/missing.jpg',
+                     '../secret.txt', 'photos/rendition/../uploadsession/a.part',
+                     'photos//uploadsession/a.part', 'photos/./uploadsession/a.part'):
+            self.assertEqual(self.client.get('/media/' + path).status_code, 404)
+        self.client.logout()
+        response = self.client.get('/media/photos/rendition/a-200x200-fit-v2.jpg')
+        self.assertEqual(response.status_code, 302)
@@ -1,3 +1,4 @@
+import hashlib
 import os
 import uuid
 
@@ -37,3 +38,14 @@ def get_unique_upload_path(instance, filename):
     app_label = str(instance._meta.app_label.lower())
     model_name = str(instance._meta.model_name.lower())
     return '/'.join([app_label, model_name, new_filename])
+
+
+def get_file_checksum(file_handle):
+    """
+    Returns the SHA-1 hex digest of the contents of the given file (a Django
+    File or FieldFile), reading it in chunks.
+    """
+    checksum = hashlib.sha1()
+    for chunk in file_handle.chunks():
+        checksum.update(chunk)
+    return checksum.hexdigest()
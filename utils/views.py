@@ -1,7 +1,16 @@
-from django.http import JsonResponse
+import os
+import posixpath
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
+from django.http import Http404, JsonResponse
 from django.views.generic import CreateView, UpdateView, DeleteView, RedirectView
 
-__all__ = ['AjaxFormView', 'AjaxCreateView', 'AjaxUpdateView', 'AjaxDeleteView', 'RedirectView']
+from utils.http import serve_file
+
+__all__ = ['AjaxFormView', 'AjaxCreateView', 'AjaxUpdateView', 'AjaxDeleteView', 'RedirectView',
+           'serve_media']
 
 
 class AjaxFormMixin:
@@ -51,3 +60,35 @@ class AjaxDeleteView(AjaxFormMixin, DeleteView):
         success_url = self.get_success_url()
         self.object.delete()
         return self.json(url=success_url)
+
+
+def get_media_cache_control(path):
+    """
+    Returns the Cache-Control header for the media file at path, from the
+    first prefix in MEDIA_CACHE_CONTROL that matches it. Raises KeyError if
+    none does.
+    """
+    for prefix, cache_control in settings.MEDIA_CACHE_CONTROL:
+        if path.startswith(prefix):
+            return cache_control
+    raise KeyError(path)
+
+
+def serve_media(request, path):
+    """
+    Serves a file from MEDIA_ROOT (through serve_file, so with ETags, 304
+    responses, byte ranges and X-Sendfile) with the Cache-Control header from
+    MEDIA_CACHE_CONTROL. Files whose prefix has no Cache-Control (None) are
+    not served at all. The path is normalised before its prefix is looked up,
+    and paths that leave MEDIA_ROOT (or could leave a prefix) are refused.
+    """
+    if path.startswith('/') or '\\' in path or '..' in path.split('/'):
+        raise Http404
+    path = posixpath.normpath(path)
+    try:
+        cache_control = get_media_cache_control(path)
+        if cache_control is None or not os.path.isfile(default_storage.path(path)):
+            raise Http404
+    except (KeyError, SuspiciousFileOperation):
+        raise Http404
+    return serve_file(request, default_storage, path, cache_control=cache_control)
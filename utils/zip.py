@@ -0,0 +1,138 @@
+import struct
+import time
+import zlib
+
+# Amount of each file that is read (and sent) at a time
+ZIP_CHUNK_SIZE = 64 * 1024
+
+# Sizes and offsets from this on need ZIP64 records
+ZIP64_LIMIT = 0xffffffff
+ZIP64_COUNT_LIMIT = 0xffff
+
+# Flags: sizes and CRC follow the data (in a data descriptor), UTF-8 names
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+DATA_DESCRIPTOR = struct.Struct('<IIII')
+DATA_DESCRIPTOR64 = struct.Struct('<IIQQ')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+END_RECORD = struct.Struct('<IHHHHIIH')
+END_RECORD64 = struct.Struct('<IQHHIIQQQQ')
+END_LOCATOR64 = struct.Struct('<IIQI')
+
+
+def get_dos_time(timestamp):
+    """
+    Return the (time, date) of the given timestamp (or now, for None) the way
+    zip files store them. Times before 1980 cannot be stored and become
+    1980-01-01.
+    """
+    year, month, day, hour, minute, second = time.localtime(timestamp)[:6]
+    if year < 1980:
+        year, month, day, hour, minute, second = 1980, 1, 1, 0, 0, 0
+    return ((hour << 11) | (minute << 5) | (second // 2),
+            ((year - 1980) << 9) | (month << 5) | day)
+
+
+class ZipMember:
+    """
+    The central directory entry of a file that was written to the archive.
+    """
+
+    def __init__(self, arcname, modified, offset):
+        self.name = arcname.encode('utf-8')
+        self.flags = FLAG_DATA_DESCRIPTOR
+        if any(ord(char) > 127 for char in arcname):
+            self.flags |= FLAG_UTF8
+        self.time, self.date = get_dos_time(modified)
+        self.offset = offset
+        self.crc = 0
+        self.size = 0
+
+    def local_header(self, zip64):
+        """
+        Return the header that comes before the data. Its sizes and CRC are
+        left empty, they are only known after the data (see data_descriptor).
+        """
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if zip64 else b''
+        size = ZIP64_LIMIT if zip64 else 0
+        return LOCAL_HEADER.pack(
+            0x04034b50, 45 if zip64 else 20, self.flags, 0, self.time, self.date,
+            0, size, size, len(self.name), len(extra)) + self.name + extra
+
+    def data_descriptor(self, zip64):
+        record = DATA_DESCRIPTOR64 if zip64 else DATA_DESCRIPTOR
+        return record.pack(0x08074b50, self.crc, self.size, self.size)
+
+    def central_header(self):
+        values = []
+        size = self.size
+        if size >= ZIP64_LIMIT:
+            values += [size, size]
+            size = ZIP64_LIMIT
+        offset = self.offset
+        if offset >= ZIP64_LIMIT:
+            values.append(offset)
+            offset = ZIP64_LIMIT
+        extra = b''
+        if values:
+            extra = struct.pack('<HH' + 'Q' * len(values), 1, 8 * len(values), *values)
+        version = 45 if values else 20
+        return CENTRAL_HEADER.pack(
+            0x02014b50, (3 << 8) | version, version, self.flags, 0, self.time, self.date,
+            self.crc, size, size, len(self.name), len(extra), 0, 0, 0, 0o644 << 16,
+            offset) + self.name + extra
+
+
+def get_end_records(members, start, end):
+    """
+    Return the records that end an archive with the given members, whose
+    central directory goes from start to end. ZIP64 records are added when
+    the archive is too large, or has too many members, for the classic one.
+    """
+    count, size = len(members), end - start
+    if count < ZIP64_COUNT_LIMIT and start < ZIP64_LIMIT and size < ZIP64_LIMIT:
+        return END_RECORD.pack(0x06054b50, 0, 0, count, count, size, start, 0)
+    return (
+        END_RECORD64.pack(0x06064b50, 44, (3 << 8) | 45, 45, 0, 0, count, count, size, start) +
+        END_LOCATOR64.pack(0x07064b50, 0, end, 1) +
+        END_RECORD.pack(0x06054b50, 0, 0, min(count, ZIP64_COUNT_LIMIT),
+                        min(count, ZIP64_COUNT_LIMIT), min(size, ZIP64_LIMIT),
+                        min(start, ZIP64_LIMIT), 0))
+
+
+def stream_zip(files, chunk_size=ZIP_CHUNK_SIZE):
+    """
+    Yields a zip archive of the given files, which is an iterable of
+    (arcname, file, modified) tuples, where file is an open Django File
+    (which is closed once it is read) and modified is its modification time
+    as a timestamp or None, a chunk at a time. The files are stored without
+    compression (photos are already compressed), so only about chunk_size
+    bytes are held in memory at a time. The records are written here rather
+    than with ZipFile, which can only write to a stream that cannot seek
+    from Python 3.6 on.
+    """
+    members = []
+    position = 0
+    for arcname, file, modified in files:
+        member = ZipMember(arcname, modified, position)
+        with file as source:
+            # Knowing the size up front decides on ZIP64
+            zip64 = file.size >= ZIP64_LIMIT
+            header = member.local_header(zip64)
+            yield header
+            position += len(header)
+            for chunk in iter(lambda: source.read(chunk_size), b''):
+                member.crc = zlib.crc32(chunk, member.crc)
+                member.size += len(chunk)
+                yield chunk
+        zip64 = zip64 or member.size >= ZIP64_LIMIT
+        descriptor = member.data_descriptor(zip64)
+        yield descriptor
+        position += member.size + len(descriptor)
+        members.append(member)
+    start = position
+    directory = b''.join(member.central_header() for member in members)
+    yield directory
+    yield get_end_records(members, start, start + len(directory))